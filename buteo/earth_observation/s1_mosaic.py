@@ -7,6 +7,7 @@ from glob import glob
 from numba import jit, prange
 from buteo.raster.io import (
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
     raster_to_array,
     array_to_raster,
 )
@@ -289,6 +290,7 @@ def mosaic_sentinel1(
                     tile_extent[3],
                 ]
 
+                invalidate_raster_metadata(tile_img_path)
                 warped = gdal.Warp(
                     tile_img_path,
                     meta["path"],
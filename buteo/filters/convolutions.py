@@ -6,51 +6,134 @@ from numba import jit, prange
 from buteo.filters.kernel_generator import create_kernel
 
 
+# 2D kernels with at least this many weights use FFT convolution (11x11).
+FFT_KERNEL_SIZE = 121
+
+# The size of the tiles convolved with FFTs, before the kernel overlap.
+FFT_BLOCK_SIZE = 1024
+
+
+@jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
+def hood_summed(values, weights, length):
+    summed = 0.0
+    for idx in range(length):
+        summed += values[idx] * weights[idx]
+
+    return summed
+
+
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_summed(values, weights):
-    return np.sum(np.multiply(values, weights))
+def hood_swap(values, weights, first, second):
+    value = values[first]
+    values[first] = values[second]
+    values[second] = value
+
+    weight = weights[first]
+    weights[first] = weights[second]
+    weights[second] = weight
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_quantile(values, weights, quant):
-    sort_mask = np.argsort(values)
-    sorted_data = values[sort_mask]
-    sorted_weights = weights[sort_mask]
-    cumsum = np.cumsum(sorted_weights)
-    intersect = (cumsum - 0.5 * sorted_weights) / cumsum[-1]
-    return np.interp(quant, intersect, sorted_data)
+def hood_quantile(values, weights, length, quant):
+    # Weighted quickselect. Reorders the values and weights in place, and
+    # narrows in on the two values whose midpoints in the cumulative weights
+    # straddle quant. Same as interpolating the sorted midpoints.
+    if length == 0:
+        return np.nan
+
+    total = 0.0
+    for idx in range(length):
+        total += weights[idx]
+
+    low = 0
+    high = length - 1
+    weight_below = 0.0
+
+    lower_value = values[0]
+    lower_position = -1.0
+    upper_value = values[0]
+    upper_position = 2.0
+
+    while low <= high:
+        # Partition around the middle value.
+        hood_swap(values, weights, (low + high) // 2, high)
+        pivot = values[high]
+
+        store = low
+        left_weight = 0.0
+        for idx in range(low, high):
+            if values[idx] < pivot:
+                left_weight += weights[idx]
+                hood_swap(values, weights, idx, store)
+                store += 1
+
+        hood_swap(values, weights, store, high)
+
+        position = (weight_below + left_weight + 0.5 * weights[store]) / total
+
+        if position == quant:
+            return pivot
+        elif position < quant:
+            lower_value = pivot
+            lower_position = position
+            weight_below += left_weight + weights[store]
+            low = store + 1
+        else:
+            upper_value = pivot
+            upper_position = position
+            high = store - 1
+
+    if lower_position < 0.0:
+        return upper_value
+    if upper_position > 1.0:
+        return lower_value
+
+    fraction = (quant - lower_position) / (upper_position - lower_position)
+
+    return lower_value + (upper_value - lower_value) * fraction
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_standard_deviation(values, weights):
-    summed = hood_summed(values, weights)
-    variance = np.sum(np.multiply(np.power(np.subtract(values, summed), 2), weights))
+def hood_standard_deviation(values, weights, length):
+    summed = hood_summed(values, weights, length)
+
+    variance = 0.0
+    for idx in range(length):
+        variance += ((values[idx] - summed) ** 2) * weights[idx]
+
     return np.sqrt(variance)
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_median_absolute_deviation(values, weights):
-    median = hood_quantile(values, weights, 0.5)
-    absdeviation = np.abs(np.subtract(values, median))
-    return hood_quantile(absdeviation, weights, 0.5)
+def hood_median_absolute_deviation(
+    values, weights, length, scratch_values, scratch_weights
+):
+    median = hood_quantile(values, weights, length, 0.5)
+
+    for idx in range(length):
+        scratch_values[idx] = np.abs(values[idx] - median)
+        scratch_weights[idx] = weights[idx]
+
+    return hood_quantile(scratch_values, scratch_weights, length, 0.5)
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_z_score(values, weights):
-    center_idx = len(values) // 2
-    center = values[center_idx]
-    std = hood_standard_deviation(values, weights)
-    mean = hood_summed(values, weights)
+def hood_z_score(values, weights, length, center):
+    std = hood_standard_deviation(values, weights, length)
+    mean = hood_summed(values, weights, length)
 
     return (center - mean) / std
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_z_score_mad(values, weights):
-    center_idx = len(values) // 2
-    center = values[center_idx]
-    mad_std = hood_median_absolute_deviation(values, weights) * 1.4826
-    median = hood_quantile(values, weights, 0.5)
+def hood_z_score_mad(values, weights, length, center, scratch_values, scratch_weights):
+    mad_std = (
+        hood_median_absolute_deviation(
+            values, weights, length, scratch_values, scratch_weights
+        )
+        * 1.4826
+    )
+    median = hood_quantile(values, weights, length, 0.5)
 
     return (center - median) / mad_std
 
@@ -61,69 +144,87 @@ def k_to_size(size):
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_sigma_lee_mad(values, weights):
-    std = hood_median_absolute_deviation(values, weights) * 1.4826
-    selected_values = np.zeros_like(values)
-    selected_weights = np.zeros_like(weights)
+def hood_sigma_lee_mad(
+    values, weights, length, hood_size, scratch_values, scratch_weights
+):
+    std = (
+        hood_median_absolute_deviation(
+            values, weights, length, scratch_values, scratch_weights
+        )
+        * 1.4826
+    )
 
     sigma2 = std * 2
     sigma_min = -sigma2
     sigma_max = sigma2
 
     passed = 0
-    for idx in range(len(values)):
+    sum_of_weights = 0.0
+    for idx in range(length):
         if values[idx] >= sigma_min and values[idx] <= sigma_max:
-            selected_values[idx] = values[idx]
-            selected_weights[idx] = weights[idx]
+            scratch_values[passed] = values[idx]
+            scratch_weights[passed] = weights[idx]
+            sum_of_weights += weights[idx]
             passed += 1
 
-    if passed <= k_to_size(values.size):
-        steep = np.power(weights, 2)
-        steep_sum = np.sum(steep)
-        normed_steed = np.divide(steep, steep_sum)
-        return hood_quantile(values, normed_steed, 0.5)
+    if passed <= k_to_size(hood_size):
+        steep_sum = 0.0
+        for idx in range(length):
+            scratch_values[idx] = values[idx]
+            scratch_weights[idx] = weights[idx] ** 2
+            steep_sum += scratch_weights[idx]
+
+        for idx in range(length):
+            scratch_weights[idx] = scratch_weights[idx] / steep_sum
+
+        return hood_quantile(scratch_values, scratch_weights, length, 0.5)
 
-    sum_of_weights = np.sum(selected_weights)
     if sum_of_weights == 0:
         return 0
 
-    selected_weights = np.divide(selected_weights, sum_of_weights)
+    for idx in range(passed):
+        scratch_weights[idx] = scratch_weights[idx] / sum_of_weights
 
-    return hood_quantile(selected_values, selected_weights, 0.5)
+    return hood_quantile(scratch_values, scratch_weights, passed, 0.5)
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True, inline="always")
-def hood_sigma_lee(values, weights):
-    std = hood_standard_deviation(values, weights)
-    selected_values = np.zeros_like(values)
-    selected_weights = np.zeros_like(weights)
+def hood_sigma_lee(values, weights, length, hood_size, scratch_values, scratch_weights):
+    std = hood_standard_deviation(values, weights, length)
+
+    for idx in range(length):
+        scratch_values[idx] = 0.0
+        scratch_weights[idx] = 0.0
 
     sigma_mult = 1
     passed = 0
     attempts = 0
-    ks = k_to_size(values.size)
+    ks = k_to_size(hood_size)
 
     while passed < ks and attempts < 5:
-        for idx in range(len(values)):
+        for idx in range(length):
             if values[idx] >= std * sigma_mult and values[idx] <= -std * sigma_mult:
-                selected_values[idx] = values[idx]
-                selected_weights[idx] = weights[idx]
+                scratch_values[idx] = values[idx]
+                scratch_weights[idx] = weights[idx]
                 passed += 1
 
         sigma_mult += 1
         attempts += 1
 
     if passed < ks:
-        return hood_summed(values, weights)
+        return hood_summed(values, weights, length)
 
-    sum_of_weights = np.sum(selected_weights)
+    sum_of_weights = 0.0
+    for idx in range(length):
+        sum_of_weights += scratch_weights[idx]
 
     if sum_of_weights == 0:
         return 0
 
-    selected_weights = np.divide(selected_weights, sum_of_weights)
+    for idx in range(length):
+        scratch_weights[idx] = scratch_weights[idx] / sum_of_weights
 
-    return hood_summed(selected_values, selected_weights)
+    return hood_summed(scratch_values, scratch_weights, length)
 
 
 @jit(nopython=True, parallel=True, nogil=True, fastmath=True)
@@ -131,105 +232,511 @@ def convolve_3d(
     arr,
     offsets,
     weights,
+    valid,
+    full,
+    masked,
     operation="sum",
     border="valid",
     quantile=0.5,
-    nodata=False,
-    nodata_value=0,
 ):
     x_adj = arr.shape[0] - 1
     y_adj = arr.shape[1] - 1
     z_adj = (arr.shape[2] - 1) // 2
 
     hood_size = len(offsets)
+    hood_center = hood_size // 2
     result = np.zeros(arr.shape[:2], dtype="float32")
-    border = True if border == "valid" else False
+    valid_border = border == "valid"
+
+    # The neighbours of the pixels this far from the edges are all inside.
+    edge_x = 0
+    edge_y = 0
+    edge_z = 0
+    for n in range(hood_size):
+        edge_x = max(edge_x, abs(offsets[n][0]))
+        edge_y = max(edge_y, abs(offsets[n][1]))
+        edge_z = max(edge_z, abs(offsets[n][2]))
 
     for x in prange(arr.shape[0]):
+
+        # Scratch buffers, reused for every pixel of the row. Only the
+        # neighbours with a weight are gathered, the first length entries.
+        hood_values = np.zeros(hood_size, dtype="float32")
+        hood_weights = np.zeros(hood_size, dtype="float32")
+        scratch_values = np.zeros(hood_size, dtype="float32")
+        scratch_weights = np.zeros(hood_size, dtype="float32")
+
         for y in range(arr.shape[1]):
 
-            hood_values = np.zeros(hood_size, dtype="float32")
-            hood_weights = np.zeros(hood_size, dtype="float32")
-            weight_sum = np.array([0.0], dtype="float32")
+            length = 0
+            weight_sum = 0.0
+            center = 0.0
             normalise = False
 
-            for n in range(hood_size):
-                offset_x = x + offsets[n][0]
-                offset_y = y + offsets[n][1]
-                offset_z = offsets[n][2]
-
-                outside = False
-
-                if offset_z < -z_adj:
-                    offset_z = -z_adj
-                    outside = True
-                elif offset_z > z_adj:
-                    offset_z = z_adj
-                    outside = True
-
-                if offset_x < 0:
-                    offset_x = 0
-                    outside = True
-                elif offset_x > x_adj:
-                    offset_x = x_adj
-                    outside = True
-
-                if offset_y < 0:
-                    offset_y = 0
-                    outside = True
-                elif offset_y > y_adj:
-                    offset_y = y_adj
-                    outside = True
-
-                value = arr[offset_x, offset_y, offset_z]
-
-                if border == True and outside == True:
-                    normalise = True
-                    hood_weights[n] = 0
-                elif nodata and value == nodata_value:
-                    normalise = True
-                    hood_weights[n] = 0
-                else:
-                    hood_values[n] = value
+            inside = (
+                edge_z <= z_adj
+                and x >= edge_x
+                and x <= x_adj - edge_x
+                and y >= edge_y
+                and y <= y_adj - edge_y
+            )
+
+            # Every neighbour is inside and valid, so nothing is checked.
+            if inside and (not masked or full[x, y]):
+                for n in range(hood_size):
+                    value = arr[x + offsets[n][0], y + offsets[n][1], offsets[n][2]]
                     weight = weights[n]
 
-                    hood_weights[n] = weight
-                    weight_sum[0] += weight
+                    if n == hood_center:
+                        center = value
+
+                    if weight != 0:
+                        hood_values[length] = value
+                        hood_weights[length] = weight
+                        length += 1
+            else:
+                for n in range(hood_size):
+                    offset_x = x + offsets[n][0]
+                    offset_y = y + offsets[n][1]
+                    offset_z = offsets[n][2]
+
+                    outside = False
+
+                    if offset_z < -z_adj:
+                        offset_z = -z_adj
+                        outside = True
+                    elif offset_z > z_adj:
+                        offset_z = z_adj
+                        outside = True
+
+                    if offset_x < 0:
+                        offset_x = 0
+                        outside = True
+                    elif offset_x > x_adj:
+                        offset_x = x_adj
+                        outside = True
+
+                    if offset_y < 0:
+                        offset_y = 0
+                        outside = True
+                    elif offset_y > y_adj:
+                        offset_y = y_adj
+                        outside = True
+
+                    value = arr[offset_x, offset_y, offset_z]
+
+                    if valid_border and outside:
+                        normalise = True
+                    elif masked and not valid[offset_x, offset_y, offset_z]:
+                        normalise = True
+                    else:
+                        weight = weights[n]
+                        weight_sum += weight
+
+                        if n == hood_center:
+                            center = value
+
+                        if weight != 0:
+                            hood_values[length] = value
+                            hood_weights[length] = weight
+                            length += 1
 
             if normalise:
-                hood_weights = np.divide(hood_weights, weight_sum[0])
+                for idx in range(length):
+                    hood_weights[idx] = hood_weights[idx] / weight_sum
 
             if operation == "sum":
-                result[x][y] = np.sum(np.multiply(hood_values, hood_weights))
+                result[x][y] = hood_summed(hood_values, hood_weights, length)
 
             elif operation == "quantile":
-                result[x][y] = hood_quantile(hood_values, hood_weights, quantile)
+                result[x][y] = hood_quantile(
+                    hood_values, hood_weights, length, quantile
+                )
 
             elif operation == "median":
-                result[x][y] = hood_quantile(hood_values, hood_weights, 0.5)
+                result[x][y] = hood_quantile(hood_values, hood_weights, length, 0.5)
 
             elif operation == "median_absolute_deviation":
-                result[x][y] == hood_median_absolute_deviation(
-                    hood_values, hood_weights
+                result[x][y] = hood_median_absolute_deviation(
+                    hood_values, hood_weights, length, scratch_values, scratch_weights
                 )
             elif operation == "standard_deviation":
-                result[x][y] = hood_standard_deviation(hood_values, hood_weights)
+                result[x][y] = hood_standard_deviation(
+                    hood_values, hood_weights, length
+                )
 
             elif operation == "z_score":
-                result[x][y] = hood_z_score(hood_values, hood_weights)
+                result[x][y] = hood_z_score(hood_values, hood_weights, length, center)
 
             elif operation == "z_score_mad":
-                result[x][y] = hood_z_score_mad(hood_values, hood_weights)
+                result[x][y] = hood_z_score_mad(
+                    hood_values,
+                    hood_weights,
+                    length,
+                    center,
+                    scratch_values,
+                    scratch_weights,
+                )
 
             elif operation == "sigma_lee":
-                result[x][y] = hood_sigma_lee(hood_values, hood_weights)
+                result[x][y] = hood_sigma_lee(
+                    hood_values,
+                    hood_weights,
+                    length,
+                    hood_size,
+                    scratch_values,
+                    scratch_weights,
+                )
 
             elif operation == "sigma_lee_mad":
-                result[x][y] = hood_sigma_lee_mad(hood_values, hood_weights)
+                result[x][y] = hood_sigma_lee_mad(
+                    hood_values,
+                    hood_weights,
+                    length,
+                    hood_size,
+                    scratch_values,
+                    scratch_weights,
+                )
 
     return result
 
 
+def kernel_is_separable(kernel_2d, tolerance=1e-6):
+    singular = np.linalg.svd(kernel_2d, compute_uv=False)
+
+    return singular.size < 2 or singular[1] <= singular[0] * tolerance
+
+
+def kernel_spans(kernel_2d, tolerance=1e-6):
+    """The first and last column with a weight in each row of a kernel, as
+    offsets from the center. None if the weights differ, or a row is not one
+    run of weights, as the histogram engine cannot be used then."""
+    nonzero = kernel_2d != 0
+
+    if not nonzero.any():
+        return None
+
+    used = kernel_2d[nonzero]
+    if np.abs(used - used[0]).max() > abs(used[0]) * tolerance:
+        return None
+
+    edge_y = kernel_2d.shape[1] // 2
+    spans = np.zeros((kernel_2d.shape[0], 2), dtype="int64")
+
+    for row in range(kernel_2d.shape[0]):
+        columns = np.nonzero(nonzero[row])[0]
+
+        if columns.size == 0:
+            # An empty row, the start is after the end.
+            spans[row] = (1, 0)
+            continue
+
+        if columns[-1] - columns[0] + 1 != columns.size:
+            return None
+
+        spans[row] = (columns[0] - edge_y, columns[-1] - edge_y)
+
+    return spans
+
+
+def select_engine(kernel, operation="sum", dtype=None):
+    """Picks the fastest engine for an operation with a kernel. Only weighted
+    sums with 2D kernels can be separated or use FFTs, and medians and
+    quantiles of 8 and 16 bit integers with flat kernels use sliding
+    histograms. Everything else is evaluated offset by offset in convolve_3d."""
+    if kernel.ndim == 3 and kernel.shape[2] != 1:
+        return "loop"
+
+    kernel_2d = kernel[:, :, 0] if kernel.ndim == 3 else kernel
+
+    if operation in ["median", "quantile"]:
+        if dtype in [np.uint8, np.uint16] and kernel_spans(kernel_2d) is not None:
+            return "histogram"
+
+        return "loop"
+
+    if operation != "sum":
+        return "loop"
+
+    if kernel_is_separable(kernel_2d):
+        return "separable"
+
+    if kernel_2d.size >= FFT_KERNEL_SIZE:
+        return "fft"
+
+    return "loop"
+
+
+def correlate_separable(arr, kernel_2d):
+    # A rank one kernel is the outer product of a column and a row.
+    u, singular, vt = np.linalg.svd(kernel_2d)
+    column = u[:, 0] * np.sqrt(singular[0])
+    row = vt[0] * np.sqrt(singular[0])
+
+    edge_x = kernel_2d.shape[0] // 2
+    edge_y = kernel_2d.shape[1] // 2
+
+    # Outside the array is zero, so it adds nothing.
+    padded = np.pad(arr, ((edge_x, edge_x), (edge_y, edge_y)))
+
+    passed = np.zeros((arr.shape[0], padded.shape[1]), dtype="float64")
+    for idx, weight in enumerate(column):
+        passed += weight * padded[idx : idx + arr.shape[0], :]
+
+    result = np.zeros(arr.shape, dtype="float64")
+    for idx, weight in enumerate(row):
+        result += weight * passed[:, idx : idx + arr.shape[1]]
+
+    return result
+
+
+def correlate_fft(arr, kernel_2d, block_size=FFT_BLOCK_SIZE):
+    kernel_x, kernel_y = kernel_2d.shape
+    edge_x = kernel_x // 2
+    edge_y = kernel_y // 2
+
+    padded = np.pad(arr, ((edge_x, edge_x), (edge_y, edge_y)))
+
+    # Overlap-save: each tile carries the kernel overlap, and the part of the
+    # circular convolution that wraps around is discarded.
+    fft_shape = (
+        min(block_size, arr.shape[0]) + kernel_x - 1,
+        min(block_size, arr.shape[1]) + kernel_y - 1,
+    )
+    kernel_fft = np.fft.rfft2(kernel_2d[::-1, ::-1], fft_shape)
+
+    result = np.empty(arr.shape, dtype="float64")
+
+    for x in range(0, arr.shape[0], block_size):
+        for y in range(0, arr.shape[1], block_size):
+            block_x = min(block_size, arr.shape[0] - x)
+            block_y = min(block_size, arr.shape[1] - y)
+
+            tile = padded[
+                x : x + block_x + kernel_x - 1, y : y + block_y + kernel_y - 1
+            ]
+
+            convolved = np.fft.irfft2(
+                np.fft.rfft2(tile, fft_shape) * kernel_fft, fft_shape
+            )
+
+            result[x : x + block_x, y : y + block_y] = convolved[
+                kernel_x - 1 : kernel_x - 1 + block_x,
+                kernel_y - 1 : kernel_y - 1 + block_y,
+            ]
+
+    return result
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def histogram_quantile(arr, spans, quantile, bins, valid, masked):
+    """Sliding histogram (Huang) quantile of an integer array with a flat
+    kernel, given as the column spans of each kernel row. Moving one pixel
+    along a row adds and removes one pixel per kernel row. The histogram has
+    two levels, so finding a rank looks at most at 256 coarse and 256 fine
+    bins, also for 16 bit values. Pixels outside the array and invalid pixels
+    are excluded, as in convolve_3d."""
+    x_size = arr.shape[0]
+    y_size = arr.shape[1]
+    edge_x = spans.shape[0] // 2
+    coarse_bins = (bins + 255) // 256
+
+    result = np.zeros((x_size, y_size), dtype="float32")
+
+    for x in prange(x_size):
+        histogram = np.zeros(bins, dtype=np.int64)
+        coarse = np.zeros(coarse_bins, dtype=np.int64)
+        count = 0
+
+        # The histogram of the first pixel of the row.
+        for row in range(spans.shape[0]):
+            offset_x = x + row - edge_x
+            if offset_x < 0 or offset_x >= x_size:
+                continue
+
+            start_y = max(spans[row, 0], 0)
+            end_y = min(spans[row, 1], y_size - 1)
+
+            for offset_y in range(start_y, end_y + 1):
+                if masked and not valid[offset_x, offset_y]:
+                    continue
+
+                value = arr[offset_x, offset_y]
+                histogram[value] += 1
+                coarse[value >> 8] += 1
+                count += 1
+
+        for y in range(y_size):
+            if count == 0:
+                result[x, y] = np.nan
+            else:
+                # Equal weights put rank i at (i + 0.5) / count.
+                target = quantile * count - 0.5
+                if target < 0.0:
+                    target = 0.0
+                elif target > count - 1:
+                    target = count - 1
+
+                lower_rank = int(np.floor(target))
+                fraction = target - lower_rank
+
+                values = np.zeros(2, dtype=np.float64)
+                for idx in range(2):
+                    rank = min(lower_rank + idx, count - 1)
+
+                    seen = 0
+                    block = 0
+                    while seen + coarse[block] <= rank:
+                        seen += coarse[block]
+                        block += 1
+
+                    value = block << 8
+                    while seen + histogram[value] <= rank:
+                        seen += histogram[value]
+                        value += 1
+
+                    values[idx] = value
+
+                result[x, y] = values[0] + (values[1] - values[0]) * fraction
+
+            if y == y_size - 1:
+                break
+
+            # Slide one pixel: remove the left column, add the right column.
+            for row in range(spans.shape[0]):
+                offset_x = x + row - edge_x
+                if offset_x < 0 or offset_x >= x_size or spans[row, 0] > spans[row, 1]:
+                    continue
+
+                remove_y = y + spans[row, 0]
+                if remove_y >= 0 and remove_y < y_size:
+                    value = arr[offset_x, remove_y]
+                    if not masked or valid[offset_x, remove_y]:
+                        histogram[value] -= 1
+                        coarse[value >> 8] -= 1
+                        count -= 1
+
+                add_y = y + 1 + spans[row, 1]
+                if add_y >= 0 and add_y < y_size:
+                    value = arr[offset_x, add_y]
+                    if not masked or valid[offset_x, add_y]:
+                        histogram[value] += 1
+                        coarse[value >> 8] += 1
+                        count += 1
+
+    return result
+
+
+def box_sum_rows(arr, edge):
+    """The sums of the rows within edge rows of each row, clipped to the
+    array, from a running sum."""
+    rows = arr.shape[0]
+    summed = np.cumsum(arr, axis=0, dtype="int32")
+
+    # The sum up to the last row of each window, minus the sum before it.
+    box = np.empty_like(summed)
+    split = max(rows - edge, 0)
+    box[:split] = summed[edge:]
+    box[split:] = summed[-1]
+
+    if rows > edge + 1:
+        box[edge + 1 :] -= summed[: rows - edge - 1]
+
+    return box
+
+
+def valid_counts(valid_2d, kernel_shape):
+    """The amount of valid pixels in the window of a kernel around each pixel,
+    as running sums over the rows and columns of the validity mask. Pixels
+    outside the array are not counted, so a count equal to the size of the
+    window means every neighbour is inside and valid."""
+    counts = box_sum_rows(valid_2d, kernel_shape[0] // 2)
+
+    return box_sum_rows(counts.T, kernel_shape[1] // 2).T
+
+
+def border_weights(kernel_2d, rows, columns, height, width):
+    """The sum of the weights of a kernel that fall inside the array, around
+    the given rows and columns, from an integral image of the kernel."""
+    edge_x = kernel_2d.shape[0] // 2
+    edge_y = kernel_2d.shape[1] // 2
+
+    integral = np.zeros((kernel_2d.shape[0] + 1, kernel_2d.shape[1] + 1))
+    integral[1:, 1:] = kernel_2d.cumsum(axis=0).cumsum(axis=1)
+
+    start_x = np.clip(edge_x - rows, 0, kernel_2d.shape[0])[:, np.newaxis]
+    end_x = np.clip(edge_x + height - rows, 0, kernel_2d.shape[0])[:, np.newaxis]
+    start_y = np.clip(edge_y - columns, 0, kernel_2d.shape[1])
+    end_y = np.clip(edge_y + width - columns, 0, kernel_2d.shape[1])
+
+    return (
+        integral[end_x, end_y]
+        - integral[start_x, end_y]
+        - integral[end_x, start_y]
+        + integral[start_x, start_y]
+    )
+
+
+def weighted_sum(arr_2d, kernel_2d, engine="separable", valid=None):
+    """The "sum" operation of convolve_3d with "valid" borders, using separable
+    1D passes or FFTs. Pixels outside the array and invalid pixels are
+    excluded, and where any are excluded the weights are normalised by what is
+    left."""
+    correlate = correlate_separable if engine == "separable" else correlate_fft
+    height, width = arr_2d.shape
+    edge_x = kernel_2d.shape[0] // 2
+    edge_y = kernel_2d.shape[1] // 2
+
+    if valid is None:
+        result = correlate(arr_2d.astype("float64"), kernel_2d.astype("float64"))
+
+        # Without a mask only the borders miss neighbours. Each border strip is
+        # normalised by the weights inside the array.
+        top = min(edge_x, height)
+        bottom = max(height - edge_x, top)
+        left = min(edge_y, width)
+        right = max(width - edge_y, left)
+
+        strips = [
+            (0, top, 0, width),
+            (bottom, height, 0, width),
+            (top, bottom, 0, left),
+            (top, bottom, right, width),
+        ]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for x_start, x_end, y_start, y_end in strips:
+                if x_end <= x_start or y_end <= y_start:
+                    continue
+
+                result[x_start:x_end, y_start:y_end] /= border_weights(
+                    kernel_2d,
+                    np.arange(x_start, x_end),
+                    np.arange(y_start, y_end),
+                    height,
+                    width,
+                )
+
+        return result.astype("float32")
+
+    values = np.where(valid, arr_2d, 0).astype("float64")
+
+    numerator = correlate(values, kernel_2d.astype("float64"))
+
+    # Counting the valid pixels under the footprint finds the excluded ones.
+    excluded = valid_counts(valid, kernel_2d.shape) < kernel_2d.size
+
+    if not excluded.any():
+        return numerator.astype("float32")
+
+    denominator = correlate(valid.astype("float64"), kernel_2d.astype("float64"))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        result = np.where(excluded, numerator / denominator, numerator)
+
+    return result.astype("float32")
+
+
 def filter_array(
     arr,
     shape,
@@ -239,11 +746,43 @@ def filter_array(
     normalised=True,
     nodata=False,
     nodata_value=0,
+    mask=None,
     quantile=0.5,
     distance_calc="gaussian",
     radius_method="ellipsoid",
     operation="sum",
+    engine="auto",
 ):
+    """Filters an array with a kernel. The pixels used are given by a validity
+    mask, combined from the mask of a masked array, mask (True is valid) and
+    nodata_value if nodata is True. Invalid pixels are excluded and the weights
+    renormalised. If arr is a masked array or a mask is given, the result is a
+    masked array, masked where the input is."""
+    masked_output = np.ma.isMaskedArray(arr) or mask is not None
+
+    # The mask is used as is, the array is never filled.
+    valid = None
+    if np.ma.isMaskedArray(arr):
+        if arr.mask is not np.ma.nomask:
+            valid = ~arr.mask
+
+        arr = arr.data
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype="bool")
+        if mask.ndim == 2 and arr.ndim == 3:
+            mask = mask[:, :, np.newaxis]
+
+        valid = mask if valid is None else valid & mask
+
+    if nodata:
+        by_value = arr != nodata_value
+        valid = by_value if valid is None else valid & by_value
+
+    # Without a mask, no validity array is allocated.
+    if valid is not None:
+        valid = np.ascontiguousarray(np.broadcast_to(valid, arr.shape))
+
     if len(arr.shape) == 3:
         if len(shape) == 2:
             shape = (arr.shape[0], shape[0], shape[1])
@@ -254,6 +793,9 @@ def filter_array(
                 shape[0] = 1
         elif len(shape) == 2:
             arr = arr[np.newaxis, :, :]
+
+            if valid is not None:
+                valid = valid[np.newaxis, :, :]
         else:
             raise ValueError("Unable to merge shape and array.")
 
@@ -268,13 +810,85 @@ def filter_array(
         radius_method=radius_method,
     )
 
+    # auto picks separable passes or FFTs for weighted sums, and sliding
+    # histograms for integer medians, where possible.
+    if engine == "auto":
+        engine = select_engine(_kernel, operation, arr.dtype)
+
+    if engine not in ["loop", "separable", "fft", "histogram"]:
+        raise ValueError(f"Unable to parse engine: {engine}")
+
+    result = filter_engine(
+        arr, valid, _kernel, offsets, weights, operation, quantile, engine
+    )
+
+    if masked_output:
+        mask = np.ma.nomask if valid is None else ~valid[:, :, 0]
+        return np.ma.array(result, mask=mask, copy=False)
+
+    return result
+
+
+def filter_engine(arr, valid, kernel, offsets, weights, operation, quantile, engine):
+    """Runs an engine over the valid pixels of an array. If valid is None, all
+    the pixels are valid."""
+    masked = valid is not None
+    if engine == "histogram":
+        spans = kernel_spans(kernel[:, :, 0]) if kernel.shape[2] == 1 else None
+
+        if operation not in ["median", "quantile"] or spans is None:
+            raise ValueError(
+                "The histogram engine only supports medians and quantiles with flat 2D kernels."
+            )
+
+        if arr.dtype not in [np.uint8, np.uint16]:
+            raise ValueError("The histogram engine only supports uint8 and uint16.")
+
+        return histogram_quantile(
+            arr[:, :, 0],
+            spans,
+            0.5 if operation == "median" else quantile,
+            256 if arr.dtype == np.uint8 else 65536,
+            valid[:, :, 0] if masked else np.ones((1, 1), dtype="bool"),
+            masked,
+        )
+
+    if engine != "loop":
+        if operation != "sum" or kernel.shape[2] != 1:
+            raise ValueError(f"The {engine} engine only supports 2D sum operations.")
+
+        if engine == "separable" and not kernel_is_separable(kernel[:, :, 0]):
+            raise ValueError("The kernel is not separable.")
+
+        # Like convolve_3d, a 2D kernel reads the first channel.
+        return weighted_sum(
+            arr[:, :, 0],
+            kernel[:, :, 0],
+            engine=engine,
+            valid=valid[:, :, 0] if masked else None,
+        )
+
+    if masked:
+        # A 2D kernel reads the first channel, a 3D kernel the channels around
+        # it. The borders are handled in convolve_3d.
+        if kernel.shape[2] == 1:
+            valid_2d = valid[:, :, 0]
+        else:
+            valid_2d = valid.all(axis=2)
+
+        full = valid_counts(valid_2d, kernel.shape) == kernel.shape[0] * kernel.shape[1]
+    else:
+        valid = np.ones((1, 1, 1), dtype="bool")
+        full = np.ones((1, 1), dtype="bool")
+
     return convolve_3d(
         arr,
         offsets,
         weights,
+        valid,
+        full,
+        masked,
         operation=operation,
-        nodata=nodata,
-        nodata_value=nodata_value,
         quantile=quantile,
     )
 
@@ -1,9 +1,41 @@
 import numpy as np
+import os
 import sys
 
 sys.path.append("../../")
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Union, Optional, List
+from uuid import uuid4
+from numba import set_num_threads
+from osgeo import gdal
 from buteo.filters.convolutions import filter_array
 from buteo.filters.kernel_generator import create_kernel
+from buteo.raster.io import (
+    internal_raster_to_metadata,
+    internal_block_windows,
+    internal_read_bands,
+    internal_shareable_source,
+    invalidate_raster_metadata,
+)
+from buteo.gdal_utils import (
+    default_options,
+    gdal_nodata_value_from_type,
+    gdal_to_numpy_datatype,
+    path_to_driver,
+    numpy_to_gdal_datatype,
+)
+from buteo.utils import (
+    overwrite_required,
+    remove_if_overwrite,
+    prefetch,
+    progress,
+    threaded_map,
+    type_check,
+)
+
+# The raster read by a filter worker process, opened once by its initializer.
+_worker_dataset = None
 
 
 # filters = [
@@ -32,6 +64,269 @@ def conv_filter(in_raster, kernel=None, filter="sum", iterations=1):
     return filter_array(in_raster, _kernel, filter, iterations)
 
 
+def internal_read_window(dataset, window):
+    """OBS: INTERNAL: Single output.
+
+    Reads a window of a dataset directly from its bands as a masked array,
+    masked by the GDAL mask band of each band. The mask bands cover nodata
+    values, alpha bands and mask files.
+    """
+    bands = [dataset.GetRasterBand(band + 1) for band in range(dataset.RasterCount)]
+
+    dtype = np.result_type(*[gdal_to_numpy_datatype(band.DataType) for band in bands])
+    array = np.empty((window[3], window[2], len(bands)), dtype=dtype)
+    internal_read_bands(bands, window, array)
+
+    mask = np.empty(array.shape, dtype=bool)
+    for index, band in enumerate(bands):
+        mask[:, :, index] = band.GetMaskBand().ReadAsArray(*window) == 0
+
+    return np.ma.array(array, mask=mask, copy=False)
+
+
+def internal_filter_tile(array, window, core, shape, filter_kwargs):
+    """OBS: INTERNAL: Single output.
+
+    Filters each band of a window read from a raster and returns the core of
+    the window, masked where the input is.
+    """
+    x_local = core[0] - window[0]
+    y_local = core[1] - window[1]
+
+    filtered = np.empty((core[3], core[2], array.shape[2]), dtype="float32")
+    mask = np.zeros(filtered.shape, dtype=bool)
+
+    for band in range(array.shape[2]):
+        band_filtered = filter_array(
+            array[:, :, band : band + 1], list(shape), **filter_kwargs
+        )
+
+        core_slice = (
+            slice(y_local, y_local + core[3]),
+            slice(x_local, x_local + core[2]),
+        )
+
+        filtered[:, :, band] = band_filtered.data[core_slice]
+        mask[:, :, band] = np.ma.getmaskarray(band_filtered)[core_slice]
+
+    return np.ma.array(filtered, mask=mask, copy=False)
+
+
+def internal_init_filter_worker(raster, threads):
+    """OBS: INTERNAL: Single output.
+
+    Opens the raster once for a worker process, and limits the threads of the
+    Numba kernels, so the workers share the cores instead of each using all of
+    them. The dataset is closed when the process exits with the pool.
+    """
+    global _worker_dataset
+
+    set_num_threads(threads)
+
+    _worker_dataset = gdal.Open(raster, gdal.GA_ReadOnly)
+
+    if _worker_dataset is None:
+        raise ValueError(f"Unable to open raster: {raster}")
+
+
+def internal_filter_window(window, core, shape, filter_kwargs):
+    """OBS: INTERNAL: Single output.
+
+    Reads and filters a window of the raster of a worker process. Module level,
+    so it can run in a process pool.
+    """
+    array = internal_read_window(_worker_dataset, window)
+
+    return internal_filter_tile(array, window, core, shape, filter_kwargs)
+
+
+def filter_raster(
+    raster: Union[str, gdal.Dataset],
+    shape: List[int],
+    out_path: Optional[str] = None,
+    tile_size: int = 1024,
+    workers: int = 1,
+    dtype: str = "float32",
+    overwrite: bool = True,
+    creation_options: list = [],
+    verbose: int = 1,
+    **filter_kwargs,
+) -> str:
+    """Filters a raster tile by tile and writes the result to a new raster, so
+        rasters larger than memory can be filtered. Each tile is read with a
+        halo of the kernel radius, so the results match filtering the whole
+        raster with filter_array. Every band is filtered on its own.
+    Args:
+        raster (path | Dataset): The raster to filter.
+
+        shape (list): The shape of the kernel, eg. [5, 5] or [5, 5, 1].
+
+    **kwargs:
+        out_path (path | None): The destination of the filtered raster. If None,
+        the raster is written to /vsimem/.
+
+        tile_size (int): The size of the tiles read, before the halo is added.
+
+        workers (int): The amount of processes filtering tiles. If 1, the tiles
+        are filtered in this process while the next tile is read in the
+        background. Rasters in memory are always filtered in this process.
+        Each process compiles the kernels and uses its share of the cores.
+
+        dtype (str): The datatype of the output raster.
+
+        overwrite (bool): Overwrite the output if it exists.
+
+        creation_options (list): GDAL creation options for the output.
+
+        verbose (int): If 1 will output messages on progress.
+
+        filter_kwargs: Passed to filter_array, eg. operation="sigma_lee". The
+        pixels masked by the GDAL mask bands of the raster are excluded, and
+        written as the default nodata value of dtype, eg. -9999.0 for floats.
+
+    Returns:
+        The path to the filtered raster.
+    """
+    type_check(raster, [str, gdal.Dataset], "raster")
+    type_check(shape, [list, tuple], "shape")
+    type_check(out_path, [str], "out_path", allow_none=True)
+    type_check(tile_size, [int], "tile_size")
+    type_check(workers, [int], "workers")
+    type_check(dtype, [str], "dtype")
+    type_check(overwrite, [bool], "overwrite")
+    type_check(creation_options, [list], "creation_options")
+    type_check(verbose, [int], "verbose")
+
+    if len(shape) == 2:
+        shape = [shape[0], shape[1], 1]
+
+    if len(shape) != 3 or shape[2] != 1:
+        raise ValueError(f"filter_raster only supports 2D kernels. Recieved: {shape}")
+
+    if tile_size < 1 or workers < 1:
+        raise ValueError("tile_size and workers must be 1 or above.")
+
+    metadata = internal_raster_to_metadata(raster)
+
+    # The nodata value of the input could be a real filtered value, like 0 for
+    # the deviation of a flat area, so the default of the output type is used.
+    out_datatype = numpy_to_gdal_datatype(np.dtype(dtype))
+    out_nodata = gdal_nodata_value_from_type(out_datatype)
+
+    # Parse the driver
+    driver_name = "GTiff" if out_path is None else path_to_driver(out_path)
+    driver = gdal.GetDriverByName(driver_name)
+    if driver is None:
+        raise ValueError(f"Unable to parse filetype from path: {out_path}")
+
+    if out_path is None:
+        output_name = f"/vsimem/filtered_{uuid4().int}.tif"
+    else:
+        output_name = out_path
+
+    overwrite_required(out_path, overwrite)
+    remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(output_name)
+
+    destination = driver.Create(
+        output_name,
+        metadata["width"],
+        metadata["height"],
+        metadata["band_count"],
+        out_datatype,
+        default_options(creation_options),
+    )
+
+    destination.SetProjection(metadata["projection"])
+    destination.SetGeoTransform(metadata["transform"])
+
+    dst_bands = [
+        destination.GetRasterBand(band + 1) for band in range(metadata["band_count"])
+    ]
+
+    for dst_band in dst_bands:
+        dst_band.SetNoDataValue(out_nodata)
+
+    # The halo gives the tile edges their real neighbours. At the raster edges
+    # the windows are clipped, like the edges of a whole array.
+    halo = max(shape[0], shape[1]) // 2
+    windows = internal_block_windows(
+        metadata["width"], metadata["height"], tile_size, tile_size, halo
+    )
+
+    # Rasters in memory are filtered in this process.
+    read_raster, in_memory = internal_shareable_source(raster)
+    if in_memory:
+        workers = 1
+
+    executor = None
+    if workers > 1:
+        # Spawned, as forking a process running Numba or GDAL threads can hang.
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=internal_init_filter_worker,
+            initargs=(read_raster, max(1, (os.cpu_count() or 1) // workers)),
+        )
+
+        def filter_window(window_and_core):
+            window, core = window_and_core
+
+            return executor.submit(
+                internal_filter_window, window, core, shape, filter_kwargs
+            ).result()
+
+        # The threads only wait on the processes.
+        filtered_windows = threaded_map(filter_window, windows, workers=workers)
+    else:
+        # Opened once. Only the prefetching thread reads from it.
+        if isinstance(read_raster, gdal.Dataset):
+            dataset = read_raster
+        else:
+            dataset = gdal.Open(read_raster, gdal.GA_ReadOnly)
+
+            if dataset is None:
+                raise ValueError(f"Unable to open raster: {read_raster}")
+
+        def read_window(window_and_core):
+            window, core = window_and_core
+
+            return internal_read_window(dataset, window), window, core
+
+        # The Numba kernels use all the cores, so only the reads are threaded.
+        filtered_windows = (
+            internal_filter_tile(array, window, core, shape, filter_kwargs)
+            for array, window, core in prefetch(map(read_window, windows))
+        )
+
+    try:
+        # The tiles are written as they finish, in order, so only the tiles in
+        # flight are held in memory.
+        for index, filtered in enumerate(filtered_windows):
+            if verbose == 1:
+                progress(index, len(windows), "Filtering raster")
+
+            core = windows[index][1]
+
+            for band, dst_band in enumerate(dst_bands):
+                dst_band.WriteArray(
+                    filtered[:, :, band].filled(out_nodata).astype(dtype),
+                    core[0],
+                    core[1],
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if verbose == 1:
+        progress(len(windows), len(windows), "Filtering raster")
+
+    destination.FlushCache()
+    destination = None
+
+    return output_name
+
+
 def sigma_to_db(arr):
     return 10 * np.log10(np.abs(arr))
 
@@ -1,6 +1,6 @@
 import osgeo
 from osgeo import gdal, ogr, osr
-from typing import Sequence, Union, Any, Tuple, List
+from typing import Sequence, Union, Any, Tuple, List, Dict, Optional
 from uuid import uuid4
 import numpy as np
 import os
@@ -568,144 +568,547 @@ def align_bbox(extent_og, extent_ta, pixel_width, pixel_height, warp_format=True
     return (x_min, y_max, x_max, y_min)
 
 
-def advanced_extents(
-    extent_ogr: List[Number], projection: osr.SpatialReference
-) -> Expanded_extents:
-    original_projection = projection
-    target_projection = osr.SpatialReference()
-    target_projection.ImportFromEPSG(4326)
-
-    if int(osgeo.__version__[0]) >= 3:
-        original_projection.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-        target_projection.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-
-    x_min, x_max, y_min, y_max = extent_ogr
-
-    bottom_left = [x_min, y_min]
-    top_left = [x_min, y_max]
-    top_right = [x_max, y_max]
-    bottom_right = [x_max, y_min]
-
-    coord_array = [
-        [bottom_left[1], bottom_left[0]],
-        [top_left[1], top_left[0]],
-        [top_right[1], top_right[0]],
-        [bottom_right[1], bottom_right[0]],
-        [bottom_left[1], bottom_left[0]],
-    ]
+def copy_mutable(value: Any) -> Any:
+    """ Copies lists, dictionaries and spatial references, so memoized metadata
+        can be handed out without callers changing it for everyone. Spatial
+        references are cloned, as setting their axis mapping changes them.
+    """
+    if isinstance(value, osr.SpatialReference):
+        return value.Clone()
+
+    if isinstance(value, list):
+        return [copy_mutable(item) for item in value]
+
+    if isinstance(value, dict):
+        return {key: copy_mutable(item) for key, item in value.items()}
+
+    return value
+
+
+EXPANDED_EXTENT_KEYS = (
+    "extent_wkt",
+    "extent_datasource",
+    "extent_geom",
+    "extent_latlng",
+    "extent_gdal_warp_latlng",
+    "extent_ogr_latlng",
+    "extent_dict_latlng",
+    "extent_wkt_latlng",
+    "extent_datasource_latlng",
+    "extent_geom_latlng",
+    "extent_geojson",
+    "extent_geojson_dict",
+)
+
 
+def extent_to_wkt(coord_array: List[List[Number]]) -> str:
+    """ Converts a ring of [y, x] coordinates to a WKT polygon. """
     wkt_coords = ""
     for coord in coord_array:
         wkt_coords += f"{coord[1]} {coord[0]}, "
     wkt_coords = wkt_coords[:-2]  # Remove the last ", "
 
-    extent_wkt = f"POLYGON (({wkt_coords}))"
+    return f"POLYGON (({wkt_coords}))"
 
-    extent_name = f"/vsimem/{uuid4().int}_extent.shp"
+
+def extent_to_datasource(
+    extent_wkt: str, projection: osr.SpatialReference, name: str = "extent"
+) -> ogr.DataSource:
+    """ Creates an in memory shapefile containing a single polygon. """
+    extent_name = f"/vsimem/{uuid4().int}_{name}.shp"
 
     driver = ogr.GetDriverByName("ESRI Shapefile")
     extent_ds = driver.CreateDataSource(extent_name)
-    layer = extent_ds.CreateLayer(
-        extent_name + "_layer", original_projection, ogr.wkbPolygon
-    )
+    layer = extent_ds.CreateLayer(extent_name + "_layer", projection, ogr.wkbPolygon)
 
     feature = ogr.Feature(layer.GetLayerDefn())
-    extent_geom = ogr.CreateGeometryFromWkt(extent_wkt, original_projection)
-    feature.SetGeometry(extent_geom)
+    feature.SetGeometry(ogr.CreateGeometryFromWkt(extent_wkt, projection))
     layer.CreateFeature(feature)
     feature = None
 
-    if not original_projection.IsSame(target_projection):
-        tx = osr.CoordinateTransformation(original_projection, target_projection)
+    layer.SyncToDisk()
 
-        bottom_left = tx.TransformPoint(x_min, y_min)
-        top_left = tx.TransformPoint(x_min, y_max)
-        top_right = tx.TransformPoint(x_max, y_max)
-        bottom_right = tx.TransformPoint(x_max, y_min)
+    return extent_ds
 
-    extent_latlng = [
-        top_left[0],
-        top_left[1],
-        bottom_right[0],
-        bottom_right[1],
-    ]
 
-    extent_gdal_warp_latlng = [
-        top_left[0],
-        bottom_right[1],
-        bottom_right[0],
-        top_left[1],
-    ]
+class LazyExtents:
+    """ The expanded extents of a raster or vector (WKT, GeoJSON, latlng and
+        OGR datasources). Each field is computed on first access and memoized,
+        so only the fields that are used are paid for.
 
-    extent_ogr_latlng = [
-        top_left[0],
-        bottom_right[0],
-        bottom_right[1],
-        top_left[1],
-    ]
+    Args:
+        extent_ogr (list): The extent in the OGR format (x_min, x_max, y_min, y_max)
 
-    extent_dict_latlng = {
-        "left": top_left[0],
-        "top": top_left[1],
-        "right": bottom_right[0],
-        "bottom": bottom_right[1],
-    }
+        projection (osr.SpatialReference): The projection of the extent.
+    """
 
-    # WKT has latitude first, geojson has longitude first
-    coord_array = [
-        [bottom_left[1], bottom_left[0]],
-        [top_left[1], top_left[0]],
-        [top_right[1], top_right[0]],
-        [bottom_right[1], bottom_right[0]],
-        [bottom_left[1], bottom_left[0]],
-    ]
+    def __init__(self, extent_ogr: List[Number], projection: osr.SpatialReference):
+        self.extent_ogr = list(extent_ogr)
+        self.projection = projection
+        self.values = {}
 
-    wkt_coords = ""
-    for coord in coord_array:
-        wkt_coords += f"{coord[1]} {coord[0]}, "
-    wkt_coords = wkt_coords[:-2]  # Remove the last ", "
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.values:
+            if key not in EXPANDED_EXTENT_KEYS:
+                raise KeyError(key)
 
-    extent_wkt_latlng = f"POLYGON (({wkt_coords}))"
+            self.values[key] = getattr(self, "create_" + key)()
 
-    # Create an OGR Datasource in memory with the extent
-    extent_name = f"/vsimem/{uuid4().int}_extent_latlng.shp"
+        return copy_mutable(self.values[key])
 
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    extent_ds_latlng = driver.CreateDataSource(extent_name)
-    layer = extent_ds_latlng.CreateLayer(
-        extent_name + "_layer", target_projection, ogr.wkbPolygon
+    def __contains__(self, key: str) -> bool:
+        return key in EXPANDED_EXTENT_KEYS
+
+    def keys(self):
+        return EXPANDED_EXTENT_KEYS
+
+    def to_dict(self) -> Expanded_extents:
+        """ Computes all the fields and returns them as a dictionary. """
+        return {key: self[key] for key in EXPANDED_EXTENT_KEYS}  # type: ignore
+
+    def projections(self) -> Tuple[osr.SpatialReference, osr.SpatialReference]:
+        if "projections" not in self.values:
+            # Cloned, so the axis mapping of the shared projection is not changed.
+            original_projection = self.projection.Clone()
+            target_projection = osr.SpatialReference()
+            target_projection.ImportFromEPSG(4326)
+
+            if int(osgeo.__version__[0]) >= 3:
+                original_projection.SetAxisMappingStrategy(
+                    osr.OAMS_TRADITIONAL_GIS_ORDER
+                )
+                target_projection.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+            self.values["projections"] = (original_projection, target_projection)
+
+        return self.values["projections"]
+
+    def corners(self) -> List[List[Number]]:
+        """ bottom_left, top_left, top_right, bottom_right in the original projection. """
+        x_min, x_max, y_min, y_max = self.extent_ogr
+
+        return [[x_min, y_min], [x_min, y_max], [x_max, y_max], [x_max, y_min]]
+
+    def corners_latlng(self) -> List[List[Number]]:
+        """ bottom_left, top_left, top_right, bottom_right in latlng. """
+        if "corners_latlng" not in self.values:
+            original_projection, target_projection = self.projections()
+            corners = self.corners()
+
+            if not original_projection.IsSame(target_projection):
+                tx = osr.CoordinateTransformation(original_projection, target_projection)
+                corners = [tx.TransformPoint(x, y) for x, y in corners]
+
+            self.values["corners_latlng"] = corners
+
+        return self.values["corners_latlng"]
+
+    def coord_array_latlng(self) -> List[List[Number]]:
+        bottom_left, top_left, top_right, bottom_right = self.corners_latlng()
+
+        return [
+            [bottom_left[1], bottom_left[0]],
+            [top_left[1], top_left[0]],
+            [top_right[1], top_right[0]],
+            [bottom_right[1], bottom_right[0]],
+            [bottom_left[1], bottom_left[0]],
+        ]
+
+    def create_extent_wkt(self) -> str:
+        bottom_left, top_left, top_right, bottom_right = self.corners()
+
+        return extent_to_wkt(
+            [
+                [bottom_left[1], bottom_left[0]],
+                [top_left[1], top_left[0]],
+                [top_right[1], top_right[0]],
+                [bottom_right[1], bottom_right[0]],
+                [bottom_left[1], bottom_left[0]],
+            ]
+        )
+
+    def create_extent_geom(self) -> ogr.Geometry:
+        original_projection, _target_projection = self.projections()
+
+        return ogr.CreateGeometryFromWkt(self["extent_wkt"], original_projection)
+
+    def create_extent_datasource(self) -> ogr.DataSource:
+        original_projection, _target_projection = self.projections()
+
+        return extent_to_datasource(self["extent_wkt"], original_projection, "extent")
+
+    def create_extent_latlng(self) -> List[Number]:
+        _bottom_left, top_left, _top_right, bottom_right = self.corners_latlng()
+
+        return [top_left[0], top_left[1], bottom_right[0], bottom_right[1]]
+
+    def create_extent_gdal_warp_latlng(self) -> List[Number]:
+        _bottom_left, top_left, _top_right, bottom_right = self.corners_latlng()
+
+        return [top_left[0], bottom_right[1], bottom_right[0], top_left[1]]
+
+    def create_extent_ogr_latlng(self) -> List[Number]:
+        _bottom_left, top_left, _top_right, bottom_right = self.corners_latlng()
+
+        return [top_left[0], bottom_right[0], bottom_right[1], top_left[1]]
+
+    def create_extent_dict_latlng(self) -> Dict[str, Number]:
+        _bottom_left, top_left, _top_right, bottom_right = self.corners_latlng()
+
+        return {
+            "left": top_left[0],
+            "top": top_left[1],
+            "right": bottom_right[0],
+            "bottom": bottom_right[1],
+        }
+
+    def create_extent_wkt_latlng(self) -> str:
+        # WKT has latitude first, geojson has longitude first
+        return extent_to_wkt(self.coord_array_latlng())
+
+    def create_extent_geom_latlng(self) -> ogr.Geometry:
+        _original_projection, target_projection = self.projections()
+
+        return ogr.CreateGeometryFromWkt(self["extent_wkt_latlng"], target_projection)
+
+    def create_extent_datasource_latlng(self) -> ogr.DataSource:
+        _original_projection, target_projection = self.projections()
+
+        return extent_to_datasource(
+            self["extent_wkt_latlng"], target_projection, "extent_latlng"
+        )
+
+    def create_extent_geojson_dict(self) -> Dict[str, Any]:
+        # We don't define a geojson in the original projection as geojson is usually expected to be latlng.
+        return {
+            "type": "Feature",
+            "properties": {},
+            "geometry": {"type": "Polygon", "coordinates": [self.coord_array_latlng()],},
+        }
+
+    def create_extent_geojson(self) -> str:
+        return json.dumps(self["extent_geojson_dict"])
+
+
+class Metadata:
+    """ Base class for the immutable metadata objects. The values are stored in
+        __slots__ and the redundant extent layouts are derived on access, while
+        dictionary style access (metadata["extent"]) is kept for compatibility.
+        The expanded extent fields (see LazyExtents) are computed on first
+        access, or are None if the metadata was created without geometry.
+    """
+
+    __slots__ = ("_extents",)
+
+    _fields: Tuple[str, ...] = ()
+    _derived: Tuple[str, ...] = ()
+
+    def __init__(self, extents: Optional[LazyExtents] = None, **values: Any):
+        missing = set(self._fields).difference(values)
+        if len(missing) > 0:
+            raise ValueError(f"Missing metadata fields: {sorted(missing)}")
+
+        unknown = set(values).difference(self._fields)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown metadata fields: {sorted(unknown)}")
+
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+        object.__setattr__(self, "_extents", extents)
+
+    def __setattr__(self, key: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable, use replace.")
+
+    def __delattr__(self, key: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable, use replace.")
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        raise TypeError(f"{type(self).__name__} is immutable, use replace.")
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._fields:
+            return copy_mutable(getattr(self, key))
+
+        if key in self._derived:
+            return getattr(self, key)
+
+        if key in EXPANDED_EXTENT_KEYS:
+            if self._extents is None:
+                return None
+
+            return self._extents[key]
+
+        raise KeyError(key)
+
+    def __getattr__(self, key: str) -> Any:
+        # Only called when normal attribute lookup fails: the expanded extents.
+        if key in EXPANDED_EXTENT_KEYS:
+            return self[key]
+
+        raise AttributeError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Metadata):
+            return type(self) is type(other) and all(
+                getattr(self, key) == getattr(other, key) for key in self._fields
+            )
+
+        return NotImplemented
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self) -> str:
+        path = getattr(self, "path", getattr(self, "layer_name", ""))
+        return f"{type(self).__name__}({path})"
+
+    def __reduce__(self):
+        return (
+            _metadata_from_values,
+            (type(self), {key: getattr(self, key) for key in self._fields}),
+        )
+
+    def keys(self) -> Tuple[str, ...]:
+        return self._fields + self._derived + EXPANDED_EXTENT_KEYS
+
+    def values(self) -> List[Any]:
+        return [self[key] for key in self.keys()]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self, create_geometry: bool = True) -> "Metadata":
+        """ Returns self or a view without the expanded extents. The expanded
+            extents are shared, so they are only computed once.
+        """
+        if create_geometry or self._extents is None:
+            return self
+
+        return self.replace(extents=None)
+
+    def replace(self, extents: Any = "keep", **changes: Any) -> "Metadata":
+        """ Returns a copy with some fields replaced. The expanded extents are
+            kept, unless they are given or the extent changes.
+        """
+        values = {key: getattr(self, key) for key in self._fields}
+
+        for key in changes:
+            if key not in self._fields:
+                raise ValueError(f"Unable to replace: {key}")
+
+        values.update(changes)
+
+        if extents == "keep":
+            extents = self._extents
+
+            if extents is not None and (
+                len({"x_min", "x_max", "y_min", "y_max"}.intersection(changes)) > 0
+            ):
+                extents = LazyExtents(
+                    [values["x_min"], values["x_max"], values["y_min"], values["y_max"]],
+                    values["projection_osr"],
+                )
+
+        return type(self)(extents=extents, **values)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Returns a plain dictionary with all the fields. """
+        return dict(self.items())
+
+    @property
+    def extent(self) -> List[Number]:
+        return [self.x_min, self.y_max, self.x_max, self.y_min]  # type: ignore
+
+    @property
+    def extent_ogr(self) -> List[Number]:
+        return [self.x_min, self.x_max, self.y_min, self.y_max]  # type: ignore
+
+    @property
+    def extent_gdal_warp(self) -> List[Number]:
+        return [self.x_min, self.y_min, self.x_max, self.y_max]  # type: ignore
+
+    @property
+    def extent_dict(self) -> Dict[str, Number]:
+        return {
+            "left": self.x_min,  # type: ignore
+            "top": self.y_max,  # type: ignore
+            "right": self.x_max,  # type: ignore
+            "bottom": self.y_min,  # type: ignore
+        }
+
+
+def _metadata_from_values(cls: type, values: Dict[str, Any]) -> Metadata:
+    # Used for pickling, the expanded extents are not carried over.
+    return cls(**values)
+
+
+class PathMetadata(Metadata):
+    """ Metadata of a file, the basename, name and extension are derived from the path. """
+
+    __slots__ = ()
+
+    @property
+    def basename(self) -> str:
+        return os.path.basename(self.path)  # type: ignore
+
+    @property
+    def name(self) -> str:
+        return os.path.splitext(self.basename)[0]
+
+    @property
+    def ext(self) -> str:
+        return os.path.splitext(self.basename)[1]
+
+
+class RasterMetadata(PathMetadata):
+    """ Immutable metadata of a raster. See Metadata_raster for the keys. """
+
+    _fields = (
+        "path",
+        "transform",
+        "in_memory",
+        "projection",
+        "projection_osr",
+        "width",
+        "height",
+        "band_count",
+        "driver",
+        "pixel_width",
+        "pixel_height",
+        "x_min",
+        "y_max",
+        "x_max",
+        "y_min",
+        "datatype",
+        "datatype_gdal_raw",
+        "nodata_value",
+    )
+    _derived = (
+        "basename",
+        "name",
+        "ext",
+        "size",
+        "shape",
+        "datatype_gdal",
+        "has_nodata",
+        "is_raster",
+        "is_vector",
+        "extent",
+        "extent_ogr",
+        "extent_gdal_warp",
+        "extent_dict",
     )
 
-    feature = ogr.Feature(layer.GetLayerDefn())
-    extent_geom_latlng = ogr.CreateGeometryFromWkt(extent_wkt_latlng, target_projection)
-    feature.SetGeometry(extent_geom_latlng)
-    layer.CreateFeature(feature)
-    feature = None
+    __slots__ = _fields
+
+    is_raster = True
+    is_vector = False
+
+    @property
+    def size(self) -> List[int]:
+        return [self.width, self.height]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return (self.width, self.height, self.band_count)
+
+    @property
+    def datatype_gdal(self) -> str:
+        return gdal.GetDataTypeName(self.datatype_gdal_raw)
+
+    @property
+    def has_nodata(self) -> bool:
+        return self.nodata_value is not None
+
+
+class VectorLayerMetadata(Metadata):
+    """ Immutable metadata of a vector layer. See Metadata_vector_layer for the keys. """
+
+    _fields = (
+        "layer_name",
+        "x_min",
+        "x_max",
+        "y_min",
+        "y_max",
+        "column_fid",
+        "column_geom",
+        "feature_count",
+        "projection",
+        "projection_osr",
+        "geom_type",
+        "geom_type_ogr",
+        "field_names",
+        "field_types",
+        "field_types_ogr",
+    )
+    _derived = (
+        "field_count",
+        "extent",
+        "extent_ogr",
+        "extent_gdal_warp",
+        "extent_dict",
+    )
 
-    # We don't define a geojson in the original projection as geojson is usually expected to be latlng.
-    extent_geojson_dict = {
-        "type": "Feature",
-        "properties": {},
-        "geometry": {"type": "Polygon", "coordinates": [coord_array],},
-    }
-    extent_geojson = json.dumps(extent_geojson_dict)
-
-    expanded_extents: Expanded_extents = {
-        "extent_wkt": extent_wkt,
-        "extent_datasource": extent_ds,
-        "extent_geom": extent_geom,
-        "extent_latlng": extent_latlng,
-        "extent_gdal_warp_latlng": extent_gdal_warp_latlng,
-        "extent_ogr_latlng": extent_ogr_latlng,
-        "extent_dict_latlng": extent_dict_latlng,
-        "extent_wkt_latlng": extent_wkt_latlng,
-        "extent_datasource_latlng": extent_ds_latlng,
-        "extent_geom_latlng": extent_geom_latlng,
-        "extent_geojson": extent_geojson,
-        "extent_geojson_dict": extent_geojson_dict,
-    }
+    __slots__ = _fields
+
+    @property
+    def field_count(self) -> int:
+        return len(self.field_names)
+
+
+class VectorMetadata(PathMetadata):
+    """ Immutable metadata of a vector. See Metadata_vector for the keys. """
+
+    _fields = (
+        "path",
+        "in_memory",
+        "projection",
+        "projection_osr",
+        "driver",
+        "x_min",
+        "y_max",
+        "x_max",
+        "y_min",
+        "layer_count",
+        "layers",
+    )
+    _derived = (
+        "basename",
+        "name",
+        "ext",
+        "is_vector",
+        "is_raster",
+        "extent",
+        "extent_ogr",
+        "extent_gdal_warp",
+        "extent_dict",
+    )
+
+    __slots__ = _fields
+
+    is_raster = False
+    is_vector = True
 
-    return expanded_extents
+
+def advanced_extents(
+    extent_ogr: List[Number], projection: osr.SpatialReference
+) -> Expanded_extents:
+    return LazyExtents(extent_ogr, projection).to_dict()
 
 
 # x_min, x_max, y_min, y_max
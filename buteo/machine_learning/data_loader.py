@@ -0,0 +1,226 @@
+import sys
+
+sys.path.append("../../")
+import numpy as np
+import os
+
+from typing import Union, Optional, List
+from buteo.utils import type_check, threaded_map
+from buteo.machine_learning.ml_utils import add_rotations, add_noise
+
+
+def internal_open_region(paths: List[str]) -> List[np.ndarray]:
+    """OBS: INTERNAL: Single output.
+
+    Memory maps the patch files of a region and checks that they hold the same
+    amount of patches.
+    """
+    arrays = []
+    for path in paths:
+        if not os.path.exists(path):
+            raise ValueError(f"Numpy array does not exist: {path}")
+
+        arrays.append(np.load(path, mmap_mode="r"))
+
+    for array in arrays:
+        if array.shape[0] != arrays[0].shape[0]:
+            raise ValueError(f"The amount of patches in the region differ: {paths}")
+
+    return arrays
+
+
+def internal_augment_batch(
+    batch: List[np.ndarray],
+    label_index: Optional[int],
+    rotations: int,
+    noise: float,
+    rng: np.random.Generator,
+) -> List[np.ndarray]:
+    """OBS: INTERNAL: Single output.
+
+    Adds rotations to all the arrays of a batch, so they stay aligned, and noise
+    drawn from rng to the arrays that are not the labels.
+    """
+    label_position = None
+    if label_index is not None:
+        label_position = label_index % len(batch)
+
+    augmented = []
+    for index, array in enumerate(batch):
+        if rotations > 1:
+            array = add_rotations(array, k=rotations)
+
+        if noise > 0.0 and index != label_position:
+            array = add_noise(array, amount=noise, rng=rng).astype(array.dtype, copy=False)
+
+        augmented.append(array)
+
+    return augmented
+
+
+def load_patch_batches(
+    regions: Union[List[str], List[List[str]]],
+    batch_size: int = 32,
+    label_index: Optional[int] = -1,
+    shuffle: bool = True,
+    shuffle_buffer: int = 4096,
+    chunk_size: int = 512,
+    prefetch_chunks: int = 4,
+    workers: int = 2,
+    rotations: int = 1,
+    noise: float = 0.0,
+    epochs: int = 1,
+    seed: Optional[int] = None,
+):
+    """Loads shuffled batches from patch files, such as the outputs of
+        extract_patches. The files are memory mapped and read in chunks, which
+        are shuffled across all the regions and read ahead by background
+        threads. The patches pass through a bounded shuffle buffer, so the
+        batches mix regions without loading any region whole.
+    Args:
+        regions (list): A list of regions, each a list of .npy paths with the
+        same amount of patches, eg. [[rgbn_1, swir_1, labels_1], [rgbn_2, ...]].
+        A list of paths is a single region.
+
+    **kwargs:
+        batch_size (int): The amount of patches in each batch, before rotations.
+
+        label_index (int | None): The index of the labels in each region. The
+        batches are yielded as (inputs, labels) and no noise is added to the
+        labels. If None, a list of all the arrays is yielded. Otherwise each
+        region must have at least two files.
+
+        shuffle (bool): Shuffle the chunks and the patches.
+
+        shuffle_buffer (int): The amount of patches shuffled together. Every
+        patch is mixed with at least half as many others.
+
+        chunk_size (int): The amount of patches read from a file at a time.
+
+        prefetch_chunks (int): The amount of chunks read ahead.
+
+        workers (int): The amount of threads reading chunks.
+
+        rotations (int): Add rotations (ml_utils.add_rotations) to each batch,
+        multiplying its size. 1 adds none.
+
+        noise (float): Add multiplicative noise (ml_utils.add_noise) to the
+        inputs of each batch. 0.0 adds none.
+
+        epochs (int): The amount of passes over the patches, each shuffled anew.
+
+        seed (int | None): A seed for the shuffle and the noise.
+
+    Returns:
+        A generator yielding batches.
+    """
+    type_check(regions, [list], "regions")
+    type_check(batch_size, [int], "batch_size")
+    type_check(label_index, [int], "label_index", allow_none=True)
+    type_check(shuffle, [bool], "shuffle")
+    type_check(shuffle_buffer, [int], "shuffle_buffer")
+    type_check(chunk_size, [int], "chunk_size")
+    type_check(prefetch_chunks, [int], "prefetch_chunks")
+    type_check(workers, [int], "workers")
+    type_check(rotations, [int], "rotations")
+    type_check(noise, [float], "noise")
+    type_check(epochs, [int], "epochs")
+    type_check(seed, [int], "seed", allow_none=True)
+
+    if len(regions) == 0:
+        raise ValueError("No regions to load.")
+
+    if batch_size < 1 or chunk_size < 1:
+        raise ValueError("batch_size and chunk_size must be 1 or above.")
+
+    if rotations < 1 or rotations > 4:
+        raise ValueError(f"rotations must be between 1 and 4. Recieved: {rotations}")
+
+    in_regions = [regions] if isinstance(regions[0], str) else regions
+    opened = [internal_open_region(paths) for paths in in_regions]
+
+    for arrays in opened:
+        if len(arrays) != len(opened[0]):
+            raise ValueError("All regions must have the same amount of files.")
+
+    if label_index is not None and len(opened[0]) < 2:
+        raise ValueError(
+            "Each region must have inputs and labels, unless label_index is None."
+        )
+
+    rng = np.random.default_rng(seed)
+
+    chunks = [
+        (region, start)
+        for region, arrays in enumerate(opened)
+        for start in range(0, arrays[0].shape[0], chunk_size)
+    ]
+
+    def read_chunk(chunk):
+        region, start = chunk
+
+        # Copies the chunk out of the memory maps, so the reads happen here.
+        return [
+            np.array(array[start : start + chunk_size]) for array in opened[region]
+        ]
+
+    def finish(batch):
+        batch = internal_augment_batch(batch, label_index, rotations, noise, rng)
+
+        if label_index is None:
+            return batch
+
+        label_position = label_index % len(batch)
+        inputs = [
+            array for index, array in enumerate(batch) if index != label_position
+        ]
+
+        return (inputs[0] if len(inputs) == 1 else inputs, batch[label_position])
+
+    for _epoch in range(epochs):
+        order = rng.permutation(len(chunks)) if shuffle else np.arange(len(chunks))
+
+        buffer: List[List[np.ndarray]] = [[] for _ in opened[0]]
+        buffered = 0
+
+        read_chunks = threaded_map(
+            read_chunk,
+            [chunks[index] for index in order],
+            workers=max(workers, 1),
+            depth=max(prefetch_chunks, 1),
+        )
+
+        for chunk_arrays in read_chunks:
+            for index, array in enumerate(chunk_arrays):
+                buffer[index].append(array)
+
+            buffered += chunk_arrays[0].shape[0]
+
+            if buffered < max(shuffle_buffer, batch_size):
+                continue
+
+            # Shuffle the buffer, and keep half of it to mix with the next chunks.
+            merged = [np.concatenate(arrays) for arrays in buffer]
+
+            if shuffle:
+                permutation = rng.permutation(buffered)
+                merged = [array[permutation] for array in merged]
+
+            keep = min(shuffle_buffer // 2, buffered - batch_size) if shuffle else 0
+            release = ((buffered - keep) // batch_size) * batch_size
+
+            for start in range(0, release, batch_size):
+                yield finish([array[start : start + batch_size] for array in merged])
+
+            buffer = [[array[release:]] for array in merged]
+            buffered -= release
+
+        if buffered > 0:
+            merged = [np.concatenate(arrays) for arrays in buffer]
+
+            if shuffle:
+                permutation = rng.permutation(buffered)
+                merged = [array[permutation] for array in merged]
+
+            for start in range(0, buffered, batch_size):
+                yield finish([array[start : start + batch_size] for array in merged])
@@ -105,8 +105,9 @@ def add_rotations(X, k=4, axes=(1, 2)):
         )
 
 
-def add_noise(X, amount=0.01):
-    return X * np.random.normal(1, amount, X.shape)
+def add_noise(X, amount=0.01, rng=None):
+    random = np.random if rng is None else rng
+    return X * random.normal(1, amount, X.shape)
 
 
 def add_fixed_noise(X, center=0, amount=0.05):
@@ -4,14 +4,27 @@ sys.path.append("../../")
 import numpy as np
 import os
 import random
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import reduce
+from math import ceil, gcd
+from multiprocessing import get_context
+from threading import local
 
 from typing import Any, Dict, Union, Optional, Tuple, List
+from numba import jit, prange
 from osgeo import ogr, gdal
 from uuid import uuid4
 import rtree
 
 from buteo.project_types import Number
 from buteo.raster.io import (
+    internal_block_windows,
+    internal_open_thread_dataset,
+    internal_read_bands,
+    internal_shareable_source,
+    invalidate_raster_metadata,
     open_raster,
     to_raster_list,
     raster_to_array,
@@ -28,9 +41,34 @@ from buteo.vector.io import (
 from buteo.vector.reproject import internal_reproject_vector
 from buteo.raster.clip import clip_raster, internal_clip_raster
 from buteo.raster.resample import internal_resample_raster
-from buteo.utils import overwrite_required, remove_if_overwrite, progress, type_check
-from buteo.gdal_utils import ogr_bbox_intersects
+from buteo.utils import (
+    overwrite_required,
+    remove_if_overwrite,
+    progress,
+    type_check,
+    prefetch,
+    threaded_map,
+    BackgroundWorker,
+)
+from buteo.gdal_utils import (
+    default_options,
+    gdal_to_numpy_datatype,
+    numpy_to_gdal_datatype,
+    path_to_driver,
+)
 from buteo.machine_learning.ml_utils import Mish, mish, load_mish
+from buteo.machine_learning.patch_store import patches_to_store
+
+
+# The largest stack of passes held in memory when merging with median or mode.
+MERGE_BUFFER_BYTES = 67108864
+
+# The most cells along a patch when rasterizing clip geometries on a shared grid.
+CLIP_CELLS_PER_PATCH = 8
+
+# The least amount of sampled patches verified in a process pool. Starting the
+# processes imports this module and its dependencies in each of them.
+VERIFY_PROCESS_SAMPLES = 100000
 
 
 def reconstitute_raster(
@@ -162,7 +200,10 @@ def blocks_to_raster(
         if none is present.
 
         merge_method (str): How to handle overlapping pixels. Options are:
-        median, average, mode, min, max
+        median, average, mode, min, max, cosine, pyramid. Cosine and pyramid
+        blend the overlapping patches with weights that fall off towards the
+        edges of each patch, so a single overlapping offset gives seamless
+        output.
 
         output_array (bool): If True the output will be a numpy array instead of a
         raster.
@@ -209,24 +250,7 @@ def blocks_to_raster(
         border_patches_y = True
 
     # internal offset array. Avoid manipulating the og array.
-    in_offsets = []
-
-    if generate_zero_offset:
-        if offsets is not None:
-            if (0, 0) not in offsets:
-                in_offsets.append((0, 0))
-        else:
-            in_offsets.append((0, 0))
-
-    for offset in offsets:
-        if offset != (0, 0):
-            if not isinstance(offset, (list, tuple)) or len(offset) != 2:
-                raise ValueError(
-                    f"offset must be a list or tuple of two integers. Recieved: {offset}"
-                )
-            in_offsets.append((offset[0], offset[1]))
-        elif not generate_zero_offset:
-            in_offsets.append((offset[0], offset[1]))
+    in_offsets = internal_patch_offsets(offsets, generate_zero_offset)
 
     # Easier to read this way.
     has_offsets = False
@@ -237,75 +261,25 @@ def blocks_to_raster(
         has_offsets = True
 
     if has_offsets:
-        passes = []
-
-        previous = 0
-        largest_x = 0
-        largest_y = 0
-        for index, offset in enumerate(in_offsets):
-            passes.append(
-                np.ma.masked_all(
-                    (
-                        metadata["height"],
-                        metadata["width"],
-                        blocks.shape[3],
-                    ),
-                    dtype=metadata["datatype"],
-                ),
-            )
+        # The passes are merged as they are placed, instead of stacking a full
+        # raster per offset.
+        positions = internal_patch_positions(
+            metadata["width"], metadata["height"], size, in_offsets, border_patches
+        )
 
-            if index == 0:
-                x_blocks = ((metadata["width"] - offset[0]) // size) + border_patches_x
-                y_blocks = ((metadata["height"] - offset[1]) // size) + border_patches_x
-            else:
-                x_blocks = (metadata["width"] - offset[0]) // size
-                y_blocks = (metadata["height"] - offset[1]) // size
-
-            block_size = x_blocks * y_blocks
-
-            raster_pass = reconstitute_raster(  # pylint: disable=too-many-function-args
-                blocks[previous : block_size + previous, :, :, :],
-                metadata["height"],
-                metadata["width"],
-                size,
-                offset,
-                border_patches,
-                border_patches_x,
-                border_patches_y,
+        if positions.shape[0] != blocks.shape[0]:
+            raise ValueError(
+                f"The amount of blocks ({blocks.shape[0]}) does not match the offsets ({positions.shape[0]})."
             )
 
-            if raster_pass.shape[1] > largest_x:
-                largest_x = raster_pass.shape[1]
-
-            if raster_pass.shape[0] > largest_y:
-                largest_y = raster_pass.shape[0]
-
-            previous += block_size
-
-            passes[index][
-                offset[1] : raster_pass.shape[0] + offset[1],
-                offset[0] : raster_pass.shape[1] + offset[0],
-                :,
-            ] = raster_pass
-
-            passes[index] = passes[index].filled(np.nan)
-
-        if merge_method == "median":
-            raster = np.nanmedian(passes, axis=0)
-        elif merge_method == "mean" or merge_method == "average":
-            raster = np.nanmean(passes, axis=0)
-        elif merge_method == "min" or merge_method == "minumum":
-            raster = np.nanmin(passes, axis=0)
-        elif merge_method == "max" or merge_method == "maximum":
-            raster = np.nanmax(passes, axis=0)
-        elif merge_method == "mode" or merge_method == "majority":
-            for index, _ in enumerate(passes):
-                passes[index] = np.rint(passes[index]).astype(int)
-            raster = np.apply_along_axis(
-                lambda x: np.bincount(x).argmax(), axis=0, arr=passes
-            )
-        else:
-            raise ValueError(f"Unable to parse merge_method: {merge_method}")
+        raster = internal_patches_to_array(
+            blocks,
+            positions,
+            metadata["height"],
+            metadata["width"],
+            len(in_offsets),
+            merge_method,
+        )
 
     else:
         raster: np.ndarray = reconstitute_raster(
@@ -358,23 +332,19 @@ def shape_to_blockshape(shape: tuple, block_shape: tuple, offset: tuple) -> list
     return sizes
 
 
-def array_to_blocks(
+def internal_array_to_block_grid(
     array: np.ndarray,
     block_shape: tuple,
     offset: tuple,
     border_patches_x: bool = False,
     border_patches_y: bool = False,
 ) -> np.ndarray:
-    """Turns an array into a series of blocks. The array can be offset.
-    Args:
-        array (ndarray): The array to turn to blocks. (Channel last format: 1920x1080x3)
-
-        block_shape (tuple | list | ndarray): The size of the blocks eg. (64, 64)
+    """OBS: INTERNAL: Single output.
 
-        offset (tuple, list, ndarray): An initial offset for the array eg. (32, 32)
-
-    Returns:
-        A modified view into the array.
+    Turns an array into a grid of blocks without copying, unless border patches
+    are needed. The output has the shape
+    (blocks_y, blocks_x, block_y, block_x, channels). The blocks are ordered
+    like the output of array_to_blocks.
     """
     type_check(array, [np.ndarray], "array")
     type_check(block_shape, [tuple], "block_shape")
@@ -438,10 +408,636 @@ def array_to_blocks(
         block_shape[1],
         arr.shape[2],
     )
-    swaped = reshaped.swapaxes(1, 2)
-    merge = swaped.reshape(-1, block_shape[0], block_shape[1], array.shape[2])
 
-    return merge
+    # (blocks_y, blocks_x, block_y, block_x, channels)
+    return reshaped.swapaxes(1, 2)
+
+
+def array_to_blocks(
+    array: np.ndarray,
+    block_shape: tuple,
+    offset: tuple,
+    border_patches_x: bool = False,
+    border_patches_y: bool = False,
+) -> np.ndarray:
+    """Turns an array into a series of blocks. The array can be offset.
+    Args:
+        array (ndarray): The array to turn to blocks. (Channel last format: 1920x1080x3)
+
+        block_shape (tuple | list | ndarray): The size of the blocks eg. (64, 64)
+
+        offset (tuple, list, ndarray): An initial offset for the array eg. (32, 32)
+
+    Returns:
+        A modified view into the array.
+    """
+    block_grid = internal_array_to_block_grid(
+        array, block_shape, offset, border_patches_x, border_patches_y
+    )
+
+    return block_grid.reshape(-1, block_shape[0], block_shape[1], array.shape[2])
+
+
+def internal_write_blocks(
+    block_grid: np.ndarray,
+    output: np.ndarray,
+    position: int,
+    rows: Optional[np.ndarray] = None,
+    chunk_size: int = 4096,
+) -> int:
+    """OBS: INTERNAL: Single output.
+
+    Writes a grid of blocks (see internal_array_to_block_grid) into the rows of
+    output starting at position. If rows is given, only those blocks are
+    written, in order. The blocks are copied straight into output, in chunks,
+    so no intermediate copy of all the blocks is made. Returns the position
+    after the last written row.
+    """
+    blocks_x = block_grid.shape[1]
+
+    if rows is None:
+        count = block_grid.shape[0] * blocks_x
+
+        # The rows of output are contiguous, so this is a view.
+        np.copyto(
+            output[position : position + count].reshape(block_grid.shape),
+            block_grid,
+            casting="unsafe",
+        )
+
+        return position + count
+
+    for chunk in range(0, rows.shape[0], chunk_size):
+        chunk_rows = rows[chunk : chunk + chunk_size]
+        block_y, block_x = np.divmod(chunk_rows, blocks_x)
+
+        output[position : position + chunk_rows.shape[0]] = block_grid[
+            block_y, block_x
+        ]
+        position += chunk_rows.shape[0]
+
+    return position
+
+
+def internal_grid_to_wkb(
+    coord_grid: np.ndarray,
+    dx: Number,
+    dy: Number,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Packs the rectangles around the centroids in coord_grid (x, y) as little
+    endian WKB polygons in bulk. Returns an array with one 93 byte record per
+    polygon, use record.tobytes() to get the WKB.
+    """
+    wkb = np.empty(
+        coord_grid.shape[0],
+        dtype=[
+            ("byte_order", "u1"),
+            ("geom_type", "<u4"),
+            ("rings", "<u4"),
+            ("points", "<u4"),
+            ("coords", "<f8", (10,)),
+        ],
+    )
+
+    wkb["byte_order"] = 1  # Little endian
+    wkb["geom_type"] = ogr.wkbPolygon
+    wkb["rings"] = 1
+    wkb["points"] = 5
+
+    x_min = coord_grid[:, 0] - dx
+    x_max = coord_grid[:, 0] + dx
+    y_min = coord_grid[:, 1] - dy
+    y_max = coord_grid[:, 1] + dy
+
+    # top_left, top_right, bottom_right, bottom_left, top_left
+    coords = wkb["coords"]
+    coords[:, 0], coords[:, 1] = x_min, y_max
+    coords[:, 2], coords[:, 3] = x_max, y_max
+    coords[:, 4], coords[:, 5] = x_max, y_min
+    coords[:, 6], coords[:, 7] = x_min, y_min
+    coords[:, 8], coords[:, 9] = x_min, y_max
+
+    return wkb
+
+
+def internal_write_grid_layer(
+    layer: ogr.Layer,
+    wkb: np.ndarray,
+    fid_field: str,
+    verbose: int = 1,
+) -> ogr.Layer:
+    """OBS: INTERNAL: Single output.
+
+    Writes polygons packed by internal_grid_to_wkb to a layer within a single
+    transaction. The fids and the fid_field are the index of the polygons.
+    """
+    layer_defn = layer.GetLayerDefn()
+    field_index = layer_defn.GetFieldIndex(fid_field)
+
+    feature_count = wkb.shape[0]
+    record_size = wkb.dtype.itemsize
+    wkb_bytes = wkb.tobytes()
+
+    progress_step = max(1, feature_count // 100)
+
+    layer.StartTransaction()
+
+    for fid in range(feature_count):
+        if verbose == 1 and fid % progress_step == 0:
+            progress(fid, feature_count, "Patch generation")
+
+        feature = ogr.Feature(layer_defn)
+        feature.SetGeometryDirectly(
+            ogr.CreateGeometryFromWkb(
+                wkb_bytes[fid * record_size : (fid + 1) * record_size]
+            )
+        )
+        feature.SetField(field_index, fid)
+        feature.SetFID(fid)
+
+        layer.CreateFeature(feature)
+        feature = None
+
+    layer.CommitTransaction()
+
+    if verbose == 1:
+        progress(feature_count, feature_count, "Patch generation")
+
+    return layer
+
+
+def internal_burn_integral(
+    layer: ogr.Layer,
+    transform: List[Number],
+    cells_x: int,
+    cells_y: int,
+    all_touched: bool,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Rasterizes a layer on a grid and returns the integral image (summed area
+    table) of the burned cells. The integral image has a leading row and
+    column of zeros, so the burned cells in a window are:
+    I[y1, x1] - I[y0, x1] - I[y1, x0] + I[y0, x0]
+    """
+    driver = gdal.GetDriverByName("MEM")
+    burn_ds = driver.Create("", cells_x, cells_y, 1, gdal.GDT_Byte)
+    burn_ds.SetGeoTransform(transform)
+
+    layer_srs = layer.GetSpatialRef()
+    if layer_srs is not None:
+        burn_ds.SetProjection(layer_srs.ExportToWkt())
+
+    gdal.RasterizeLayer(
+        burn_ds,
+        [1],
+        layer,
+        burn_values=[1],
+        options=[f"ALL_TOUCHED={'TRUE' if all_touched else 'FALSE'}"],
+    )
+
+    burned = burn_ds.GetRasterBand(1).ReadAsArray()
+    burn_ds = None
+
+    integral = np.zeros((cells_y + 1, cells_x + 1), dtype="uint32")
+    np.cumsum(
+        np.cumsum(burned, axis=0, dtype="uint32"), axis=1, out=integral[1:, 1:]
+    )
+
+    return integral
+
+
+def internal_clip_grid(
+    coord_grid: np.ndarray,
+    clip_layer: ogr.Layer,
+    metadata: Dict[str, Any],
+    size: int,
+    offsets: List[Tuple[int, int]],
+    verbose: int = 1,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Finds the patches in coord_grid (x, y centroids) that intersect a clip
+    layer in the projection of the raster. Returns the sorted indices of the
+    intersecting patches.
+
+    The clip layer is rasterized once on a grid of cells that all the patch
+    offsets align with, or once per offset on a grid of patch sized cells if
+    those cells are small. With ALL_TOUCHED, patches with no burned cells can not
+    intersect and are rejected in bulk. For polygons, patches containing a
+    cell with its center inside a polygon are accepted in bulk. Only the
+    patches on the edges of the clip geometries are tested exactly, against
+    geometries loaded once.
+    """
+    pixel_width = metadata["pixel_width"]
+    pixel_height = metadata["pixel_height"]
+    x_min, y_max = metadata["x_min"], metadata["y_max"]
+
+    dx = (pixel_width * size) / 2
+    dy = (pixel_height * size) / 2
+
+    # The top left pixel of each patch.
+    pixel_x = np.rint((coord_grid[:, 0] - dx - x_min) / pixel_width).astype("int64")
+    pixel_y = np.rint((y_max - (coord_grid[:, 1] + dy)) / pixel_height).astype("int64")
+
+    # The largest cell that every patch aligns with.
+    cell = reduce(gcd, [size] + [int(value) for offset in offsets for value in offset])
+
+    if size // cell <= CLIP_CELLS_PER_PATCH:
+        groups = [(0, 0, cell, np.arange(coord_grid.shape[0]))]
+    else:
+        # Small cells rasterize close to the full resolution of the raster, so
+        # each offset gets its own grid of patch sized cells instead.
+        groups = []
+        origins = np.stack([pixel_x % size, pixel_y % size], axis=1)
+        for origin_x, origin_y in np.unique(origins, axis=0):
+            group_ids = np.nonzero(
+                (origins[:, 0] == origin_x) & (origins[:, 1] == origin_y)
+            )[0]
+            groups.append((int(origin_x), int(origin_y), size, group_ids))
+
+    clip_geom_type = ogr.GT_Flatten(clip_layer.GetGeomType())
+    polygons = clip_geom_type in [ogr.wkbPolygon, ogr.wkbMultiPolygon]
+
+    keep = np.zeros(coord_grid.shape[0], dtype=bool)
+    candidates = np.zeros(coord_grid.shape[0], dtype=bool)
+
+    for origin_x, origin_y, group_cell, group_ids in groups:
+        cells_x = ceil((metadata["width"] - origin_x) / group_cell)
+        cells_y = ceil((metadata["height"] - origin_y) / group_cell)
+        cells_per_patch = size // group_cell
+
+        transform = [
+            x_min + origin_x * pixel_width,
+            pixel_width * group_cell,
+            0,
+            y_max - origin_y * pixel_height,
+            0,
+            -(pixel_height * group_cell),
+        ]
+
+        # The top left cell of each patch.
+        cell_x = (pixel_x[group_ids] - origin_x) // group_cell
+        cell_y = (pixel_y[group_ids] - origin_y) // group_cell
+
+        np.clip(cell_x, 0, cells_x - cells_per_patch, out=cell_x)
+        np.clip(cell_y, 0, cells_y - cells_per_patch, out=cell_y)
+
+        def burned_cells(integral: np.ndarray) -> np.ndarray:
+            x_end = cell_x + cells_per_patch
+            y_end = cell_y + cells_per_patch
+
+            return (
+                integral[y_end, x_end]
+                - integral[cell_y, x_end]
+                - integral[y_end, cell_x]
+                + integral[cell_y, cell_x]
+            )
+
+        # With ALL_TOUCHED, patches with no burned cells can not intersect.
+        touched = burned_cells(
+            internal_burn_integral(clip_layer, transform, cells_x, cells_y, True)
+        )
+        candidates[group_ids] = touched > 0
+
+        if polygons:
+            interior = burned_cells(
+                internal_burn_integral(clip_layer, transform, cells_x, cells_y, False)
+            )
+            keep[group_ids[interior > 0]] = True
+
+    candidates[keep] = False
+
+    candidate_ids = np.nonzero(candidates)[0]
+
+    if candidate_ids.shape[0] == 0:
+        return np.nonzero(keep)[0]
+
+    # Load the clip geometries once.
+    clip_geoms = []
+    spatial_index = rtree.index.Index(interleaved=False)
+
+    clip_layer.ResetReading()
+    for clip_feature in clip_layer:
+        clip_feature_geom = clip_feature.GetGeometryRef()
+
+        if clip_feature_geom is None:
+            continue
+
+        spatial_index.insert(len(clip_geoms), clip_feature_geom.GetEnvelope())
+        clip_geoms.append(clip_feature_geom.Clone())
+
+    candidate_wkb = internal_grid_to_wkb(coord_grid[candidate_ids], dx, dy)
+    progress_step = max(1, candidate_ids.shape[0] // 100)
+
+    for index, tile_id in enumerate(candidate_ids):
+        if verbose == 1 and index % progress_step == 0:
+            progress(index, candidate_ids.shape[0], "Patch clipping")
+
+        x, y = coord_grid[tile_id]
+        bbox = (x - dx, x + dx, y - dy, y + dy)
+
+        grid_geom = ogr.CreateGeometryFromWkb(candidate_wkb[index].tobytes())
+
+        for clip_index in spatial_index.intersection(bbox):
+            if grid_geom.Intersects(clip_geoms[clip_index]):
+                keep[tile_id] = True
+                break
+
+    if verbose == 1:
+        progress(candidate_ids.shape[0], candidate_ids.shape[0], "Patch clipping")
+
+    return np.nonzero(keep)[0]
+
+
+def internal_patch_offsets(
+    offsets: Optional[List[Tuple[int, int]]],
+    generate_zero_offset: bool = True,
+) -> List[Tuple[int, int]]:
+    """OBS: INTERNAL: Single output.
+
+    Readies a list of offsets the same way as extract_patches. The (0, 0) offset
+    is first if generate_zero_offset is True.
+    """
+    in_offsets: List[Tuple[int, int]] = []
+
+    if generate_zero_offset:
+        in_offsets.append((0, 0))
+
+    for offset in offsets if offsets is not None else []:
+        if not isinstance(offset, (list, tuple)) or len(offset) != 2:
+            raise ValueError(
+                f"offset must be a list or tuple of two integers. Recieved: {offset}"
+            )
+
+        offset = (int(offset[0]), int(offset[1]))
+
+        if offset not in in_offsets:
+            in_offsets.append(offset)
+
+    return in_offsets
+
+
+def internal_patch_grid(
+    width: int,
+    height: int,
+    size: int,
+    offsets: List[Tuple[int, int]],
+    generate_border_patches: bool = True,
+) -> List[Tuple[Tuple[int, int], np.ndarray, np.ndarray]]:
+    """OBS: INTERNAL: Single output.
+
+    Calculates the top left pixel of the patches of each offset, in the order
+    used by extract_patches. Border patches are added to the (0, 0) offset, if
+    it is the first. Returns a list of (offset, x_positions, y_positions).
+    """
+    grid = []
+    for index, offset in enumerate(offsets):
+        x_positions = list(range(offset[0], width - size + 1, size))
+        y_positions = list(range(offset[1], height - size + 1, size))
+
+        if generate_border_patches and index == 0 and tuple(offset) == (0, 0):
+            if width % size != 0:
+                x_positions.append(width - size)
+
+            if height % size != 0:
+                y_positions.append(height - size)
+
+        grid.append(
+            (
+                (int(offset[0]), int(offset[1])),
+                np.array(x_positions, dtype="int64"),
+                np.array(y_positions, dtype="int64"),
+            )
+        )
+
+    return grid
+
+
+def iter_patches(
+    raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
+    size: int = 32,
+    offsets: Optional[List[Tuple[int, int]]] = [],
+    generate_border_patches: bool = True,
+    generate_zero_offset: bool = True,
+    batch_size: int = 64,
+    return_positions: bool = False,
+):
+    """Iterates over the patches of a raster in batches, without creating an
+        array of all the patches. The patches are in the same order as the output
+        of extract_patches (without clip_geom), so iterating all batches gives the
+        same patches. Only a strip of size rows is read at a time.
+
+    Args:
+        raster (list | path | raster): The raster(s) to iterate. If a list is
+        provided the rasters must be aligned and the bands are stacked in order.
+
+    **kwargs:
+        size (int): The size of the patches in pixels.
+
+        offsets (list of tuples): List of offsets to extract. Example:
+        offsets=[(16, 16), (16, 0), (0, 16)].
+
+        generate_border_patches (bool): Add patches along the right and bottom
+        borders, where the patches do not align with the raster. Only added to
+        the (0, 0) offset.
+
+        generate_zero_offset (bool): if True, an offset is inserted at (0, 0)
+        if none is present.
+
+        batch_size (int): The amount of patches in each batch. The last batch
+        can be smaller.
+
+        return_positions (bool): Also yield the top left pixel (x, y) of each
+        patch.
+
+    Returns:
+        A generator yielding arrays of (batch, size, size, bands) or tuples of
+        (patches, positions) if return_positions is True.
+    """
+    type_check(raster, [list, str, gdal.Dataset], "raster")
+    type_check(size, [int], "size")
+    type_check(offsets, [list], "offsets", allow_none=True)
+    type_check(generate_border_patches, [bool], "generate_border_patches")
+    type_check(generate_zero_offset, [bool], "generate_zero_offset")
+    type_check(batch_size, [int], "batch_size")
+    type_check(return_positions, [bool], "return_positions")
+
+    if size < 1 or batch_size < 1:
+        raise ValueError("size and batch_size must be positive integers.")
+
+    in_rasters = to_raster_list(raster)
+
+    if not rasters_are_aligned(in_rasters, same_extent=True):
+        raise ValueError(
+            "Input rasters must be aligned. Please use the align function."
+        )
+
+    # Keep the datasets referenced while reading from their bands.
+    datasets = []
+    read_bands = []
+    for in_raster in in_rasters:
+        ref = open_raster(in_raster, writeable=False)
+        datasets.append(ref)
+
+        for band in range(ref.RasterCount):
+            read_bands.append(ref.GetRasterBand(band + 1))
+
+    width = datasets[0].RasterXSize
+    height = datasets[0].RasterYSize
+
+    if size > width or size > height:
+        raise ValueError(f"Patch size {size} is larger than the raster.")
+
+    channels = len(read_bands)
+    dtype = np.result_type(
+        *[gdal_to_numpy_datatype(band.DataType) for band in read_bands]
+    )
+
+    grid = internal_patch_grid(
+        width,
+        height,
+        size,
+        internal_patch_offsets(offsets, generate_zero_offset),
+        generate_border_patches,
+    )
+
+    strip = np.empty((size, width, channels), dtype=dtype)
+    batch = np.empty((batch_size, size, size, channels), dtype=dtype)
+    positions = np.empty((batch_size, 2), dtype="int64")
+    batch_filled = 0
+
+    for offset, x_positions, y_positions in grid:
+        x_regular = (width - offset[0]) // size
+
+        for y_position in y_positions:
+            internal_read_bands(read_bands, [0, int(y_position), width, size], strip)
+
+            # A view of the strip as (patches, size, size, channels).
+            row = (
+                strip[:, offset[0] : offset[0] + (x_regular * size)]
+                .reshape(size, x_regular, size, channels)
+                .swapaxes(0, 1)
+            )
+
+            sources = [(row, x_positions[:x_regular])]
+
+            if x_positions.shape[0] > x_regular:
+                sources.append(
+                    (strip[np.newaxis, :, width - size :], x_positions[x_regular:])
+                )
+
+            for patches, patch_x in sources:
+                done = 0
+                while done < patches.shape[0]:
+                    take = min(batch_size - batch_filled, patches.shape[0] - done)
+
+                    batch[batch_filled : batch_filled + take] = patches[
+                        done : done + take
+                    ]
+                    positions[batch_filled : batch_filled + take, 0] = patch_x[
+                        done : done + take
+                    ]
+                    positions[batch_filled : batch_filled + take, 1] = y_position
+
+                    batch_filled += take
+                    done += take
+
+                    if batch_filled == batch_size:
+                        yield (batch, positions) if return_positions else batch
+
+                        # The consumer might keep the batch, so do not reuse it.
+                        batch = np.empty_like(batch)
+                        positions = np.empty_like(positions)
+                        batch_filled = 0
+
+    if batch_filled > 0:
+        if return_positions:
+            yield (batch[:batch_filled], positions[:batch_filled])
+        else:
+            yield batch[:batch_filled]
+
+
+def count_patches(
+    raster: Union[str, gdal.Dataset],
+    size: int = 32,
+    offsets: Optional[List[Tuple[int, int]]] = [],
+    generate_border_patches: bool = True,
+    generate_zero_offset: bool = True,
+) -> int:
+    """Counts the patches iter_patches will generate for a raster.
+
+    Args:
+        raster (path | raster): The raster to count patches for.
+
+    **kwargs:
+        See iter_patches.
+
+    Returns:
+        The amount of patches.
+    """
+    type_check(raster, [str, gdal.Dataset], "raster")
+
+    metadata = internal_raster_to_metadata(raster)
+
+    grid = internal_patch_grid(
+        metadata["width"],
+        metadata["height"],
+        size,
+        internal_patch_offsets(offsets, generate_zero_offset),
+        generate_border_patches,
+    )
+
+    return int(sum(x.shape[0] * y.shape[0] for _offset, x, y in grid))
+
+
+def patch_dataset(
+    raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
+    size: int = 32,
+    offsets: Optional[List[Tuple[int, int]]] = [],
+    generate_border_patches: bool = True,
+    generate_zero_offset: bool = True,
+    batch_size: int = 64,
+):
+    """Creates a tf.data.Dataset of batches of patches, generated on the fly by
+        iter_patches. Requires tensorflow.
+
+    Args:
+        raster (list | path | raster): The raster(s) to generate patches from.
+
+    **kwargs:
+        See iter_patches.
+
+    Returns:
+        A tf.data.Dataset yielding batches of (batch, size, size, bands).
+    """
+    import tensorflow as tf
+
+    in_rasters = to_raster_list(raster)
+
+    channels = 0
+    datatypes = []
+    for in_raster in in_rasters:
+        metadata = internal_raster_to_metadata(in_raster)
+        channels += metadata["band_count"]
+        datatypes.append(metadata["datatype"])
+
+    return tf.data.Dataset.from_generator(
+        lambda: iter_patches(
+            in_rasters,
+            size=size,
+            offsets=offsets,
+            generate_border_patches=generate_border_patches,
+            generate_zero_offset=generate_zero_offset,
+            batch_size=batch_size,
+        ),
+        output_signature=tf.TensorSpec(
+            shape=(None, size, size, channels),
+            dtype=tf.as_dtype(np.result_type(*datatypes)),
+        ),
+    )
 
 
 def test_extraction(
@@ -568,28 +1164,270 @@ def test_extraction(
     return True
 
 
-# TODO: Initial clip to extent of clip.
-def extract_patches(
-    raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
-    out_dir: Optional[str] = None,
-    prefix: str = "",
-    postfix: str = "_patches",
-    size: int = 32,
-    offsets: Union[list, None] = [],
-    generate_border_patches: bool = True,
-    generate_zero_offset: bool = True,
-    generate_grid_geom: bool = True,
+def internal_verify_patch_rows(
+    raster: Union[str, gdal.Dataset],
+    array: Union[str, np.ndarray],
+    rows: np.ndarray,
+    windows: np.ndarray,
+    size: int,
+) -> List[int]:
+    """OBS: INTERNAL: Single output.
+
+    Compares the patches at rows of an array with the windows (x, y) read
+    directly from the raster. Returns the rows that do not match. Paths are
+    opened for each call, in the calling thread or process, and .npy files are
+    memory mapped.
+    """
+    if isinstance(raster, str):
+        dataset = gdal.Open(raster, gdal.GA_ReadOnly)
+
+        if dataset is None:
+            raise ValueError(f"Unable to open raster: {raster}")
+    else:
+        dataset = raster
+
+    if isinstance(array, str):
+        array = np.load(array, mmap_mode="r")
+
+    failed = []
+    for row, (x, y) in zip(rows, windows):
+        window = dataset.ReadAsArray(int(x), int(y), size, size)
+
+        if window is None:
+            failed.append(int(row))
+            continue
+
+        if window.ndim == 2:
+            window = window[np.newaxis]
+
+        if not np.array_equal(np.moveaxis(window, 0, -1), array[row]):
+            failed.append(int(row))
+
+    return failed
+
+
+def verify_patches(
+    rasters: Union[list, str, gdal.Dataset],
+    arrays: Union[list, str, np.ndarray],
+    pixel_windows: np.ndarray,
+    size: int,
+    samples: int = 1000,
+    workers: Optional[int] = None,
+    verbose: int = 1,
+) -> bool:
+    """Validates the output of the patch_extractor by reading the expected window
+        of each sampled patch directly from the rasters, by pixel offset. Much
+        faster than test_extraction, as nothing is clipped or warped. The
+        patches are verified in a thread pool, as GDAL releases the GIL while
+        reading. Rasters on disk with patches saved as .npy are verified in a
+        process pool if at least VERIFY_PROCESS_SAMPLES patches are sampled.
+    Args:
+        rasters (list of rasters | path | raster): The raster(s) used.
+
+        arrays (list of arrays | path | ndarray): The arrays generated.
+
+        pixel_windows (ndarray): The (x, y) pixel of the top left corner of
+        each patch, in the same order as the arrays.
+
+        size (int): The size of the patches.
+
+    **kwargs:
+        samples (int): The amount of patches to randomly test. If 0 all patches
+        will be tested.
+
+        workers (int | None): The amount of threads or processes. If None, the
+        amount of cpus.
+
+        verbose (int): If 1 will output messages on progress.
+
+    Returns:
+        True if the extraction is valid. Raises an error otherwise.
+    """
+    type_check(rasters, [list, str, gdal.Dataset], "rasters")
+    type_check(arrays, [list, str, np.ndarray], "arrays")
+    type_check(pixel_windows, [np.ndarray], "pixel_windows")
+    type_check(size, [int], "size")
+    type_check(samples, [int], "samples")
+    type_check(workers, [int], "workers", allow_none=True)
+    type_check(verbose, [int], "verbose")
+
+    in_rasters = to_raster_list(rasters)
+    in_arrays = arrays if isinstance(arrays, list) else [arrays]
+
+    if len(in_rasters) != len(in_arrays):
+        raise ValueError("The amount of rasters and arrays must match.")
+
+    if verbose == 1:
+        print("Verifying integrity of output patches..")
+
+    patch_count = pixel_windows.shape[0]
+    test_count = patch_count if samples <= 0 else min(samples, patch_count)
+    test_rows = np.sort(
+        np.random.default_rng().choice(patch_count, test_count, replace=False)
+    )
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    workers = max(workers, 1)
+    chunk_count = min(workers * 4, max(test_count, 1))
+    chunks = [
+        chunk for chunk in np.array_split(test_rows, chunk_count) if chunk.shape[0] > 0
+    ]
+
+    for index, raster in enumerate(in_rasters):
+        test_array = in_arrays[index]
+
+        if isinstance(test_array, str) and not os.path.exists(test_array):
+            raise ValueError(f"Numpy array does not exist: {test_array}")
+
+        source, in_memory = internal_shareable_source(raster)
+
+        if verbose == 1:
+            name = os.path.basename(source) if isinstance(source, str) else index
+            print(f"Testing: {name}")
+
+        if isinstance(source, gdal.Dataset):
+            results = [
+                internal_verify_patch_rows(
+                    source, test_array, chunk, pixel_windows[chunk], size
+                )
+                for chunk in chunks
+            ]
+        else:
+            # Processes cannot see /vsimem or arrays in memory. They are spawned,
+            # as forking a process running GDAL or Numba threads can hang.
+            if (
+                not in_memory
+                and isinstance(test_array, str)
+                and test_count >= VERIFY_PROCESS_SAMPLES
+            ):
+                pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=get_context("spawn")
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=workers)
+
+            with pool as executor:
+                futures = [
+                    executor.submit(
+                        internal_verify_patch_rows,
+                        source,
+                        test_array,
+                        chunk,
+                        pixel_windows[chunk],
+                        size,
+                    )
+                    for chunk in chunks
+                ]
+
+                results = []
+                for tested, future in enumerate(futures):
+                    results.append(future.result())
+
+                    if verbose == 1:
+                        progress(tested + 1, len(futures), "Verifying..")
+
+        failed = [row for result in results for row in result]
+
+        if len(failed) > 0:
+            raise Exception(
+                f"Raster {index} and {len(failed)} of the sampled patches did not match. First: {failed[0]}"
+            )
+
+    return True
+
+
+def internal_patch_scales(
+    rasters: List[Union[str, gdal.Dataset]],
+    size: int,
+    offsets: List[Tuple[int, int]],
+    threshold: float = 0.001,
+) -> List[Tuple[float, int, List[Tuple[int, int]]]]:
+    """OBS: INTERNAL: Single output.
+
+    Scales the patch size and offsets, given in pixels of the first raster, to
+    the native resolution of each raster. The rasters must share the projection
+    and extent, and the scaled sizes and offsets must be whole pixels. Returns a
+    list of (ratio, size, offsets), where ratio is the amount of pixels of the
+    raster per pixel of the first raster.
+    """
+    base = internal_raster_to_metadata(rasters[0])
+
+    scales = []
+    for raster in rasters:
+        metadata = internal_raster_to_metadata(raster)
+
+        if metadata["projection"] != base["projection"]:
+            raise ValueError(f"Raster projections do not match: {metadata['name']}")
+
+        for key in ["x_min", "y_max", "x_max", "y_min"]:
+            if abs(metadata[key] - base[key]) > threshold:
+                raise ValueError(
+                    f"Raster extents do not match: {metadata['name']}. Please use the align function."
+                )
+
+        ratio = base["pixel_width"] / metadata["pixel_width"]
+        ratio_y = abs(base["pixel_height"] / metadata["pixel_height"])
+
+        if abs(ratio - ratio_y) > 1e-6:
+            raise ValueError(f"Raster pixels must be square: {metadata['name']}")
+
+        values = [size, base["width"], base["height"]]
+        for offset in offsets:
+            values += [offset[0], offset[1]]
+
+        scaled = [value * ratio for value in values]
+
+        if any(abs(value - round(value)) > 1e-6 for value in scaled):
+            raise ValueError(
+                f"The patch size and offsets are not whole pixels in {metadata['name']} at a ratio of {ratio}."
+            )
+
+        if (round(scaled[1]), round(scaled[2])) != (
+            metadata["width"],
+            metadata["height"],
+        ):
+            raise ValueError(f"Raster does not share the grid: {metadata['name']}")
+
+        scaled_offsets = [
+            (round(scaled[index]), round(scaled[index + 1]))
+            for index in range(3, len(scaled), 2)
+        ]
+
+        scales.append((ratio, round(scaled[0]), scaled_offsets))
+
+    return scales
+
+
+# TODO: Initial clip to extent of clip.
+def extract_patches(
+    raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
+    out_dir: Optional[str] = None,
+    prefix: str = "",
+    postfix: str = "_patches",
+    size: int = 32,
+    offsets: Union[list, None] = [],
+    generate_border_patches: bool = True,
+    generate_zero_offset: bool = True,
+    generate_grid_geom: bool = True,
     clip_geom: Optional[Union[str, ogr.DataSource, gdal.Dataset]] = None,
     clip_layer_index: int = 0,
     verify_output=True,
     verification_samples=100,
+    verification_workers: Optional[int] = None,
     overwrite=True,
+    memmap: bool = False,
+    output_format: str = "npy",
     epsilon: float = 1e-9,
     verbose: int = 1,
 ) -> tuple:
     """Extracts square tiles from a raster.
     Args:
-        raster (list of rasters | path | raster): The raster(s) to convert.
+        raster (list of rasters | path | raster): The raster(s) to convert. The
+        rasters must share the extent, but can be of different resolutions. The
+        grid is calculated once and the patches of each raster are extracted at
+        its native resolution, eg. 64 px at 10m and 32 px at 20m.
 
     **kwargs:
         out_dir (path | none): Folder to save output. If None, in-memory
@@ -599,7 +1437,8 @@ def extract_patches(
 
         postfix (str): A postfix for all outputs.
 
-        size (int): The size of the tiles in pixels.
+        size (int): The size of the tiles in pixels of the first raster. The
+        size and offsets must be whole pixels in the other rasters.
 
         offsets (list of tuples): List of offsets to extract. Example:
         offsets=[(16, 16), (16, 0), (0, 16)]. Will offset the initial raster
@@ -618,6 +1457,25 @@ def extract_patches(
         intersections with a geometry. Useful if a lot of the target
         area is water or similar.
 
+        verify_output (bool): Read the window of a sample of the patches
+        directly from the rasters and compare them with the output.
+
+        verification_samples (int): The amount of patches to verify. If 0 all
+        patches are verified.
+
+        verification_workers (int | None): The amount of processes (or threads
+        for in memory outputs) used to verify. If None, the amount of cpus.
+
+        memmap (bool): Write the patches straight into a memory mapped .npy
+        file in out_dir, instead of assembling them in memory first. Useful
+        when the patches do not fit in memory. Requires out_dir.
+
+        output_format (str): npy saves a .npy file per raster. hdf5 saves all
+        the rasters to a single chunked and compressed patch store, with the
+        grid index and offset of each patch. See patch_store. Requires out_dir.
+        The datasets are named after the rasters, suffixed with the index of
+        the raster if the names repeat.
+
         epsilon (float): How much for buffer the arange array function. This
         should usually just be left alone.
 
@@ -641,6 +1499,8 @@ def extract_patches(
     )
     type_check(clip_layer_index, [int], "clip_layer_index")
     type_check(overwrite, [bool], "overwrite")
+    type_check(memmap, [bool], "memmap")
+    type_check(output_format, [str], "output_format")
     type_check(epsilon, [float], "epsilon")
     type_check(verbose, [int], "verbose")
 
@@ -649,10 +1509,14 @@ def extract_patches(
     if out_dir is not None and not os.path.isdir(out_dir):
         raise ValueError(f"Output directory does not exists: {out_dir}")
 
-    if not rasters_are_aligned(in_rasters):
-        raise ValueError(
-            "Input rasters must be aligned. Please use the align function."
-        )
+    if memmap and out_dir is None:
+        raise ValueError("memmap requires an out_dir.")
+
+    if output_format not in ["npy", "hdf5"]:
+        raise ValueError(f"Unable to parse output_format: {output_format}")
+
+    if output_format == "hdf5" and out_dir is None:
+        raise ValueError("The hdf5 output_format requires an out_dir.")
 
     output_geom = None
 
@@ -662,20 +1526,10 @@ def extract_patches(
         print("Generating blocks..")
 
     # internal offset array. Avoid manipulating the og array.
-    if offsets is None:
-        offsets = []
+    in_offsets = internal_patch_offsets(offsets, generate_zero_offset)
 
-    in_offsets = []
-    if generate_zero_offset and (0, 0) not in offsets:
-        in_offsets.append((0, 0))
-
-    for offset in offsets:
-        if offset != (0, 0):
-            if not isinstance(offset, (list, tuple)) or len(offset) != 2:
-                raise ValueError(
-                    f"offset must be a list or tuple of two integers. Recieved: {offset}"
-                )
-            in_offsets.append((offset[0], offset[1]))
+    # The size and offsets of the patches at the resolution of each raster.
+    patch_scales = internal_patch_scales(in_rasters, size, in_offsets)
 
     border_patches_needed_x = True
     border_patches_needed_y = True
@@ -723,13 +1577,15 @@ def extract_patches(
 
     offset_rows_cumsum = np.cumsum(offset_rows)
 
+    # The rows (patches) to keep. None keeps all.
+    mask = None
+    coord_grid = None
+
     if generate_grid_geom is True or clip_geom is not None:
 
         if verbose == 1:
             print("Calculating grid cells..")
 
-        mask = np.arange(all_rows, dtype="uint64")
-
         ulx, uly, _lrx, _lry = metadata["extent"]
 
         pixel_width = abs(metadata["pixel_width"])
@@ -748,10 +1604,8 @@ def extract_patches(
             )
             clip_layer = clip_ref.GetLayerByIndex(clip_layer_index)
 
-            meta_clip = internal_vector_to_metadata(clip_ref)
-            # geom_clip = meta_clip["layers"][clip_layer_index]["column_geom"]
-
-            clip_extent = meta_clip["extent_ogr"]
+            if clip_layer is None:
+                raise ValueError(f"Unable to read clip layer: {clip_layer_index}")
             # clip_adjust = [
             #     clip_extent[0] - clip_extent[0] % xres,  # x_min
             #     (clip_extent[1] - clip_extent[1] % xres) + xres,  # x_max
@@ -851,88 +1705,27 @@ def extract_patches(
         patches_layer = patches_ds.CreateLayer(
             "patches_all", geom_type=ogr.wkbPolygon, srs=metadata["projection_osr"]
         )
-        patches_fdefn = patches_layer.GetLayerDefn()
 
         og_fid = "og_fid"
 
         field_defn = ogr.FieldDefn(og_fid, ogr.OFTInteger)
         patches_layer.CreateField(field_defn)
 
-        if clip_geom is not None:
-            clip_feature_count = meta_clip["layers"][clip_layer_index]["feature_count"]
-            spatial_index = rtree.index.Index(interleaved=False)
-            for _ in range(clip_feature_count):
-                clip_feature = clip_layer.GetNextFeature()
-                clip_fid = clip_feature.GetFID()
-                clip_feature_geom = clip_feature.GetGeometryRef()
-                xmin, xmax, ymin, ymax = clip_feature_geom.GetEnvelope()
-
-                spatial_index.insert(clip_fid, (xmin, xmax, ymin, ymax))
-
-        fids = 0
-        mask = []
-        for tile_id in range(coord_grid.shape[0]):
-            x, y = coord_grid[tile_id]
-
-            if verbose == 1:
-                progress(tile_id, coord_grid.shape[0], "Patch generation")
-
-            x_min = x - dx
-            x_max = x + dx
-            y_min = y - dx
-            y_max = y + dx
+        # The polygons of all the patches, packed as WKB.
+        grid_wkb = internal_grid_to_wkb(coord_grid, dx, dy)
 
-            tile_intersects = True
-
-            grid_geom = None
-            poly_wkt = None
-
-            if clip_geom is not None:
-                tile_intersects = False
-
-                if not ogr_bbox_intersects([x_min, x_max, y_min, y_max], clip_extent):
-                    continue
-
-                intersections = list(
-                    spatial_index.intersection((x_min, x_max, y_min, y_max))
-                )
-                if len(intersections) == 0:
-                    continue
-
-                poly_wkt = f"POLYGON (({x_min} {y_max}, {x_max} {y_max}, {x_max} {y_min}, {x_min} {y_min}, {x_min} {y_max}))"
-                grid_geom = ogr.CreateGeometryFromWkt(poly_wkt)
-
-                for fid1 in intersections:
-                    clip_feature = clip_layer.GetFeature(fid1)
-                    clip_geom = clip_feature.GetGeometryRef()
-
-                    if grid_geom.Intersects(clip_geom):
-                        tile_intersects = True
-                        continue
-
-            if tile_intersects:
-                ft = ogr.Feature(patches_fdefn)
-
-                if grid_geom is None:
-                    poly_wkt = f"POLYGON (({x_min} {y_max}, {x_max} {y_max}, {x_max} {y_min}, {x_min} {y_min}, {x_min} {y_max}))"
-                    grid_geom = ogr.CreateGeometryFromWkt(poly_wkt)
-
-                ft_geom = ogr.CreateGeometryFromWkt(poly_wkt)
-                ft.SetGeometry(ft_geom)
-
-                ft.SetField(og_fid, int(fids))
-                ft.SetFID(int(fids))
-
-                patches_layer.CreateFeature(ft)
-                ft = None
-
-                mask.append(tile_id)
-                fids += 1
-
-        if verbose == 1:
-            progress(coord_grid.shape[0], coord_grid.shape[0], "Patch generation")
+        if clip_geom is not None:
+            mask = internal_clip_grid(
+                coord_grid, clip_layer, metadata, size, in_offsets, verbose=verbose
+            )
 
-        mask = np.array(mask, dtype=int)
+            internal_write_grid_layer(
+                patches_layer, grid_wkb[mask], og_fid, verbose=verbose
+            )
+        else:
+            # Without a clip geometry all the patches are kept.
+            mask = None
+            internal_write_grid_layer(patches_layer, grid_wkb, og_fid, verbose=verbose)
 
         if generate_grid_geom is True:
             if out_dir is None:
@@ -955,7 +1748,8 @@ def extract_patches(
 
     output_blocks = []
 
-    for raster in in_rasters:
+    for raster_index, raster in enumerate(in_rasters):
+        _ratio, raster_size, raster_offsets = patch_scales[raster_index]
 
         base = None
         basename = None
@@ -968,66 +1762,137 @@ def extract_patches(
 
         metadata = internal_raster_to_metadata(raster)
 
-        if generate_grid_geom is True or clip_geom is not None:
-            output_shape = (row_count, size, size, metadata["band_count"])
+        if mask is not None:
+            output_rows = mask.shape[0]
+        elif generate_grid_geom is True or clip_geom is not None:
+            output_rows = row_count
         else:
-            output_shape = (all_rows, size, size, metadata["band_count"])
+            output_rows = all_rows
+
+        output_shape = (output_rows, raster_size, raster_size, metadata["band_count"])
 
         input_datatype = metadata["datatype"]
 
-        output_array = np.empty(output_shape, dtype=input_datatype)
+        if memmap:
+            overwrite_required(output_block, overwrite)
+            remove_if_overwrite(output_block, overwrite)
+
+            output_array = np.lib.format.open_memmap(
+                output_block, mode="w+", dtype=input_datatype, shape=output_shape
+            )
+        else:
+            output_array = np.empty(output_shape, dtype=input_datatype)
 
-        # if clip_geom is not None:
-        #     ref = raster_to_array(raster, filled=True, extent=tiled_extent)
-        # else:
         ref = raster_to_array(raster, filled=True)
 
-        for k, offset in enumerate(in_offsets):
+        # The patches are written offset by offset. Only the rows in the mask
+        # are written, so the output is never copied.
+        position = 0
+        for k, offset in enumerate(raster_offsets):
             start = 0
             if k > 0:
                 start = offset_rows_cumsum[k - 1]
 
-            blocks = None
+            block_grid = None
             if (
                 k == 0
                 and generate_border_patches
                 and (border_patches_needed_x or border_patches_needed_y)
             ):
-                blocks = array_to_blocks(
+                block_grid = internal_array_to_block_grid(
                     ref,
-                    (size, size),
+                    (raster_size, raster_size),
                     offset,
                     border_patches_needed_x,
                     border_patches_needed_y,
                 )
             else:
-                blocks = array_to_blocks(ref, (size, size), offset)
+                block_grid = internal_array_to_block_grid(
+                    ref, (raster_size, raster_size), offset
+                )
+
+            rows = None
+            if mask is not None:
+                mask_start, mask_end = np.searchsorted(
+                    mask, [start, offset_rows_cumsum[k]]
+                )
+                rows = mask[mask_start:mask_end] - start
 
-            output_array[start : offset_rows_cumsum[k]] = blocks
+            position = internal_write_blocks(block_grid, output_array, position, rows)
 
-        if generate_grid_geom is False and clip_geom is None:
-            if out_dir is None:
-                output_blocks.append(output_array)
-            else:
-                output_blocks.append(output_block)
-                np.save(output_block, output_array)
+        if memmap:
+            output_array.flush()
+            output_blocks.append(output_block)
+            output_array = None
+        elif out_dir is None or output_format == "hdf5":
+            output_blocks.append(output_array)
         else:
-            if out_dir is None:
-                output_blocks.append(output_array[mask])
-            else:
-                output_blocks.append(output_block)
-                np.save(output_block, output_array[mask])
+            output_blocks.append(output_block)
+            np.save(output_block, output_array)
+
+    if verify_output and coord_grid is not None:
+        # The top left pixel of each patch, from the center of its grid cell.
+        pixel_windows = np.empty((coord_grid.shape[0], 2), dtype="int64")
+        pixel_windows[:, 0] = np.rint((coord_grid[:, 0] - dx - ulx) / pixel_width)
+        pixel_windows[:, 1] = np.rint(
+            (uly - (coord_grid[:, 1] + dy)) / pixel_height
+        )
 
-    if verify_output and generate_grid_geom:
-        test_extraction(
-            in_rasters,
-            output_blocks,
-            output_geom,
-            samples=verification_samples,
-            grid_layer_index=0,
+        if mask is not None:
+            pixel_windows = pixel_windows[mask]
+
+        # Each raster is verified at its own resolution.
+        for raster_index, raster in enumerate(in_rasters):
+            ratio, raster_size, _raster_offsets = patch_scales[raster_index]
+
+            verify_patches(
+                raster,
+                output_blocks[raster_index],
+                np.rint(pixel_windows * ratio).astype("int64"),
+                raster_size,
+                samples=verification_samples,
+                workers=verification_workers,
+                verbose=verbose,
+            )
+
+    if output_format == "hdf5":
+        # The row of each patch in the full grid, and the offset it belongs to.
+        grid_index = mask if mask is not None else np.arange(output_rows)
+        offset_index = np.searchsorted(offset_rows_cumsum, grid_index, side="right")
+
+        raster_names = [
+            os.path.splitext(os.path.basename(raster))[0] for raster in in_rasters
+        ]
+
+        # Rasters with the same name in different folders would overwrite
+        # each other in the store.
+        raster_names = [
+            f"{name}_{index}" if raster_names.count(name) > 1 else name
+            for index, name in enumerate(raster_names)
+        ]
+
+        store_path = os.path.join(
+            out_dir, f"{prefix}{raster_names[0]}{postfix}.h5"  # type: ignore
+        )
+
+        patches_to_store(
+            dict(zip(raster_names, output_blocks)),
+            store_path,
+            grid_index=grid_index,
+            offset_index=offset_index,
+            offsets=in_offsets,
+            attributes={"size": size},
+            overwrite=overwrite,
             verbose=verbose,
         )
 
+        # The memory maps were only used to assemble the patches.
+        for output_block in output_blocks:
+            if isinstance(output_block, str):
+                os.remove(output_block)
+
+        output_blocks = [store_path]
+
     if len(output_blocks) == 1:
         output_blocks = output_blocks[0]
 
@@ -1035,6 +1900,699 @@ def extract_patches(
 
 
 # TODO: Create input option
+def internal_patch_positions(
+    width: int,
+    height: int,
+    size: int,
+    offsets: List[Tuple[int, int]],
+    generate_border_patches: bool = True,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Lists the (x, y, offset_index) of the top left pixel of each patch, in the
+    same order as iter_patches and extract_patches.
+    """
+    grid = internal_patch_grid(width, height, size, offsets, generate_border_patches)
+
+    positions = []
+    for offset_index, (_offset, x_positions, y_positions) in enumerate(grid):
+        y_grid, x_grid = np.meshgrid(y_positions, x_positions, indexing="ij")
+
+        positions.append(
+            np.stack(
+                [
+                    x_grid.ravel(),
+                    y_grid.ravel(),
+                    np.full(x_grid.size, offset_index, dtype="int64"),
+                ],
+                axis=1,
+            )
+        )
+
+    if len(positions) == 0:
+        return np.empty((0, 3), dtype="int64")
+
+    return np.concatenate(positions).astype("int64")
+
+
+def internal_array_to_patches(
+    array: np.ndarray,
+    size: int,
+    offsets: List[Tuple[int, int]],
+    generate_border_patches: bool = True,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """OBS: INTERNAL: Single output.
+
+    Cuts an array (height, width, channels) into patches, in the same order as
+    iter_patches. Returns a tuple of (patches, positions), where positions are
+    (x, y, offset_index) of the top left pixel of each patch.
+    """
+    positions = internal_patch_positions(
+        array.shape[1], array.shape[0], size, offsets, generate_border_patches
+    )
+
+    patches = np.empty(
+        (positions.shape[0], size, size, array.shape[2]), dtype=array.dtype
+    )
+
+    for index, (x, y, _offset_index) in enumerate(positions):
+        patches[index] = array[y : y + size, x : x + size]
+
+    return (patches, positions)
+
+
+def internal_merge_method(merge_method: str) -> str:
+    """OBS: INTERNAL: Single output.
+
+    Normalises the aliases of a merge_method.
+    """
+    aliases = {
+        "median": "median",
+        "mean": "mean",
+        "average": "mean",
+        "min": "min",
+        "minumum": "min",
+        "minimum": "min",
+        "max": "max",
+        "maximum": "max",
+        "mode": "mode",
+        "majority": "mode",
+        "cosine": "cosine",
+        "weighted": "cosine",
+        "feather": "cosine",
+        "pyramid": "pyramid",
+    }
+
+    if merge_method not in aliases:
+        raise ValueError(f"Unable to parse merge_method: {merge_method}")
+
+    return aliases[merge_method]
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def internal_accumulate_pass(accumulator, count, layer, method):
+    """OBS: INTERNAL: Single output.
+
+    Folds a flat pass into a running sum (method 0), minimum (1) or maximum (2).
+    NaN values are skipped and the valid values are counted.
+    """
+    for index in prange(layer.shape[0]):
+        value = layer[index]
+
+        if np.isnan(value):
+            continue
+
+        if count[index] == 0:
+            accumulator[index] = value
+        elif method == 0:
+            accumulator[index] += value
+        elif method == 1:
+            accumulator[index] = min(accumulator[index], value)
+        else:
+            accumulator[index] = max(accumulator[index], value)
+
+        count[index] += 1
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def internal_reduce_passes(stack, mode):
+    """OBS: INTERNAL: Single output.
+
+    Reduces flat passes (passes, pixels) to the median, or the mode if mode is
+    True, of each pixel. NaN values are ignored. Ties in the mode are won by
+    the smallest value.
+    """
+    passes = stack.shape[0]
+    pixels = stack.shape[1]
+    chunk = 4096
+
+    result = np.empty(pixels, dtype=stack.dtype)
+
+    for chunk_index in prange((pixels + chunk - 1) // chunk):
+        values = np.empty(passes, dtype=stack.dtype)
+
+        chunk_end = min(pixels, (chunk_index + 1) * chunk)
+
+        for index in range(chunk_index * chunk, chunk_end):
+            valid = 0
+
+            # Insertion sort of the valid values, the passes are few.
+            for pass_index in range(passes):
+                value = stack[pass_index, index]
+
+                if np.isnan(value):
+                    continue
+
+                if mode:
+                    value = np.rint(value)
+
+                position = valid
+                while position > 0 and values[position - 1] > value:
+                    values[position] = values[position - 1]
+                    position -= 1
+
+                values[position] = value
+                valid += 1
+
+            if valid == 0:
+                result[index] = np.nan
+            elif mode:
+                best = values[0]
+                best_count = 0
+                run = 0
+
+                for position in range(valid):
+                    if position > 0 and values[position] == values[position - 1]:
+                        run += 1
+                    else:
+                        run = 1
+
+                    if run > best_count:
+                        best = values[position]
+                        best_count = run
+
+                result[index] = best
+            elif valid % 2 == 1:
+                result[index] = values[valid // 2]
+            else:
+                result[index] = (values[valid // 2 - 1] + values[valid // 2]) / 2
+
+    return result
+
+
+def internal_blend_weights(
+    size: int, window: str = "cosine", epsilon: float = 1e-3
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Creates the (size, size) weights of a patch for blending, highest in the
+    center and falling off towards the edges. The weights never go below
+    epsilon, so pixels only covered by the edge of a patch still get a value.
+    """
+    centers = (np.arange(size, dtype="float64") + 0.5) / size
+
+    if window == "cosine":
+        line = np.sin(np.pi * centers)
+    elif window == "pyramid":
+        line = 1.0 - np.abs(2.0 * centers - 1.0)
+    else:
+        raise ValueError(f"Unable to parse blend window: {window}")
+
+    line = np.maximum(line, epsilon)
+
+    return np.outer(line, line).astype("float32")
+
+
+@jit(nopython=True, parallel=True, nogil=True)
+def internal_accumulate_weighted(values, weight_sum, patches, positions, weights):
+    """OBS: INTERNAL: Single output.
+
+    Adds the weighted patches to values at their positions (x, y) and adds the
+    weights to weight_sum. NaN values are skipped.
+    """
+    size = patches.shape[1]
+    channels = patches.shape[3]
+
+    # The patches overlap, so they are added one at a time.
+    for index in range(patches.shape[0]):
+        x = positions[index, 0]
+        y = positions[index, 1]
+
+        for row in prange(size):
+            for column in range(size):
+                weight = weights[row, column]
+
+                for channel in range(channels):
+                    value = patches[index, row, column, channel]
+
+                    if np.isnan(value):
+                        continue
+
+                    values[y + row, x + column, channel] += value * weight
+                    weight_sum[y + row, x + column, channel] += weight
+
+
+def internal_merge_passes(passes: np.ndarray, merge_method: str) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Merges a stack of passes (passes, height, width, channels) along the first
+    axis. NaN values are ignored. The passes have no patch positions, so the
+    weighted merge methods are merged with the mean.
+    """
+    merge_method = internal_merge_method(merge_method)
+
+    if merge_method in ["cosine", "pyramid"]:
+        merge_method = "mean"
+
+    if merge_method in ["median", "mode"]:
+        flat = np.ascontiguousarray(passes).reshape(passes.shape[0], -1)
+        merged = internal_reduce_passes(flat, merge_method == "mode")
+
+        return merged.reshape(passes.shape[1:])
+
+    accumulator = internal_merge_accumulator(passes.shape[1:], passes.dtype)
+
+    for layer in passes:
+        internal_accumulate_layer(accumulator, layer, merge_method)
+
+    return internal_finish_accumulator(accumulator, merge_method)
+
+
+def internal_merge_accumulator(
+    shape: Tuple[int, ...], dtype: Any
+) -> Tuple[np.ndarray, np.ndarray]:
+    """OBS: INTERNAL: Single output.
+
+    Creates a (values, count) accumulator for the running merge methods.
+    """
+    return (np.zeros(shape, dtype=dtype), np.zeros(shape, dtype="uint16"))
+
+
+def internal_accumulate_layer(
+    accumulator: Tuple[np.ndarray, np.ndarray],
+    layer: np.ndarray,
+    merge_method: str,
+) -> None:
+    """OBS: INTERNAL: Single output.
+
+    Folds a pass into an accumulator with the mean, min or max merge_method.
+    """
+    values, count = accumulator
+    method = ["mean", "min", "max"].index(merge_method)
+
+    internal_accumulate_pass(
+        values.reshape(-1),
+        count.reshape(-1),
+        np.ascontiguousarray(layer, dtype=values.dtype).reshape(-1),
+        method,
+    )
+
+
+def internal_finish_accumulator(
+    accumulator: Tuple[np.ndarray, np.ndarray],
+    merge_method: str,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Turns an accumulator into the merged values. Pixels without values are NaN.
+    """
+    values, count = accumulator
+
+    if merge_method == "mean":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = values / count
+
+    values[count == 0] = np.nan
+
+    return values
+
+
+def internal_patches_to_array(
+    patches: np.ndarray,
+    positions: np.ndarray,
+    height: int,
+    width: int,
+    passes: int,
+    merge_method: str = "median",
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Places patches at their positions (x, y, offset_index) and merges the
+    overlapping offsets with merge_method. Pixels not covered by any patch
+    are NaN. Mean, min and max are accumulated one pass at a time. Median and
+    mode are merged in strips of rows, so at most MERGE_BUFFER_BYTES of passes
+    are held in memory. Cosine and pyramid blend every patch with weights that
+    fall off towards its edges, divided by the summed weights.
+    """
+    size = patches.shape[1]
+    channels = patches.shape[3]
+    dtype = np.result_type(patches.dtype, np.float32)
+
+    merge_method = internal_merge_method(merge_method)
+
+    if merge_method in ["cosine", "pyramid"]:
+        values = np.zeros((height, width, channels), dtype=dtype)
+        weight_sum = np.zeros((height, width, channels), dtype=dtype)
+
+        internal_accumulate_weighted(
+            values,
+            weight_sum,
+            patches if patches.dtype == dtype else patches.astype(dtype),
+            np.ascontiguousarray(positions[:, :2]),
+            internal_blend_weights(size, merge_method).astype(dtype),
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = values / weight_sum
+
+        values[weight_sum == 0] = np.nan
+
+        return values
+
+    # Later patches overwrite earlier ones, like the border patches in
+    # reconstitute_raster.
+    if passes == 1 or merge_method in ["mean", "min", "max"]:
+        layer = np.empty((height, width, channels), dtype=dtype)
+        accumulator = None
+
+        for pass_index in range(passes):
+            layer.fill(np.nan)
+
+            for index in np.nonzero(positions[:, 2] == pass_index)[0]:
+                x, y, _pass_index = positions[index]
+                layer[y : y + size, x : x + size] = patches[index]
+
+            if passes == 1:
+                return layer
+
+            if accumulator is None:
+                accumulator = internal_merge_accumulator(layer.shape, dtype)
+
+            internal_accumulate_layer(accumulator, layer, merge_method)
+
+        return internal_finish_accumulator(accumulator, merge_method)
+
+    merged = np.empty((height, width, channels), dtype=dtype)
+
+    row_bytes = passes * width * channels * np.dtype(dtype).itemsize
+    rows = max(1, MERGE_BUFFER_BYTES // max(row_bytes, 1))
+
+    stack = np.empty((passes, min(rows, height), width, channels), dtype=dtype)
+
+    y_positions = positions[:, 1]
+
+    for row_start in range(0, height, rows):
+        row_end = min(row_start + rows, height)
+        strip = stack[:, : row_end - row_start]
+        strip.fill(np.nan)
+
+        in_strip = (y_positions < row_end) & (y_positions + size > row_start)
+
+        for index in np.nonzero(in_strip)[0]:
+            x, y, pass_index = positions[index]
+
+            top = max(y, row_start)
+            bottom = min(y + size, row_end)
+
+            strip[
+                pass_index, top - row_start : bottom - row_start, x : x + size
+            ] = patches[index, top - y : bottom - y]
+
+        merged[row_start:row_end] = internal_merge_passes(strip, merge_method)
+
+    return merged
+
+
+def internal_tta_transforms(
+    mirror: bool = False, rotate: bool = False
+) -> List[Tuple[bool, int]]:
+    """OBS: INTERNAL: Single output.
+
+    Lists the (mirror, rotations) test time augmentations. The first is always
+    the identity.
+    """
+    flips = [False, True] if mirror else [False]
+    rotations = [0, 1, 2, 3] if rotate else [0]
+
+    return [(flip, rotation) for flip in flips for rotation in rotations]
+
+
+def internal_tta_apply(array: np.ndarray, flip: bool, rotations: int) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Mirrors and rotates a batch (patches, height, width, channels) as a view.
+    """
+    view = array[:, :, ::-1] if flip else array
+
+    return np.rot90(view, rotations, axes=(1, 2))
+
+
+def internal_tta_invert(array: np.ndarray, flip: bool, rotations: int) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Reverts internal_tta_apply on a batch, as a view.
+    """
+    view = np.rot90(array, -rotations, axes=(1, 2))
+
+    return view[:, :, ::-1] if flip else view
+
+
+def internal_predict_batch(
+    model,
+    batch: Union[np.ndarray, List[np.ndarray]],
+    predictions: np.ndarray,
+    transforms: List[Tuple[bool, int]] = [(False, 0)],
+    batch_size: int = 16,
+) -> None:
+    """OBS: INTERNAL: Single output.
+
+    Predicts a batch (or list of batches for multi input models) into
+    predictions. With test time augmentation, the transformed patches are
+    predicted together in batches of batch_size, and the inverted outputs are
+    averaged into predictions in place.
+    """
+    if len(transforms) == 1 and transforms[0] == (False, 0):
+        predictions[:] = model.predict_on_batch(batch)
+        return
+
+    inputs = batch if isinstance(batch, list) else [batch]
+    count = inputs[0].shape[0]
+    chunk = max(1, batch_size // len(transforms))
+
+    for start in range(0, count, chunk):
+        end = min(start + chunk, count)
+        length = end - start
+
+        augmented = [
+            np.concatenate(
+                [
+                    internal_tta_apply(array[start:end], flip, rotations)
+                    for flip, rotations in transforms
+                ]
+            )
+            for array in inputs
+        ]
+
+        output = np.asarray(
+            model.predict_on_batch(
+                augmented if isinstance(batch, list) else augmented[0]
+            )
+        )
+
+        target = predictions[start:end]
+        target[:] = 0
+
+        for index, (flip, rotations) in enumerate(transforms):
+            target += internal_tta_invert(
+                output[index * length : (index + 1) * length], flip, rotations
+            )
+
+        target /= len(transforms)
+
+
+def internal_predict_raster_tiled(
+    model,
+    raster: Union[str, gdal.Dataset],
+    out_path: Optional[str],
+    offsets: List[Tuple[int, int]],
+    src_tile_size: int,
+    dst_tile_size: int,
+    channels: int,
+    merge_method: str = "median",
+    dtype: Optional[str] = "same",
+    batch_size: int = 16,
+    tile_size: int = 2048,
+    device: str = "gpu",
+    overwrite: bool = True,
+    creation_options: List[str] = [],
+    prefetch_depth: int = 2,
+    read_workers: int = 1,
+    transforms: List[Tuple[bool, int]] = [(False, 0)],
+    verbose: int = 1,
+) -> str:
+    """OBS: INTERNAL: Single output.
+
+    Predicts a raster in overlapping windows with a single input model. Each
+    window is patched, predicted and merged, and its core is written to the
+    output before moving on, so memory use does not depend on the size of the
+    raster. The windows overlap by a patch and start on the patch grid, so the
+    cores are identical to predicting the whole raster at once.
+
+    The windows are read and patched by read_workers threads, up to
+    prefetch_depth windows ahead of the model, and merged and written by a
+    writer thread, so I/O overlaps with inference.
+    """
+    import tensorflow as tf
+
+    metadata = internal_raster_to_metadata(raster)
+
+    width = metadata["width"]
+    height = metadata["height"]
+    scale = dst_tile_size / src_tile_size
+
+    out_width = round(width * scale)
+    out_height = round(height * scale)
+
+    if dtype == "same":
+        out_dtype = metadata["datatype"]
+    elif dtype is None:
+        out_dtype = "float32"
+    else:
+        out_dtype = dtype
+
+    in_offsets = internal_patch_offsets(offsets, True)
+
+    for offset in in_offsets:
+        if offset[0] >= src_tile_size or offset[1] >= src_tile_size:
+            raise ValueError(
+                f"Offsets must be smaller than the patch size in tiled mode: {offset}"
+            )
+
+    # Parse the driver
+    driver_name = "GTiff" if out_path is None else path_to_driver(out_path)
+    driver = gdal.GetDriverByName(driver_name)
+    if driver is None:
+        raise ValueError(f"Unable to parse filetype from path: {out_path}")
+
+    if out_path is None:
+        output_name = f"/vsimem/predicted_{uuid4().int}.tif"
+    else:
+        output_name = out_path
+
+    overwrite_required(out_path, overwrite)
+    remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(output_name)
+
+    destination = driver.Create(
+        output_name,
+        out_width,
+        out_height,
+        channels,
+        numpy_to_gdal_datatype(out_dtype),
+        default_options(creation_options),
+    )
+
+    transform = list(metadata["transform"])
+    transform[1] = transform[1] / scale
+    transform[5] = transform[5] / scale
+
+    destination.SetProjection(metadata["projection"])
+    destination.SetGeoTransform(transform)
+
+    dst_bands = [destination.GetRasterBand(band + 1) for band in range(channels)]
+
+    block = ceil(tile_size / src_tile_size) * src_tile_size
+    windows = internal_block_windows(width, height, block, block, src_tile_size)
+
+    # MEM datasets are read by a single reader. Paths are opened once per
+    # reader thread, for the duration of the prediction.
+    read_raster, _in_memory = internal_shareable_source(raster)
+    if isinstance(read_raster, gdal.Dataset):
+        read_workers = 1
+
+    handles = local()
+
+    def read_window(window_and_core):
+        window, core = window_and_core
+
+        if isinstance(read_raster, gdal.Dataset):
+            dataset = read_raster
+        else:
+            dataset = internal_open_thread_dataset(read_raster, handles)
+
+        # Read directly from the bands, so no copy of the raster is made.
+        bands = [
+            dataset.GetRasterBand(band + 1) for band in range(dataset.RasterCount)
+        ]
+        dtype = np.result_type(
+            *[gdal_to_numpy_datatype(band.DataType) for band in bands]
+        )
+
+        array = np.empty((window[3], window[2], len(bands)), dtype=dtype)
+        internal_read_bands(bands, window, array)
+
+        patches, positions = internal_array_to_patches(
+            array, src_tile_size, in_offsets
+        )
+
+        return window, core, patches, positions
+
+    def write_window(window_and_predictions):
+        window, core, predictions, positions = window_and_predictions
+
+        positions[:, :2] = np.rint(positions[:, :2] * scale)
+
+        merged = internal_patches_to_array(
+            predictions,
+            positions,
+            round(window[3] * scale),
+            round(window[2] * scale),
+            len(in_offsets),
+            merge_method,
+        )
+
+        # Only the core of the window is written.
+        x_start = round(core[0] * scale)
+        y_start = round(core[1] * scale)
+        x_end = round((core[0] + core[2]) * scale)
+        y_end = round((core[1] + core[3]) * scale)
+
+        x_local = x_start - round(window[0] * scale)
+        y_local = y_start - round(window[1] * scale)
+
+        core_array = merged[
+            y_local : y_local + (y_end - y_start),
+            x_local : x_local + (x_end - x_start),
+        ]
+
+        for index, dst_band in enumerate(dst_bands):
+            dst_band.WriteArray(
+                core_array[:, :, index].astype(out_dtype), x_start, y_start
+            )
+
+    device_context = tf.device("/cpu:0") if device == "cpu" else nullcontext()
+
+    read_windows = threaded_map(
+        read_window,
+        windows,
+        workers=read_workers,
+        depth=max(prefetch_depth, read_workers),
+    )
+
+    with BackgroundWorker(write_window, depth=prefetch_depth) as writer:
+        for window_index, (window, core, patches, positions) in enumerate(
+            read_windows
+        ):
+            if verbose == 1:
+                progress(window_index, len(windows), "Predicting")
+
+            predictions = np.empty(
+                (patches.shape[0], dst_tile_size, dst_tile_size, channels),
+                dtype="float32",
+            )
+
+            with device_context:
+                for start in range(0, patches.shape[0], batch_size):
+                    internal_predict_batch(
+                        model,
+                        patches[start : start + batch_size],
+                        predictions[start : start + batch_size],
+                        transforms,
+                        batch_size,
+                    )
+
+            patches = None
+            writer.put((window, core, predictions, positions))
+
+    if verbose == 1:
+        progress(len(windows), len(windows), "Predicting")
+
+    destination.FlushCache()
+    destination = None
+
+    return output_name
+
+
 def predict_raster(
     raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
     model: str,
@@ -1051,6 +2609,10 @@ def predict_raster(
     batch_size: int = 16,
     overwrite: bool = True,
     creation_options: List[str] = [],
+    tiled: bool = False,
+    tile_size: int = 2048,
+    prefetch_depth: int = 2,
+    read_workers: int = 1,
     verbose: int = 1,
 ) -> str:
     """Runs a raster or list of rasters through a deep learning network (Tensorflow).
@@ -1074,11 +2636,17 @@ def predict_raster(
         device (str): Either CPU or GPU to use with tensorflow.
 
         merge_method (str): How to handle overlapping pixels. Options are:
-        median, average, mode, min, max
+        median, average, mode, min, max, cosine, pyramid. Cosine and pyramid
+        blend the overlapping patches with weights that fall off towards the
+        edges of each patch, so a single overlapping offset gives seamless
+        output.
 
-        mirror (bool): Mirror the raster and do predictions as well.
+        mirror (bool): Mirror the raster and do predictions as well. The
+        predictions are mirrored back and averaged.
 
-        rotate (bool): rotate the raster and do predictions as well.
+        rotate (bool): rotate the raster and do predictions as well. The
+        predictions are rotated back and averaged. Combined with mirror, all
+        8 flips and rotations are used.
 
         dtype (str | None): The dtype of the output. If None: Float32, "save"
         is the same as the input raster. Otherwise overwrite dtype.
@@ -1087,6 +2655,21 @@ def predict_raster(
 
         creation_options: Extra creation options for the output raster.
 
+        tiled (bool): Predict the raster in overlapping windows of tile_size
+        pixels, writing each window to the output before moving on. Memory use
+        is constant regardless of the size of the raster. Only single input
+        models are supported, and offsets must be smaller than the patch size.
+
+        tile_size (int): The size in pixels of the windows used if tiled.
+
+        prefetch_depth (int): How many batches (or windows if tiled) are read
+        and patched ahead of the model in background threads, so reading and
+        inference overlap.
+
+        read_workers (int): The amount of threads reading and patching windows
+        if tiled. The merging and writing of the windows happens in a separate
+        writer thread.
+
         verbose (int): If 1 will output messages on progress.
 
     Returns:
@@ -1106,10 +2689,16 @@ def predict_raster(
     type_check(batch_size, [int], "batch_size")
     type_check(overwrite, [bool], "overwrite")
     type_check(creation_options, [list], "creation_options")
+    type_check(tiled, [bool], "tiled")
+    type_check(tile_size, [int], "tile_size")
+    type_check(prefetch_depth, [int], "prefetch_depth")
+    type_check(read_workers, [int], "read_workers")
     type_check(verbose, [int], "verbose")
 
-    if mirror or rotate:
-        raise Exception("Mirror and rotate currently disabled.")
+    if prefetch_depth < 1 or read_workers < 1:
+        raise ValueError("prefetch_depth and read_workers must be 1 or above.")
+
+    transforms = internal_tta_transforms(mirror, rotate)
 
     import tensorflow as tf
 
@@ -1149,6 +2738,9 @@ def predict_raster(
 
         multi_input = True
 
+    if tiled and multi_input:
+        raise ValueError("Tiled prediction only supports single input models.")
+
     model_inputs = (
         model_loaded.input
         if isinstance(model_loaded.input, list)
@@ -1210,77 +2802,83 @@ def predict_raster(
         if region is not None:
             use_raster = clip_raster(use_raster, region)
 
-        blocks, _ = extract_patches(
-            use_raster,
-            size=src_tile_size,
-            offsets=in_offsets,
-            generate_border_patches=True,
-            generate_grid_geom=False,
-            verbose=verbose,
+        # The patches are generated on the fly while predicting.
+        readied_inputs.append(
+            (
+                use_raster,
+                count_patches(use_raster, size=src_tile_size, offsets=in_offsets),
+                iter_patches(
+                    use_raster,
+                    size=src_tile_size,
+                    offsets=in_offsets,
+                    generate_border_patches=True,
+                    batch_size=batch_size,
+                ),
+            )
         )
 
-        readied_inputs.append(blocks)
+    if tiled:
+        return internal_predict_raster_tiled(
+            model_loaded,
+            readied_inputs[0][0],
+            out_path,
+            in_offsets,  # type: ignore
+            src_tile_size,
+            dst_tile_size,
+            shape_output[3],
+            merge_method=merge_method,
+            dtype=dtype,
+            batch_size=batch_size,
+            tile_size=tile_size,
+            device=device,
+            overwrite=overwrite,
+            creation_options=creation_options,
+            prefetch_depth=prefetch_depth,
+            read_workers=read_workers,
+            transforms=transforms,
+            verbose=verbose,
+        )
 
-    first_len = None
-    for index, readied in enumerate(readied_inputs):
-        if index == 0:
-            first_len = readied.shape[0]
-        else:
-            if readied.shape[0] != first_len:
-                raise ValueError(
-                    "Length of inputs do not match. Have you set the offsets in the correct order?"
-                )
+    for readied in readied_inputs:
+        if readied[1] != readied_inputs[0][1]:
+            raise ValueError(
+                "Length of inputs do not match. Have you set the offsets in the correct order?"
+            )
 
     if verbose == 1:
         print("Predicting raster.")
 
     start = 0
-    end = readied_inputs[0].shape[0]
+    end = readied_inputs[0][1]
 
     predictions = np.empty(
         (end, dst_tile_size, dst_tile_size, shape_output[3]), dtype="float32"
     )
 
-    if multi_input is False:
-        if device == "cpu":
-            with tf.device("/cpu:0"):
-                while start < end:
-                    predictions[
-                        start : start + batch_size
-                    ] = model_loaded.predict_on_batch(
-                        readied_inputs[0][start : start + batch_size]
-                    )
-                    start += batch_size
-                    progress(start, end - 1, "Predicting")
-        else:
-            while start < end:
-                predictions[start : start + batch_size] = model_loaded.predict_on_batch(
-                    readied_inputs[0][start : start + batch_size]
-                )
-                start += batch_size
-                progress(start, end - 1, "Predicting")
-    else:
-        if device == "cpu":
-            with tf.device("/cpu:0"):
-                while start < end:
-                    batch = []
-                    for i in range(len(readied_inputs)):
-                        batch.append(readied_inputs[i][start : start + batch_size])
-                    predictions[
-                        start : start + batch_size
-                    ] = model_loaded.predict_on_batch(batch)
-                    start += batch_size
-                    progress(start, end - 1, "Predicting")
-        else:
-            while start < end:
-                batch = []
-                for i in range(len(readied_inputs)):
-                    batch.append(readied_inputs[i][start : start + batch_size])
-                predictions[start : start + batch_size] = model_loaded.predict_on_batch(
-                    batch
-                )
-                start += batch_size
-                progress(start, end - 1, "Predicting")
+    device_context = tf.device("/cpu:0") if device == "cpu" else nullcontext()
+
+    # The batches are read and patched in a background thread while predicting.
+    batch_queue = prefetch(
+        zip(*[readied[2] for readied in readied_inputs]), depth=prefetch_depth
+    )
+
+    with device_context:
+        for batches in batch_queue:
+            batch = list(batches) if multi_input else batches[0]
+            batch_length = batches[0].shape[0]
+
+            internal_predict_batch(
+                model_loaded,
+                batch,
+                predictions[start : start + batch_length],
+                transforms,
+                batch_size,
+            )
+            start += batch_length
+
+            if verbose == 1:
+                progress(start, end, "Predicting")
+
     print("")
     print("Reconstituting Raster.")
 
@@ -1324,23 +2922,10 @@ def predict_raster(
     if verbose == 1:
         print("Merging rasters.")
 
-    if merge_method == "median":
-        predicted = np.median(prediction_arr, axis=0)
-    elif merge_method == "mean" or merge_method == "average":
-        predicted = np.mean(prediction_arr, axis=0)
-    elif merge_method == "min" or merge_method == "minumum":
-        predicted = np.min(prediction_arr, axis=0)
-    elif merge_method == "max" or merge_method == "maximum":
-        predicted = np.max(prediction_arr, axis=0)
-    elif merge_method == "mode" or merge_method == "majority":
-        for index, _ in enumerate(prediction_arr):
-            prediction_arr[index] = np.rint(prediction_arr[index]).astype(int)
-
-        predicted = np.apply_along_axis(
-            lambda x: np.bincount(x).argmax(), axis=0, arr=prediction_arr
-        )
+    if len(prediction_arr) == 1:
+        predicted = prediction_arr[0]
     else:
-        raise ValueError(f"Unable to parse merge_method: {merge_method}")
+        predicted = internal_merge_passes(np.stack(prediction_arr), merge_method)
 
     if dtype == "same":
         predicted = array_to_raster(
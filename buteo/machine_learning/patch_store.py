@@ -0,0 +1,290 @@
+import sys
+
+sys.path.append("../../")
+import numpy as np
+import os
+
+from typing import Dict, Union, Optional, Tuple, List
+from buteo.utils import overwrite_required, remove_if_overwrite, progress, type_check
+
+
+def internal_load_patches(patches: Union[str, np.ndarray]) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Opens patches saved as .npy as a memory map, so they are never loaded whole.
+    """
+    if isinstance(patches, str):
+        if not os.path.exists(patches):
+            raise ValueError(f"Numpy array does not exist: {patches}")
+
+        return np.load(patches, mmap_mode="r")
+
+    return patches
+
+
+def patches_to_store(
+    patches: Dict[str, Union[str, np.ndarray]],
+    out_path: str,
+    grid_index: Optional[np.ndarray] = None,
+    offset_index: Optional[np.ndarray] = None,
+    offsets: Optional[List[Tuple[int, int]]] = None,
+    chunk_patches: int = 256,
+    compression: Optional[str] = "gzip",
+    compression_level: int = 4,
+    attributes: Dict[str, Union[str, int, float]] = {},
+    overwrite: bool = True,
+    verbose: int = 1,
+) -> str:
+    """Writes patches to a chunked, compressed HDF5 patch store. Each array of
+        patches is a dataset chunked along the patches, so any chunk can be
+        read without reading the rest of the store.
+    Args:
+        patches (dict): The patches to store. The keys are the names of the
+        datasets and the values are arrays or paths to .npy files with the shape
+        (patches, height, width, channels). All must have the same amount of
+        patches, but can be of different sizes.
+
+        out_path (str): The path of the store, eg. patches.h5.
+
+    **kwargs:
+        grid_index (ndarray | None): The index of each patch in the grid it was
+        extracted from. Stored as the dataset "grid_index". The fid of each
+        patch in the grid geometry is stored as "fid".
+
+        offset_index (ndarray | None): The index of the offset each patch was
+        extracted with. Stored as the dataset "offset_index".
+
+        offsets (list | None): The offsets used. Stored as an attribute.
+
+        chunk_patches (int): The amount of patches in each chunk.
+
+        compression (str | None): gzip, lzf or None.
+
+        compression_level (int): The gzip compression level (0-9).
+
+        attributes (dict): Extra attributes saved on the store.
+
+        overwrite (bool): Overwrite the store if it exists.
+
+        verbose (int): If 1 will output messages on progress.
+
+    Returns:
+        The path to the store.
+    """
+    type_check(patches, [dict], "patches")
+    type_check(out_path, [str], "out_path")
+    type_check(grid_index, [np.ndarray], "grid_index", allow_none=True)
+    type_check(offset_index, [np.ndarray], "offset_index", allow_none=True)
+    type_check(offsets, [list], "offsets", allow_none=True)
+    type_check(chunk_patches, [int], "chunk_patches")
+    type_check(compression, [str], "compression", allow_none=True)
+    type_check(compression_level, [int], "compression_level")
+    type_check(attributes, [dict], "attributes")
+    type_check(overwrite, [bool], "overwrite")
+    type_check(verbose, [int], "verbose")
+
+    import h5py
+
+    if len(patches) == 0:
+        raise ValueError("No patches to store.")
+
+    if compression not in [None, "gzip", "lzf"]:
+        raise ValueError(f"Unable to parse compression: {compression}")
+
+    arrays = {name: internal_load_patches(value) for name, value in patches.items()}
+
+    patch_count = None
+    for name, array in arrays.items():
+        if array.ndim != 4:
+            raise ValueError(f"Patches must be 4 dimensional: {name} {array.shape}")
+
+        if patch_count is None:
+            patch_count = array.shape[0]
+        elif array.shape[0] != patch_count:
+            raise ValueError(f"The amount of patches do not match: {name}")
+
+    overwrite_required(out_path, overwrite)
+    remove_if_overwrite(out_path, overwrite)
+
+    options = {}
+    if compression is not None:
+        options["compression"] = compression
+        options["shuffle"] = True
+
+        if compression == "gzip":
+            options["compression_opts"] = compression_level
+
+    chunk = max(1, min(chunk_patches, patch_count))
+
+    with h5py.File(out_path, "w") as store:
+        store.attrs["datasets"] = list(arrays.keys())
+        store.attrs["patch_count"] = patch_count
+        store.attrs["chunk_patches"] = chunk
+
+        if offsets is not None:
+            store.attrs["offsets"] = np.array(offsets, dtype="int64").reshape(-1, 2)
+
+        for key, value in attributes.items():
+            store.attrs[key] = value
+
+        store.create_dataset("fid", data=np.arange(patch_count, dtype="int64"))
+
+        if grid_index is not None:
+            store.create_dataset("grid_index", data=grid_index.astype("int64"))
+
+        if offset_index is not None:
+            store.create_dataset("offset_index", data=offset_index.astype("int64"))
+
+        steps = len(arrays) * ((patch_count + chunk - 1) // chunk)
+        step = 0
+
+        for name, array in arrays.items():
+            dataset = store.create_dataset(
+                name,
+                shape=array.shape,
+                dtype=array.dtype,
+                chunks=(chunk,) + array.shape[1:],
+                **options,
+            )
+
+            dataset.attrs["size"] = array.shape[1]
+
+            # Whole chunks are written at a time, so each is compressed once.
+            for start in range(0, patch_count, chunk):
+                if verbose == 1:
+                    progress(step, steps, "Writing store")
+
+                dataset[start : start + chunk] = array[start : start + chunk]
+                step += 1
+
+    if verbose == 1:
+        progress(steps, steps, "Writing store")
+
+    return out_path
+
+
+def read_patches(
+    store: str,
+    indices: Union[List[int], np.ndarray],
+    datasets: Optional[List[str]] = None,
+) -> Union[np.ndarray, List[np.ndarray]]:
+    """Reads patches by index from a patch store. Only the chunks holding the
+        patches are read.
+    Args:
+        store (str): The path to the patch store.
+
+        indices (list | ndarray): The indices of the patches to read.
+
+    **kwargs:
+        datasets (list | None): The datasets to read. If None, all the patch
+        datasets are read.
+
+    Returns:
+        An array of patches in the order of indices, or a list of arrays if more
+        than one dataset is read.
+    """
+    type_check(store, [str], "store")
+    type_check(indices, [list, np.ndarray], "indices")
+    type_check(datasets, [list], "datasets", allow_none=True)
+
+    import h5py
+
+    indices = np.asarray(indices, dtype="int64")
+
+    # HDF5 reads need increasing, unique indices.
+    unique, inverse = np.unique(indices, return_inverse=True)
+
+    with h5py.File(store, "r") as opened:
+        names = list(opened.attrs["datasets"]) if datasets is None else datasets
+
+        read = [opened[name][unique][inverse] for name in names]
+
+    return read[0] if len(read) == 1 else read
+
+
+def read_patch_batches(
+    store: str,
+    datasets: Optional[List[str]] = None,
+    batch_size: int = 64,
+    shuffle: bool = True,
+    shuffle_chunks: int = 8,
+    seed: Optional[int] = None,
+):
+    """Reads shuffled batches from a patch store, without loading the store.
+        The chunks are read whole in a random order, shuffle_chunks at a time,
+        and the patches of those chunks are shuffled into batches. Each patch is
+        read once.
+    Args:
+        store (str): The path to the patch store.
+
+    **kwargs:
+        datasets (list | None): The datasets to read. If None, all the patch
+        datasets are read.
+
+        batch_size (int): The amount of patches in each batch. The last batch
+        may be smaller.
+
+        shuffle (bool): Shuffle the patches. If False, the patches are read in
+        order.
+
+        shuffle_chunks (int): The amount of chunks shuffled together. More
+        chunks shuffle better but use more memory.
+
+        seed (int | None): A seed for the shuffle.
+
+    Returns:
+        A generator yielding batches. A batch is an array, or a list of arrays
+        if more than one dataset is read.
+    """
+    type_check(store, [str], "store")
+    type_check(datasets, [list], "datasets", allow_none=True)
+    type_check(batch_size, [int], "batch_size")
+    type_check(shuffle, [bool], "shuffle")
+    type_check(shuffle_chunks, [int], "shuffle_chunks")
+    type_check(seed, [int], "seed", allow_none=True)
+
+    import h5py
+
+    rng = np.random.default_rng(seed)
+
+    with h5py.File(store, "r") as opened:
+        names = list(opened.attrs["datasets"]) if datasets is None else datasets
+        sources = [opened[name] for name in names]
+
+        patch_count = sources[0].shape[0]
+        chunk = sources[0].chunks[0] if sources[0].chunks is not None else batch_size
+
+        chunk_starts = np.arange(0, patch_count, chunk)
+        if shuffle:
+            rng.shuffle(chunk_starts)
+
+        pending: List[List[np.ndarray]] = [[] for _ in names]
+        pending_count = 0
+
+        for group in range(0, chunk_starts.shape[0], max(1, shuffle_chunks)):
+            starts = chunk_starts[group : group + max(1, shuffle_chunks)]
+
+            for index, source in enumerate(sources):
+                pending[index] += [source[start : start + chunk] for start in starts]
+
+            pending_count += sum(min(chunk, patch_count - start) for start in starts)
+
+            merged = [np.concatenate(arrays) for arrays in pending]
+
+            if shuffle:
+                order = rng.permutation(pending_count)
+                merged = [array[order] for array in merged]
+
+            # Leftover patches are shuffled with the next group.
+            full = (pending_count // batch_size) * batch_size
+
+            for start in range(0, full, batch_size):
+                batch = [array[start : start + batch_size] for array in merged]
+                yield batch[0] if len(batch) == 1 else batch
+
+            pending = [[array[full:]] for array in merged]
+            pending_count -= full
+
+        if pending_count > 0:
+            batch = [np.concatenate(arrays) for arrays in pending]
+            yield batch[0] if len(batch) == 1 else batch
@@ -7,6 +7,7 @@ import os
 import numpy as np
 from buteo.raster.io import (
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
     raster_to_metadata,
     rasters_are_aligned,
     ready_io_raster,
@@ -379,6 +380,7 @@ def align_rasters(
 
         # Removes file if it exists and overwrite is True.
         remove_if_overwrite(out_name, overwrite)
+        invalidate_raster_metadata(out_name)
 
         # Hand over to gdal.Warp to do the heavy lifting!
         warped = gdal.Warp(
@@ -3,7 +3,12 @@ import sys
 sys.path.append("../../")
 from osgeo import gdal, ogr
 from typing import Union, List, Optional
-from buteo.raster.io import internal_raster_to_metadata, ready_io_raster, open_raster
+from buteo.raster.io import (
+    internal_raster_to_metadata,
+    invalidate_raster_metadata,
+    ready_io_raster,
+    open_raster,
+)
 from buteo.vector.io import (
     get_vector_path,
     open_vector,
@@ -88,7 +93,6 @@ def internal_clip_raster(
     # Input is a raster (use extent)
     elif is_raster(clip_geom):
         clip_metadata = internal_raster_to_metadata(clip_geom, create_geometry=True)
-        clip_metadata["layer_count"] = 1
         clip_ds = clip_metadata["extent_datasource"].GetName()
     else:
         if file_exists(clip_geom):
@@ -96,7 +100,10 @@ def internal_clip_raster(
         else:
             raise ValueError(f"Unable to locate clip geometry {clip_geom}")
 
-    if layer_to_clip > (clip_metadata["layer_count"] - 1):
+    # Rasters are clipped by their extent, which is a single layer.
+    clip_layer_count = clip_metadata["layer_count"] if clip_metadata["is_vector"] else 1
+
+    if layer_to_clip > (clip_layer_count - 1):
         raise ValueError("Requested an unable layer_to_clip.")
 
     if clip_ds is None:
@@ -104,6 +111,7 @@ def internal_clip_raster(
 
     clip_projection = clip_metadata["projection_osr"]
     clip_extent = clip_metadata["extent"]
+    clip_extent_reprojected = clip_extent
 
     # options
     warp_options = []
@@ -120,8 +128,8 @@ def internal_clip_raster(
 
     # Check if projections match, otherwise reproject target geom.
     if not origin_projection.IsSame(clip_projection):
-        clip_metadata["extent"] = reproject_extent(
-            clip_metadata["extent"],
+        clip_extent_reprojected = reproject_extent(
+            clip_extent,
             clip_projection,
             origin_projection,
         )
@@ -137,7 +145,7 @@ def internal_clip_raster(
         if adjust_bbox:
             output_bounds = align_bbox(
                 raster_metadata["extent"],
-                clip_metadata["extent"],
+                clip_extent_reprojected,
                 raster_metadata["pixel_width"],
                 raster_metadata["pixel_height"],
                 warp_format=True,
@@ -170,6 +178,7 @@ def internal_clip_raster(
 
     # Removes file if it exists and overwrite is True.
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_name)
 
     if verbose == 0:
         gdal.PushErrorHandler("CPLQuietErrorHandler")
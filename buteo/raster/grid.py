@@ -75,7 +75,7 @@ def raster_to_grid(
         use_grid = reproject_vector(grid, raster_metadata["projection_osr"])
         grid_metadata = internal_vector_to_metadata(use_grid)
 
-        if not isinstance(grid_metadata, dict):
+        if isinstance(grid_metadata, list):
             raise Exception("Error while parsing metadata.")
 
     # Only use the polygons in the grid that intersect the extent of the raster.
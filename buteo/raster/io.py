@@ -4,6 +4,9 @@ sys.path.append("../../")
 from uuid import uuid4
 from osgeo import gdal, osr, ogr
 from typing import Dict, Tuple, Union, List, Any, Optional
+from collections import OrderedDict
+from threading import Lock, local
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 import numpy as np
 import os
@@ -21,7 +24,8 @@ from buteo.utils import (
     folder_exists,
 )
 from buteo.gdal_utils import (
-    advanced_extents,
+    LazyExtents,
+    RasterMetadata,
     path_to_driver,
     is_raster,
     numpy_to_gdal_datatype,
@@ -41,6 +45,16 @@ from buteo.gdal_utils import (
 # TODO: delete_raster // clear memory
 
 
+# The maximum amount of metadata entries kept in the cache.
+METADATA_CACHE_SIZE = 512
+
+# The maximum size in bytes of the window buffer used by stack_rasters.
+STACK_BUFFER_BYTES = 268435456
+
+_raster_metadata_cache: "OrderedDict[tuple, RasterMetadata]" = OrderedDict()
+_raster_metadata_cache_lock = Lock()
+
+
 def open_raster(
     raster: Union[str, gdal.Dataset],
     convert_mem_driver: bool = True,
@@ -151,26 +165,112 @@ def to_raster_list(variable: Any) -> List[str]:
     return return_list
 
 
+def internal_raster_cache_key(raster: Union[str, gdal.Dataset]) -> Optional[tuple]:
+    """OBS: Internal. Single output.
+
+    Creates the key used in the metadata cache. Files on disk are keyed by their
+    path, modification time and size. Returns None for rasters that cannot be
+    cached, such as MEM datasets and /vsimem/ files, as GDAL only reports the
+    modification time of /vsimem/ files to the second.
+    """
+    if isinstance(raster, gdal.Dataset):
+        driver = raster.GetDriver()
+        if driver is None or driver.ShortName == "MEM":
+            return None
+
+        path = raster.GetDescription()
+    else:
+        path = raster
+
+    if len(path) >= 8 and path[0:8] == "/vsimem/":
+        return None
+
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def invalidate_raster_metadata(
+    raster: Optional[Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset]] = None,
+) -> None:
+    """Removes rasters from the metadata cache. Called internally whenever buteo
+        writes to a path. Use it if a raster is changed outside of buteo, within
+        the resolution of the filesystem timestamps.
+
+    **kwargs:
+        raster (list | path | Dataset | None): The raster(s) to remove. If None,
+        the whole cache is cleared.
+
+    Returns:
+        None
+    """
+    type_check(raster, [list, str, gdal.Dataset], "raster", allow_none=True)
+
+    with _raster_metadata_cache_lock:
+        if raster is None:
+            _raster_metadata_cache.clear()
+            return None
+
+        rasters = raster if isinstance(raster, list) else [raster]
+
+        paths = []
+        for in_raster in rasters:
+            path = (
+                in_raster.GetDescription()
+                if isinstance(in_raster, gdal.Dataset)
+                else in_raster
+            )
+
+            if path is None:
+                continue
+
+            paths.append(path)
+
+            if not (len(path) >= 8 and path[0:8] == "/vsimem/"):
+                paths.append(os.path.abspath(path))
+
+        for key in list(_raster_metadata_cache.keys()):
+            if key[0] in paths:
+                del _raster_metadata_cache[key]
+
+    return None
+
+
 def internal_raster_to_metadata(
     raster: Union[str, gdal.Dataset],
     create_geometry: bool = False,
 ) -> Metadata_raster:
     """OBS: Internal. Single output.
 
-    Reads a raster from a string or a dataset and returns metadata.
+    Reads a raster from a string or a dataset and returns metadata. The results
+    are cached, see invalidate_raster_metadata. The expanded extent fields
+    (extent_wkt, extent_datasource, extent_geojson, ...) are computed on first
+    access if create_geometry is True, otherwise they are None.
     """
     type_check(raster, [str, gdal.Dataset], "raster")
     type_check(create_geometry, [bool], "create_geometry")
 
+    cache_key = internal_raster_cache_key(raster)
+
+    if cache_key is not None:
+        with _raster_metadata_cache_lock:
+            cached = _raster_metadata_cache.get(cache_key)
+
+            if cached is not None:
+                _raster_metadata_cache.move_to_end(cache_key)
+
+                # The metadata is immutable and hands out copies of its lists
+                # and dictionaries, so the cached object can be shared.
+                return cached.copy(create_geometry)  # type: ignore
+
     dataset = open_raster(raster, convert_mem_driver=False)
 
     raster_driver = dataset.GetDriver()
 
     path: str = dataset.GetDescription()
-    basename: str = os.path.basename(path)
-    name: str = os.path.splitext(basename)[0]
-    ext: str = os.path.splitext(basename)[1]
-
     driver: str = raster_driver.ShortName
 
     in_memory: bool = False
@@ -182,19 +282,11 @@ def internal_raster_to_metadata(
     transform: List[Number] = dataset.GetGeoTransform()
     projection: str = dataset.GetProjection()
 
-    original_projection: osr.SpatialReference = osr.SpatialReference()
-    original_projection.ImportFromWkt(projection)
-    projection_osr: osr.SpatialReference = original_projection
+    projection_osr: osr.SpatialReference = osr.SpatialReference()
+    projection_osr.ImportFromWkt(projection)
 
     width: int = dataset.RasterXSize
     height: int = dataset.RasterYSize
-    band_count: int = dataset.RasterCount
-
-    size: List[int] = [dataset.RasterXSize, dataset.RasterYSize]
-    shape: Tuple[int, int, int] = (width, height, band_count)
-
-    pixel_width: Number = abs(transform[1])
-    pixel_height: Number = abs(transform[5])
 
     x_min: Number = transform[0]
     y_max: Number = transform[3]
@@ -204,98 +296,36 @@ def internal_raster_to_metadata(
 
     band0 = dataset.GetRasterBand(1)
 
-    datatype_gdal_raw: int = band0.DataType
-    datatype_gdal: str = gdal.GetDataTypeName(datatype_gdal_raw)
-
-    datatype: str = gdal_to_numpy_datatype(band0.DataType)
-
-    nodata_value: Optional[Number] = band0.GetNoDataValue()
-    has_nodata = True if nodata_value is not None else False
-
-    extent: List[Number] = [x_min, y_max, x_max, y_min]
-    extent_ogr: List[Number] = [x_min, x_max, y_min, y_max]
-    extent_gdal_warp: List[Number] = [x_min, y_min, x_max, y_max]
-
-    extent_dict: Dict[Any, Number] = {
-        "left": x_min,
-        "top": y_max,
-        "right": x_max,
-        "bottom": y_min,
-    }
-
-    metadata: Metadata_raster = {
-        "path": path,
-        "basename": basename,
-        "name": name,
-        "ext": ext,
-        "transform": transform,
-        "in_memory": in_memory,
-        "projection": projection,
-        "projection_osr": projection_osr,
-        "width": width,
-        "height": height,
-        "band_count": band_count,
-        "driver": driver,
-        "size": size,
-        "shape": shape,
-        "pixel_width": pixel_width,
-        "pixel_height": pixel_height,
-        "x_min": x_min,
-        "y_max": y_max,
-        "x_max": x_max,
-        "y_min": y_min,
-        "datatype": datatype,
-        "datatype_gdal": datatype_gdal,
-        "datatype_gdal_raw": datatype_gdal_raw,
-        "nodata_value": nodata_value,
-        "has_nodata": has_nodata,
-        "is_raster": True,
-        "is_vector": False,
-        "extent": extent,
-        "extent_ogr": extent_ogr,
-        "extent_gdal_warp": extent_gdal_warp,
-        "extent_dict": extent_dict,
-        "extent_wkt": None,
-        "extent_datasource": None,
-        "extent_geom": None,
-        "extent_latlng": None,
-        "extent_gdal_warp_latlng": None,
-        "extent_ogr_latlng": None,
-        "extent_dict_latlng": None,
-        "extent_wkt_latlng": None,
-        "extent_datasource_latlng": None,
-        "extent_geom_latlng": None,
-        "extent_geojson": None,
-        "extent_geojson_dict": None,
-    }
-
-    if create_geometry:
-        extended_extents = advanced_extents(extent_ogr, projection_osr)
-
-        metadata["extent_wkt"] = extended_extents["extent_wkt"]
-        metadata["extent_datasource"] = extended_extents["extent_datasource"]
-        metadata["extent_geom"] = extended_extents["extent_geom"]
-        metadata["extent_latlng"] = extended_extents["extent_latlng"]
-        metadata["extent_gdal_warp_latlng"] = extended_extents[
-            "extent_gdal_warp_latlng"
-        ]
-        metadata["extent_ogr_latlng"] = extended_extents["extent_ogr_latlng"]
-        metadata["extent_dict_latlng"] = extended_extents["extent_dict_latlng"]
-        metadata["extent_wkt_latlng"] = extended_extents["extent_wkt_latlng"]
-        metadata["extent_datasource_latlng"] = extended_extents[
-            "extent_datasource_latlng"
-        ]
-        metadata["extent_geom_latlng"] = extended_extents["extent_geom_latlng"]
-        metadata["extent_geojson"] = extended_extents["extent_geojson"]
-        metadata["extent_geojson_dict"] = extended_extents["extent_geojson_dict"]
+    metadata = RasterMetadata(
+        extents=LazyExtents([x_min, x_max, y_min, y_max], projection_osr),
+        path=path,
+        transform=transform,
+        in_memory=in_memory,
+        projection=projection,
+        projection_osr=projection_osr,
+        width=width,
+        height=height,
+        band_count=dataset.RasterCount,
+        driver=driver,
+        pixel_width=abs(transform[1]),
+        pixel_height=abs(transform[5]),
+        x_min=x_min,
+        y_max=y_max,
+        x_max=x_max,
+        y_min=y_min,
+        datatype=gdal_to_numpy_datatype(band0.DataType),
+        datatype_gdal_raw=band0.DataType,
+        nodata_value=band0.GetNoDataValue(),
+    )
 
-        extent_datasource_layer = metadata["extent_datasource"].GetLayer()
-        extent_datasource_layer.SyncToDisk()
+    if cache_key is not None:
+        with _raster_metadata_cache_lock:
+            _raster_metadata_cache[cache_key] = metadata
 
-        extent_datasource_latlng_layer = metadata["extent_datasource_latlng"].GetLayer()
-        extent_datasource_latlng_layer.SyncToDisk()
+            while len(_raster_metadata_cache) > METADATA_CACHE_SIZE:
+                _raster_metadata_cache.popitem(last=False)
 
-    return metadata
+    return metadata.copy(create_geometry)  # type: ignore
 
 
 def raster_to_metadata(
@@ -538,6 +568,7 @@ def internal_raster_to_memory(
 
         options.append("BIGTIFF=YES")
 
+    invalidate_raster_metadata(raster_name)
     driver.CreateCopy(raster_name, ref, options=options)
 
     return raster_name
@@ -584,6 +615,193 @@ def raster_to_memory(
     return results
 
 
+def internal_extent_to_window(
+    metadata: Metadata_raster,
+    extent: List[Number],
+) -> List[int]:
+    """OBS: INTERNAL: Single output.
+
+    Converts an OGR extent (x_min, x_max, y_min, y_max) to a pixel window on
+    a raster in the format [x_offset, y_offset, x_pixels, y_pixels].
+    """
+    ex_min, ex_max, ey_min, ey_max = extent
+    x_min, x_max, y_min, y_max = metadata["extent_ogr"]
+
+    width = metadata["width"]
+    height = metadata["height"]
+    pixel_width = metadata["pixel_width"]
+    pixel_height = metadata["pixel_height"]
+
+    if ex_min > x_max or ex_max < x_min or ey_min > y_max or ey_max < y_min:
+        raise ValueError("Extent is outside of raster.")
+
+    if ex_min < x_min:
+        x_offset = int(0)
+    else:
+        x_offset = int((ex_min - x_min) // pixel_width)
+
+    if ex_max > x_max:
+        x_pixels = ceil(width - x_offset)
+    else:
+        x_pixels = ceil(int(width) - int(((x_max - ex_max) // pixel_width)) - x_offset)
+
+    if ey_min < y_min:
+        y_offset = int(0)
+    else:
+        y_offset = int((ey_min - y_min) // pixel_height)
+
+    if ey_max > y_max:
+        y_pixels = ceil(height - y_offset)
+    else:
+        y_pixels = ceil(int(height) - int((y_max - ey_max) // pixel_height) - y_offset)
+
+    return [x_offset, y_offset, x_pixels, y_pixels]
+
+
+def internal_read_bands(
+    bands: List[gdal.Band],
+    window: List[int],
+    out: np.ndarray,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Reads a window of a list of bands directly into the channels of a
+    preallocated (height, width, bands) array. No intermediate arrays are created.
+    """
+    x_offset, y_offset, x_pixels, y_pixels = window
+
+    for index, band in enumerate(bands):
+        band.ReadAsArray(
+            x_offset, y_offset, x_pixels, y_pixels, buf_obj=out[:, :, index]
+        )
+
+    return out
+
+
+def internal_open_thread_dataset(path: str, handles: local) -> gdal.Dataset:
+    """OBS: INTERNAL: Single output.
+
+    Opens a read only dataset for the current thread. GDAL datasets must not be
+    shared across threads, so each reader thread keeps its own handles in
+    handles, a threading.local owned by the caller. The handles are closed when
+    the caller drops it, so rewritten files are never read through old handles.
+    """
+    datasets = getattr(handles, "datasets", None)
+
+    if datasets is None:
+        datasets = {}
+        handles.datasets = datasets
+
+    if path not in datasets:
+        dataset = gdal.Open(path, gdal.GA_ReadOnly)
+
+        if dataset is None:
+            raise ValueError(f"Unable to open raster: {path}")
+
+        datasets[path] = dataset
+
+    return datasets[path]
+
+
+def internal_shareable_source(
+    raster: Union[str, gdal.Dataset],
+) -> Tuple[Union[str, gdal.Dataset], bool]:
+    """OBS: INTERNAL: Single output.
+
+    GDAL datasets must not be shared across threads or processes, so workers
+    reopen rasters by path. Returns (source, in_memory), where source is the
+    path of a dataset, after flushing pending writes, or the dataset itself if
+    it is a MEM dataset and can only be read through its own handle. in_memory
+    is True for MEM datasets and /vsimem/ files, as other processes cannot open
+    them.
+    """
+    if isinstance(raster, gdal.Dataset):
+        driver = raster.GetDriver()
+
+        if driver is None or driver.ShortName == "MEM":
+            return raster, True
+
+        raster.FlushCache()
+        raster = raster.GetDescription()
+
+    return raster, len(raster) >= 8 and raster[0:8] == "/vsimem/"
+
+
+def internal_read_bands_threaded(
+    sources: List[Tuple[str, int]],
+    window: List[int],
+    out: np.ndarray,
+    executor: ThreadPoolExecutor,
+    handles: local,
+) -> np.ndarray:
+    """OBS: INTERNAL: Single output.
+
+    Reads a window of a list of (path, band_number) sources concurrently into
+    the channels of a preallocated (height, width, bands) array. GDAL releases
+    the GIL while decoding, so compressed bands are decoded in parallel. The
+    threads keep their datasets in handles, which should live as long as the
+    executor.
+    """
+    x_offset, y_offset, x_pixels, y_pixels = window
+
+    def read_band(index: int) -> None:
+        path, band_number = sources[index]
+        band = internal_open_thread_dataset(path, handles).GetRasterBand(band_number)
+        band.ReadAsArray(
+            x_offset, y_offset, x_pixels, y_pixels, buf_obj=out[:, :, index]
+        )
+
+    # Consume the iterator, so exceptions in the threads are raised here.
+    for _ in executor.map(read_band, range(len(sources))):
+        pass
+
+    return out
+
+
+def internal_band_sources(
+    datasets: List[gdal.Dataset],
+    bands: Union[int, list],
+) -> Optional[List[Tuple[str, int]]]:
+    """OBS: INTERNAL: Single output.
+
+    Lists the (path, band_number) of the bands to read from a list of datasets,
+    so they can be reopened by reader threads. Returns None if a dataset can
+    only be read through its own handle, such as MEM datasets.
+    """
+    sources: List[Tuple[str, int]] = []
+    for dataset in datasets:
+        path, _in_memory = internal_shareable_source(dataset)
+        if isinstance(path, gdal.Dataset):
+            return None
+
+        for band in to_band_list(bands, dataset.RasterCount):
+            sources.append((path, band + 1))
+
+    return sources
+
+
+def internal_mask_nodata(
+    array: np.ndarray,
+    nodata_values: List[Optional[Number]],
+) -> np.ma.MaskedArray:
+    """OBS: INTERNAL: Single output.
+
+    Wraps a (height, width, bands) array in a masked array without copying it.
+    Bands with a nodata value mask that value, float bands without one mask
+    invalid values.
+    """
+    mask = np.zeros(array.shape, dtype=bool)
+    is_float = np.issubdtype(array.dtype, np.floating)
+
+    for index, nodata_value in enumerate(nodata_values):
+        if nodata_value is not None:
+            np.equal(array[:, :, index], nodata_value, out=mask[:, :, index])
+        elif is_float:
+            np.logical_not(np.isfinite(array[:, :, index]), out=mask[:, :, index])
+
+    return np.ma.array(array, mask=mask, fill_value=nodata_values[0], copy=False)
+
+
 def raster_to_array(
     raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
     bands: Union[int, list] = -1,
@@ -591,6 +809,8 @@ def raster_to_array(
     output_2d: bool = False,
     extent: Optional[List[Number]] = None,
     extent_pixels: Optional[List[Number]] = None,
+    out: Optional[np.ndarray] = None,
+    workers: int = 1,
 ) -> np.ndarray:
     """Turns a path to a raster(s) or a GDAL.Dataset(s) into a numpy
         array(s).
@@ -610,6 +830,21 @@ def raster_to_array(
         fashion eg. (1920x1080) instead of the default channel-last format
         (1920x1080x1)
 
+        extent (list | None): Only read the area within this OGR extent.
+        (x_min, x_max, y_min, y_max)
+
+        extent_pixels (list | None): Only read this pixel window.
+        (x_offset, y_offset, x_pixels, y_pixels)
+
+        out (ndarray | None): A preallocated array to read into. Must have the
+        shape of the output (height, width, bands), or (height, width) if
+        output_2d. Useful to reuse a buffer across tiles. Values are cast to
+        the dtype of out.
+
+        workers (int): The amount of threads used to read bands concurrently.
+        Useful for compressed rasters, where decoding is the bottleneck. MEM
+        datasets are always read in a single thread.
+
     Returns:
         A numpy array in the 3D channel-last format unless output_2D is
         specified.
@@ -618,6 +853,13 @@ def raster_to_array(
     type_check(bands, [int, list], "bands")
     type_check(filled, [bool], "filled")
     type_check(output_2d, [bool], "output_2d")
+    type_check(extent, [list, tuple], "extent", allow_none=True)
+    type_check(extent_pixels, [list, tuple], "extent_pixels", allow_none=True)
+    type_check(out, [np.ndarray], "out", allow_none=True)
+    type_check(workers, [int], "workers")
+
+    if workers < 1:
+        raise ValueError(f"workers must be 1 or above. Recieved: {workers}")
 
     internal_rasters = to_raster_list(raster)
 
@@ -626,84 +868,231 @@ def raster_to_array(
             "Cannot merge rasters that are not aligned, have dissimilar extent or dtype."
         )
 
-    layers = []
+    # Keep the datasets referenced while reading from their bands.
+    datasets = []
+    read_bands = []
+    metadata = None
     for in_raster in internal_rasters:
-        ref = open_raster(in_raster)
-
-        metadata = internal_raster_to_metadata(ref)
+        ref = open_raster(in_raster, writeable=False)
+        datasets.append(ref)
 
-        band_count = metadata["band_count"]
-        raster_extent = metadata["extent_ogr"]
-        width = metadata["width"]
-        height = metadata["height"]
-        pixel_width = metadata["pixel_width"]
-        pixel_height = metadata["pixel_height"]
+        if metadata is None:
+            metadata = internal_raster_to_metadata(ref)
 
-        if band_count == 0:
+        if ref.RasterCount == 0:
             raise ValueError("The input raster does not have any valid bands.")
 
-        internal_bands = to_band_list(bands, metadata["band_count"])
+        for band in to_band_list(bands, ref.RasterCount):
+            read_bands.append(ref.GetRasterBand(band + 1))
 
-        for band in internal_bands:
-            band_ref = ref.GetRasterBand(band + 1)
-            band_nodata_value = band_ref.GetNoDataValue()
+    if output_2d:
+        read_bands = read_bands[:1]
 
-            if extent_pixels is not None:
-                arr = band_ref.ReadAsArray(
-                    extent_pixels[0],
-                    extent_pixels[1],
-                    extent_pixels[2],
-                    extent_pixels[3],
-                )
-            elif extent is not None:
-                ex_min, ex_max, ey_min, ey_max = extent
-                x_min, x_max, y_min, y_max = raster_extent
-
-                if ex_min > x_max or ex_max < x_min or ey_min > y_max or ey_max < y_min:
-                    raise ValueError("Extent is outside of raster.")
-
-                if ex_min < x_min:
-                    x_offset = int(0)
-                else:
-                    x_offset = int((ex_min - x_min) // pixel_width)
-
-                if ex_max > x_max:
-                    x_pixels = ceil(width - x_offset)
-                else:
-                    x_pixels = ceil(
-                        int(width) - int(((x_max - ex_max) // pixel_width)) - x_offset
-                    )
+    if extent_pixels is not None:
+        window = [int(value) for value in extent_pixels]
+    elif extent is not None:
+        window = internal_extent_to_window(metadata, extent)
+    else:
+        window = [0, 0, metadata["width"], metadata["height"]]
 
-                if ey_min < y_min:
-                    y_offset = int(0)
-                else:
-                    y_offset = int((ey_min - y_min) // pixel_height)
+    output_shape = (window[3], window[2], len(read_bands))
 
-                if ey_max > y_max:
-                    y_pixels = ceil(height - y_offset)
-                else:
-                    y_pixels = ceil(
-                        int(height) - int((y_max - ey_max) // pixel_height) - y_offset
-                    )
+    if out is None:
+        dtype = np.result_type(
+            *[gdal_to_numpy_datatype(band.DataType) for band in read_bands]
+        )
+        output = np.empty(output_shape, dtype=dtype)
+    else:
+        output = out[:, :, np.newaxis] if out.ndim == 2 else out
 
-                arr = band_ref.ReadAsArray(x_offset, y_offset, x_pixels, y_pixels)
-            else:
-                arr = band_ref.ReadAsArray()
+        if output.shape != output_shape:
+            raise ValueError(
+                f"Shape of out: {out.shape} does not match the output: {output_shape}"
+            )
 
-            if band_nodata_value is None and filled is False:
-                arr = np.ma.masked_invalid(arr)
-            elif filled is False:
-                arr = np.ma.masked_equal(arr, band_nodata_value)
+    sources = None
+    if workers > 1 and len(read_bands) > 1:
+        sources = internal_band_sources(datasets, bands)
 
-            layers.append(arr)
+    if sources is not None:
+        with ThreadPoolExecutor(max_workers=min(workers, len(read_bands))) as executor:
+            internal_read_bands_threaded(sources, window, output, executor, local())
+    else:
+        internal_read_bands(read_bands, window, output)
 
-            if output_2d:
-                break
+    if not filled:
+        output = internal_mask_nodata(
+            output, [band.GetNoDataValue() for band in read_bands]
+        )
 
     if output_2d:
-        return np.dstack(layers)[:, :, 0]
+        return output[:, :, 0]
+
+    return output
+
+
+def internal_block_shape(
+    native_block: List[int],
+    width: int,
+    height: int,
+    block_size: Optional[Union[int, List[int], Tuple[int, int]]] = None,
+    min_pixels: int = 262144,
+) -> Tuple[int, int]:
+    """OBS: INTERNAL: Single output.
+
+    Calculates the (x, y) size of the windows used when iterating a raster. The
+    windows are multiples of the native block layout of the raster, so each read
+    touches whole GTiff tiles or strips.
+    """
+    native_x = max(1, min(int(native_block[0]), width))
+    native_y = max(1, min(int(native_block[1]), height))
+
+    if block_size is None:
+        block_x = native_x
+        block_y = native_y
+
+        # Strip layouts are often a single row. Group them into larger windows.
+        if block_x * block_y < min_pixels:
+            block_y = native_y * ceil(min_pixels / (native_x * native_y))
+    else:
+        if isinstance(block_size, int):
+            request_x, request_y = block_size, block_size
+        elif len(block_size) == 2:
+            request_x, request_y = int(block_size[0]), int(block_size[1])
+        else:
+            raise ValueError(f"Unable to parse block_size: {block_size}")
+
+        if request_x <= 0 or request_y <= 0:
+            raise ValueError(f"block_size must be positive. Recieved: {block_size}")
+
+        # Round up to the nearest multiple of the native blocks.
+        block_x = ceil(request_x / native_x) * native_x
+        block_y = ceil(request_y / native_y) * native_y
+
+    return (min(block_x, width), min(block_y, height))
+
+
+def internal_block_windows(
+    width: int,
+    height: int,
+    block_x: int,
+    block_y: int,
+    overlap: int = 0,
+) -> List[Tuple[List[int], List[int]]]:
+    """OBS: INTERNAL: Single output.
+
+    Generates the windows covering a raster. Each entry is a tuple of
+    (window, core), both in the format [x_offset, y_offset, x_pixels, y_pixels].
+    The core windows tile the raster without overlap. The windows are the cores
+    expanded by overlap pixels in each direction, clipped to the raster.
+    """
+    windows: List[Tuple[List[int], List[int]]] = []
+    for y_offset in range(0, height, block_y):
+        y_pixels = min(block_y, height - y_offset)
+
+        y_start = max(0, y_offset - overlap)
+        y_end = min(height, y_offset + y_pixels + overlap)
+
+        for x_offset in range(0, width, block_x):
+            x_pixels = min(block_x, width - x_offset)
+
+            x_start = max(0, x_offset - overlap)
+            x_end = min(width, x_offset + x_pixels + overlap)
+
+            windows.append(
+                (
+                    [x_start, y_start, x_end - x_start, y_end - y_start],
+                    [x_offset, y_offset, x_pixels, y_pixels],
+                )
+            )
+
+    return windows
+
+
+def iter_raster_blocks(
+    raster: Union[List[Union[str, gdal.Dataset]], str, gdal.Dataset],
+    block_size: Optional[Union[int, List[int], Tuple[int, int]]] = None,
+    overlap: int = 0,
+    bands: Union[int, list] = -1,
+    filled: bool = False,
+):
+    """Iterates over aligned windows of a raster(s), reading only one window at a
+        time. Useful for processing rasters that do not fit in memory.
+
+    Args:
+        raster (list | path | Dataset): The raster(s) to iterate. If a list is
+        provided the rasters must be aligned and the bands are stacked in order.
+
+    **kwargs:
+        block_size (int | list | None): The size of the windows in pixels. Either
+        a single int or (x, y). The size is rounded up to a multiple of the
+        native block layout of the first raster. If None, the native blocks
+        are used.
 
-    return np.dstack(layers)
+        overlap (int): The amount of pixels to expand each window by on all
+        sides. Windows are clipped at the edges of the raster.
+
+        bands (list | int): The bands to read from each raster. -1 is all bands.
+
+        filled (bool): If False, masked arrays are returned.
+
+    Returns:
+        A generator yielding tuples of (window, core, array). Both window and core
+        are in the format [x_offset, y_offset, x_pixels, y_pixels]. window is the
+        area read into array. core is the area without the overlap.
+    """
+    type_check(raster, [list, str, gdal.Dataset], "raster")
+    type_check(block_size, [int, list, tuple], "block_size", allow_none=True)
+    type_check(overlap, [int], "overlap")
+    type_check(bands, [int, list], "bands")
+    type_check(filled, [bool], "filled")
+
+    if overlap < 0:
+        raise ValueError("overlap must be a positive integer.")
+
+    internal_rasters = to_raster_list(raster)
+
+    if not rasters_are_aligned(internal_rasters, same_extent=True):
+        raise ValueError(
+            "Cannot iterate rasters that are not aligned or have dissimilar extents."
+        )
+
+    # Open the datasets once. Keep references so the bands stay valid.
+    datasets = []
+    read_bands = []
+    for in_raster in internal_rasters:
+        ref = open_raster(in_raster, writeable=False)
+        datasets.append(ref)
+
+        if ref.RasterCount == 0:
+            raise ValueError("The input raster does not have any valid bands.")
+
+        for band in to_band_list(bands, ref.RasterCount):
+            read_bands.append(ref.GetRasterBand(band + 1))
+
+    width = datasets[0].RasterXSize
+    height = datasets[0].RasterYSize
+
+    block_x, block_y = internal_block_shape(
+        read_bands[0].GetBlockSize(), width, height, block_size
+    )
+
+    dtype = np.result_type(
+        *[gdal_to_numpy_datatype(band.DataType) for band in read_bands]
+    )
+    nodata_values = [band.GetNoDataValue() for band in read_bands]
+
+    for window, core in internal_block_windows(
+        width, height, block_x, block_y, overlap
+    ):
+        block = np.empty((window[3], window[2], len(read_bands)), dtype=dtype)
+
+        internal_read_bands(read_bands, window, block)
+
+        if not filled:
+            block = internal_mask_nodata(block, nodata_values)
+
+        yield (window, core, block)
 
 
 def internal_raster_to_disk(
@@ -737,6 +1126,7 @@ def internal_raster_to_disk(
         raise Exception(f"Error while parsing driver from extension: {out_path}")
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_path)
     driver.CreateCopy(out_path, ref, options=creation_options)
 
     return out_path
@@ -822,6 +1212,7 @@ def internal_raster_set_datatype(
     driver = gdal.GetDriverByName(path_to_driver(path))
 
     remove_if_overwrite(path, overwrite)
+    invalidate_raster_metadata(path)
 
     copy = driver.Create(
         path,
@@ -989,6 +1380,7 @@ def array_to_raster(
         print("WARNING: Input array and raster are not of equal size.")
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(output_name)
 
     destination = driver.Create(
         output_name,
@@ -1021,13 +1413,41 @@ def stack_rasters(
     overwrite: bool = True,
     dtype: Optional[str] = None,
     creation_options: list = [],
+    workers: int = 1,
 ) -> str:
-    """Stacks a list of rasters. Must be aligned."""
+    """Stacks a list of rasters. Must be aligned.
+
+    Args:
+        rasters (list): The rasters to stack.
+
+    **kwargs:
+        out_path (path | None): The destination. If None, a /vsimem/ GTiff is created.
+
+        overwrite (bool): Overwrite the destination if it exists.
+
+        dtype (str | None): The datatype of the output. Defaults to the datatype
+        of the first raster.
+
+        creation_options (list): GDAL creation options for the output.
+
+        workers (int): The amount of bands decoded concurrently. Bands are
+        written in order, in a single thread.
+
+    The rasters are copied window by window, so only a window of all the bands
+    (at most STACK_BUFFER_BYTES) is held in memory at a time.
+
+    Returns:
+        The path to the stacked raster.
+    """
     type_check(rasters, [list], "rasters")
     type_check(out_path, [str], "out_path", allow_none=True)
     type_check(overwrite, [bool], "overwrite")
     type_check(dtype, [str], "dtype", allow_none=True)
     type_check(creation_options, [list], "creation_options")
+    type_check(workers, [int], "workers")
+
+    if workers < 1:
+        raise ValueError(f"workers must be 1 or above. Recieved: {workers}")
 
     if not rasters_are_aligned(rasters, same_extent=True):
         raise ValueError("Rasters are not aligned. Try running align_rasters.")
@@ -1088,6 +1508,7 @@ def stack_rasters(
         nodata_value = None
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(output_name)
 
     destination = driver.Create(
         output_name,
@@ -1101,21 +1522,64 @@ def stack_rasters(
     destination.SetProjection(metadatas[0]["projection"])
     destination.SetGeoTransform(metadatas[0]["transform"])
 
-    bands_added = 0
-    for index, raster in enumerate(raster_list):
-        metadata = metadatas[index]
-        band_count = metadata["band_count"]
+    # Keep the datasets referenced while reading from their bands.
+    datasets = [open_raster(raster, writeable=False) for raster in raster_list]
+    read_bands = [
+        dataset.GetRasterBand(band + 1)
+        for dataset in datasets
+        for band in range(dataset.RasterCount)
+    ]
 
-        array = raster_to_array(raster)
+    width = metadatas[0]["width"]
+    height = metadatas[0]["height"]
 
-        for band_idx in range(band_count):
-            dst_band = destination.GetRasterBand(bands_added + 1)
-            dst_band.WriteArray(array[:, :, band_idx])
+    dst_bands = [destination.GetRasterBand(band + 1) for band in range(total_bands)]
+
+    if nodata_value is not None:
+        for dst_band in dst_bands:
+            dst_band.SetNoDataValue(nodata_value)
+
+    dtype = np.result_type(
+        *[gdal_to_numpy_datatype(band.DataType) for band in read_bands]
+    )
+
+    # Full width windows, aligned to the block rows of the destination, so every
+    # band of a destination block is written before moving on.
+    dst_block_y = dst_bands[0].GetBlockSize()[1]
+    rows = STACK_BUFFER_BYTES // (width * total_bands * dtype.itemsize)
+
+    block_x, block_y = internal_block_shape(
+        [width, dst_block_y], width, height, (width, max(1, rows))
+    )
+
+    buffer = np.empty((block_y, block_x, total_bands), dtype=dtype)
+
+    sources = internal_band_sources(datasets, -1) if workers > 1 else None
+
+    executor = None
+    handles = local()
+    if sources is not None:
+        executor = ThreadPoolExecutor(max_workers=min(workers, total_bands))
+
+    try:
+        for window, _core in internal_block_windows(width, height, block_x, block_y):
+            x_offset, y_offset, x_pixels, y_pixels = window
+            block = buffer[:y_pixels, :x_pixels, :]
+
+            if executor is not None and sources is not None:
+                internal_read_bands_threaded(
+                    sources, window, block, executor, handles
+                )
+            else:
+                internal_read_bands(read_bands, window, block)
 
-            if nodata_value is not None:
-                dst_band.SetNoDataValue(nodata_value)
+            for index, dst_band in enumerate(dst_bands):
+                dst_band.WriteArray(block[:, :, index], x_offset, y_offset)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
-            bands_added += 1
+    destination.FlushCache()
 
     return output_name
 
@@ -1141,6 +1605,7 @@ def stack_rasters_vrt(
     resample_algorithm = translate_resample_method(resample_alg)
     options = gdal.BuildVRTOptions(resampleAlg=resample_algorithm, separate=seperate)
 
+    invalidate_raster_metadata(out_path)
     gdal.BuildVRT(out_path, rasters, options=options)
 
     return out_path
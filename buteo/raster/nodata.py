@@ -20,6 +20,7 @@ from buteo.raster.io import (
     raster_to_memory,
     raster_to_metadata,
     array_to_raster,
+    invalidate_raster_metadata,
 )
 
 
@@ -50,7 +51,7 @@ def raster_has_nodata_value(
 
         raster_metadata = raster_to_metadata(internal_raster)
 
-        if not isinstance(raster_metadata, dict):
+        if isinstance(raster_metadata, list):
             raise Exception("Metadata is in the wrong format.")
 
         raster_nodata = raster_metadata["nodata_value"]
@@ -88,7 +89,7 @@ def raster_get_nodata_value(
 
         raster_metadata = raster_to_metadata(internal_raster)
 
-        if not isinstance(raster_metadata, dict):
+        if isinstance(raster_metadata, list):
             raise Exception("Metadata is in the wrong format.")
 
         raster_nodata = raster_metadata["nodata_value"]
@@ -174,7 +175,7 @@ def raster_set_nodata(
         if len(rasters_metadata) == 0:
             raster_metadata = raster_to_metadata(internal_raster)
 
-            if not isinstance(raster_metadata, dict):
+            if isinstance(raster_metadata, list):
                 raise Exception("Metadata is in the wrong format.")
 
             rasters_metadata.append(raster_metadata)
@@ -195,6 +196,8 @@ def raster_set_nodata(
                 raster_band = internal_raster.GetRasterBand(band + 1)
                 raster_band.SetNodataValue(internal_dst_nodata)
                 raster_band = None
+
+            invalidate_raster_metadata(internal_raster)
         else:
             if out_path is None:
                 raster_mem = raster_to_memory(internal_raster)
@@ -208,6 +211,8 @@ def raster_set_nodata(
                 raster_band = raster_mem_ref.GetRasterBand(band + 1)
                 raster_band.SetNodataValue(internal_dst_nodata)
 
+            invalidate_raster_metadata(raster_mem)
+
     if isinstance(raster, list):
         return output_rasters
 
@@ -379,6 +384,8 @@ def raster_mask_values(
                 raster_band = internal_raster.GetRasterBand(band + 1)
                 raster_band.WriteArray(arr[:, :, band])
                 raster_band = None
+
+            invalidate_raster_metadata(internal_raster)
         else:
             out_name = out_names[index]
             remove_if_overwrite(out_name, overwrite)
@@ -18,6 +18,7 @@ from buteo.raster.io import (
     open_raster,
     ready_io_raster,
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
 )
 
 
@@ -88,6 +89,7 @@ def internal_reproject_raster(
             out_nodata = dst_nodata
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_name)
 
     reprojected = gdal.Warp(
         out_name,
@@ -20,6 +20,7 @@ from buteo.raster.io import (
     ready_io_raster,
     default_options,
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
 )
 
 
@@ -80,6 +81,7 @@ def internal_resample_raster(
             out_nodata = dst_nodata
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_name)
 
     resampled = gdal.Warp(
         out_name,
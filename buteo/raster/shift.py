@@ -14,6 +14,7 @@ from buteo.raster.io import (
     open_raster,
     default_options,
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
 )
 
 
@@ -73,6 +74,7 @@ def shift_raster(
         out_format = path_to_driver(out_path)
 
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_name)
 
     driver = gdal.GetDriverByName(out_format)
 
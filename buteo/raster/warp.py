@@ -22,6 +22,7 @@ from buteo.raster.io import (
     open_raster,
     ready_io_raster,
     internal_raster_to_metadata,
+    invalidate_raster_metadata,
 )
 from buteo.vector.io import (
     open_vector,
@@ -125,6 +126,7 @@ def internal_warp_raster(
 
         clip_projection = clip_metadata["projection_osr"]
         clip_extent = clip_metadata["extent_geom_latlng"]
+        clip_extent_target = clip_metadata["extent"]
 
         # Fast check: Does the extent of the two inputs overlap?
         if not origin_extent.Intersects(clip_extent):
@@ -132,8 +134,8 @@ def internal_warp_raster(
 
         # Check if projections match, otherwise reproject target geom.
         if not target_projection.IsSame(clip_projection):
-            clip_metadata["extent"] = reproject_extent(
-                clip_metadata["extent"], clip_projection, target_projection,
+            clip_extent_target = reproject_extent(
+                clip_extent_target, clip_projection, target_projection,
             )
 
         # The extent needs to be reprojected to the target.
@@ -148,14 +150,14 @@ def internal_warp_raster(
             if adjust_bbox:
                 output_bounds = align_bbox(
                     raster_metadata["extent"],
-                    clip_metadata["extent"],
+                    clip_extent_target,
                     raster_metadata["pixel_width"],
                     raster_metadata["pixel_height"],
                     warp_format=True,
                 )
 
             else:
-                x_min_og, y_max_og, x_max_og, y_min_og = clip_metadata["extent"]
+                x_min_og, y_max_og, x_max_og, y_min_og = clip_extent_target
                 output_bounds = (
                     x_min_og,
                     y_min_og,
@@ -198,6 +200,7 @@ def internal_warp_raster(
 
     # Removes file if it exists and overwrite is True.
     remove_if_overwrite(out_path, overwrite)
+    invalidate_raster_metadata(out_name)
 
     warped = gdal.Warp(
         out_name,
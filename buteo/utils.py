@@ -7,6 +7,10 @@ import shutil
 import builtins
 import linecache
 import tracemalloc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Thread, Event
 
 
 
@@ -280,3 +284,181 @@ def type_check(
         )
 
     return False
+
+
+def prefetch(iterable, depth=2):
+    """Iterates an iterable in a background thread, keeping up to depth items
+        ready in a queue. Lets the production of items (reading, patching)
+        overlap with their consumption (inference). Exceptions raised while
+        producing are raised in the consumer.
+
+    Args:
+        iterable (iterable): The items to prefetch.
+
+    **kwargs:
+        depth (int): The maximum amount of items waiting in the queue.
+
+    Returns:
+        A generator yielding the items of the iterable, in order.
+    """
+    type_check(depth, [int], "depth")
+
+    if depth < 1:
+        raise ValueError(f"depth must be 1 or above. Recieved: {depth}")
+
+    done = object()
+    items = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item):
+        # Gives up if the consumer stopped, instead of blocking forever.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+
+            put((done, None))
+        except BaseException as error:
+            put((done, error))
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+
+            if item is done:
+                if error is not None:
+                    raise error
+
+                return
+
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def threaded_map(function, iterable, workers=2, depth=None):
+    """Applies a function to the items of an iterable in a pool of threads and
+        yields the results in order. Only depth items are in flight at a time,
+        so the results are produced ahead of the consumer, without consuming the
+        whole iterable. Useful for I/O and functions that release the GIL.
+
+    Args:
+        function (callable): The function to apply to each item.
+
+        iterable (iterable): The items.
+
+    **kwargs:
+        workers (int): The amount of threads.
+
+        depth (int | None): The maximum amount of items in flight. Defaults to
+        twice the amount of workers.
+
+    Returns:
+        A generator yielding the results, in the order of the items.
+    """
+    type_check(workers, [int], "workers")
+    type_check(depth, [int], "depth", allow_none=True)
+
+    if workers < 1:
+        raise ValueError(f"workers must be 1 or above. Recieved: {workers}")
+
+    depth = workers * 2 if depth is None else max(depth, 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        try:
+            for item in iterable:
+                pending.append(executor.submit(function, item))
+
+                if len(pending) >= depth:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class BackgroundWorker:
+    """Calls a function on items in a background thread, in the order they are
+        put. Used to overlap writing with computation. put blocks while depth
+        items are waiting. Exceptions raised in the background thread are raised
+        on the next put, or on close.
+
+    Args:
+        function (callable): The function called with each item.
+
+    **kwargs:
+        depth (int): The maximum amount of items waiting.
+    """
+
+    _stop = object()
+
+    def __init__(self, function, depth=2):
+        type_check(depth, [int], "depth")
+
+        self.function = function
+        self.items = Queue(maxsize=max(depth, 1))
+        self.error = None
+
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.items.get()
+
+            if item is self._stop:
+                return
+
+            # Drain the queue after an error, so put never blocks forever.
+            if self.error is not None:
+                continue
+
+            try:
+                self.function(item)
+            except BaseException as error:
+                self.error = error
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+
+        self.items.put(item)
+
+    def close(self):
+        """Waits for the waiting items to be processed."""
+        if self.thread.is_alive():
+            self.items.put(self._stop)
+            self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.thread.is_alive():
+            self.items.put(self._stop)
+            self.thread.join()
+
+        return False
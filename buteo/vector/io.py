@@ -12,7 +12,9 @@ from buteo.gdal_utils import (
     is_vector,
     is_raster,
     path_to_driver,
-    advanced_extents,
+    LazyExtents,
+    VectorMetadata,
+    VectorLayerMetadata,
 )
 from buteo.utils import (
     progress,
@@ -248,9 +250,6 @@ def internal_vector_to_metadata(
     vector_driver: ogr.Driver = datasource.GetDriver()
 
     path: str = datasource.GetDescription()
-    basename: str = os.path.basename(path)
-    name: str = os.path.splitext(basename)[0]
-    ext: str = os.path.splitext(basename)[1]
     driver_name: str = vector_driver.GetName()
 
     in_memory: bool = False
@@ -273,14 +272,6 @@ def internal_vector_to_metadata(
 
         x_min, x_max, y_min, y_max = layer.GetExtent()
         layer_name: str = layer.GetName()
-        extent: List[Number] = [x_min, y_max, x_max, y_min]
-        extent_ogr: List[Number] = [x_min, x_max, y_min, y_max]
-        extent_dict: Dict[str, Number] = {
-            "left": x_min,
-            "top": y_max,
-            "right": x_max,
-            "bottom": y_min,
-        }
 
         column_fid: str = layer.GetFIDColumn()
         column_geom: str = layer.GetGeometryColumn()
@@ -317,122 +308,60 @@ def internal_vector_to_metadata(
         geom_type_ogr: int = layer_defn.GetGeomType()
         geom_type: str = ogr.GeometryTypeToName(layer_defn.GetGeomType())
 
-        field_count: int = layer_defn.GetFieldCount()
         field_names: List[str] = []
         field_types: List[str] = []
         field_types_ogr: List[int] = []
 
-        for field_index in range(field_count):
+        for field_index in range(layer_defn.GetFieldCount()):
             field_defn: ogr.FieldDefn = layer_defn.GetFieldDefn(field_index)
             field_names.append(field_defn.GetName())
             field_type = field_defn.GetType()
             field_types_ogr.append(field_type)
             field_types.append(field_defn.GetFieldTypeName(field_type))
 
-        layer_dict: Metadata_vector_layer = {
-            "layer_name": layer_name,
-            "x_min": x_min,
-            "x_max": x_max,
-            "y_min": y_min,
-            "y_max": y_max,
-            "column_fid": column_fid,
-            "column_geom": column_geom,
-            "feature_count": feature_count,
-            "projection": projection,
-            "projection_osr": projection_osr,
-            "geom_type": geom_type,
-            "geom_type_ogr": geom_type_ogr,
-            "field_count": field_count,
-            "field_names": field_names,
-            "field_types": field_types,
-            "field_types_ogr": field_types_ogr,
-            "extent": extent,
-            "extent_ogr": extent_ogr,
-            "extent_dict": extent_dict,
-            "extent_wkt": None,
-            "extent_datasource": None,
-            "extent_geom": None,
-            "extent_latlng": None,
-            "extent_gdal_warp_latlng": None,
-            "extent_ogr_latlng": None,
-            "extent_dict_latlng": None,
-            "extent_wkt_latlng": None,
-            "extent_datasource_latlng": None,
-            "extent_geom_latlng": None,
-            "extent_geojson": None,
-            "extent_geojson_dict": None,
-        }
+        layer_dict = VectorLayerMetadata(
+            extents=LazyExtents([x_min, x_max, y_min, y_max], projection_osr)
+            if create_geometry
+            else None,
+            layer_name=layer_name,
+            x_min=x_min,
+            x_max=x_max,
+            y_min=y_min,
+            y_max=y_max,
+            column_fid=column_fid,
+            column_geom=column_geom,
+            feature_count=feature_count,
+            projection=projection,
+            projection_osr=projection_osr,
+            geom_type=geom_type,
+            geom_type_ogr=geom_type_ogr,
+            field_names=field_names,
+            field_types=field_types,
+            field_types_ogr=field_types_ogr,
+        )
 
         layers.append(layer_dict)
 
-    ds_extent: List[Number] = [ds_x_min, ds_y_max, ds_x_max, ds_y_min]
-    ds_extent_ogr: List[Number] = [ds_x_min, ds_x_max, ds_y_min, ds_y_max]
-    ds_extent_gdal_warp: List[Number] = [ds_x_min, ds_y_min, ds_x_max, ds_y_max]
-    ds_extent_dict: Dict[str, Number] = {
-        "left": ds_x_min,
-        "top": ds_y_max,
-        "right": ds_x_max,
-        "bottom": ds_y_min,
-    }
-
-    metadata: Metadata_vector = {
-        "path": path,
-        "basename": basename,
-        "name": name,
-        "ext": ext,
-        "in_memory": in_memory,
-        "projection": ds_projection,
-        "projection_osr": ds_projection_osr,
-        "driver": driver_name,
-        "x_min": ds_x_min,
-        "y_max": ds_y_max,
-        "x_max": ds_x_max,
-        "y_min": ds_y_min,
-        "is_vector": True,
-        "is_raster": False,
-        "layer_count": layer_count,
-        "layers": layers,
-        "extent": ds_extent,
-        "extent_ogr": ds_extent_ogr,
-        "extent_gdal_warp": ds_extent_gdal_warp,
-        "extent_dict": ds_extent_dict,
-        "extent_wkt": None,
-        "extent_datasource": None,
-        "extent_geom": None,
-        "extent_latlng": None,
-        "extent_gdal_warp_latlng": None,
-        "extent_ogr_latlng": None,
-        "extent_dict_latlng": None,
-        "extent_wkt_latlng": None,
-        "extent_datasource_latlng": None,
-        "extent_geom_latlng": None,
-        "extent_geojson": None,
-        "extent_geojson_dict": None,
-    }
-
+    # The expanded extents are computed on first access.
+    extents = None
     if create_geometry:
         proj = projection_osr if ds_projection_osr is None else ds_projection_osr
-        # Combined extents
-        extended_extents = advanced_extents(ds_extent_ogr, proj)
-
-        for key, value in extended_extents.items():
-            metadata[key] = value  # type: ignore
-
-        # Individual layer extents
-        for layer_index in range(layer_count):
-            layer_dict = layers[layer_index]
-            extended_extents_layer = advanced_extents(
-                layer_dict["extent_ogr"], layer_dict["projection_osr"]
-            )
-
-            for key, value in extended_extents_layer.items():
-                metadata[key] = value  # type: ignore
-
-        extent_datasource_layer = metadata["extent_datasource"].GetLayer()
-        extent_datasource_layer.SyncToDisk()
-
-        extent_datasource_latlng_layer = metadata["extent_datasource_latlng"].GetLayer()
-        extent_datasource_latlng_layer.SyncToDisk()
+        extents = LazyExtents([ds_x_min, ds_x_max, ds_y_min, ds_y_max], proj)
+
+    metadata: Metadata_vector = VectorMetadata(  # type: ignore
+        extents=extents,
+        path=path,
+        in_memory=in_memory,
+        projection=ds_projection,
+        projection_osr=ds_projection_osr,
+        driver=driver_name,
+        x_min=ds_x_min,
+        y_max=ds_y_max,
+        x_max=ds_x_max,
+        y_min=ds_y_min,
+        layer_count=layer_count,
+        layers=layers,
+    )
 
     return metadata
 
@@ -1,4 +1,4 @@
-from buteo.raster.io import internal_raster_to_metadata
+from buteo.raster.io import internal_raster_to_metadata, invalidate_raster_metadata
 from buteo.vector.clip import internal_clip_vector
 from osgeo import gdal
 
@@ -17,6 +17,9 @@ def rasterize_vector(
 
     metadata = internal_raster_to_metadata(reference)
 
+    if out_path is not None:
+        invalidate_raster_metadata(out_path)
+
     destination = driver.Create(
         out_path,  # Location of the saved raster, ignored if driver is memory.
         metadata["width"],  # Dataframe width in pixels (e.g. 1920px).